@@ -0,0 +1,793 @@
+import random
+import time
+import statistics
+import tempfile
+import os
+import sys
+import json
+import glob
+import platform
+import subprocess
+import urllib.request
+import concurrent.futures
+import numpy as np
+import networkx as nx
+import osmnx as ox
+from staticmap import CircleMarker, Line
+import igo
+import build
+import tiles
+import workers
+
+# Required parameters
+PLACE = 'Barcelona, Catalonia'
+GRAPH_FILENAME = 'barcelona.graph'
+WAY_INDEX_FILENAME = 'barcelona.ways'
+HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
+CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+QUERIES = 200
+POINTS = 5000
+SIZE = 800
+RENDERS = 20
+CONCURRENT_USERS = [1, 2, 4, 8, 16]
+REQUESTS_PER_USER = 10
+DESTINATIONS = [1, 3, 5]
+ISOCHRONE_MINUTES = [5, 10, 15]
+# Places of the recorded geocode table, used by the replayed trace
+TRACE_PLACES = ['Sagrada Família', 'Camp Nou', 'Park Güell', 'Plaça de Catalunya',
+                'Barceloneta', 'Badal', 'Hospital Clínic', 'Estació de Sants',
+                'Arc de Triomf', 'Port Olímpic', 'Plaça de les Glòries Catalanes',
+                'Monestir de Pedralbes']
+TRACE_USERS = 5
+TRACE_COMMANDS = 100
+TILE_ZOOMS = range(11, 15)  # Zoom levels of the recorded tiles
+REPEATS = 5  # Repetitions of every stage of the replay
+RESULTS_VERSION = 2
+# Modules that only the build tooling should import
+HEAVY_MODULES = ['osmnx', 'sklearn', 'geopandas', 'pandas', 'matplotlib', 'shapely']
+# Run in a new interpreter by bench_first_answer with the graph snapshot, the
+# tiles, the congestions and the two positions of a route
+FIRST_ANSWER_SCRIPT = '''
+import sys, json, time
+start = time.perf_counter()
+import bot
+imported = time.perf_counter()
+import igo, tiles
+tiles.configure(tiles.TileCache(sys.argv[2], offline=True))
+# The same steps as bot.load_graph, without the networkx graph
+snapshot = igo.load_graph_snapshot(sys.argv[1])
+router = igo.snapshot_router(snapshot)
+graph_map = igo.snapshot_map(snapshot, router.index)
+node_index = igo.snapshot_node_index(snapshot)
+router = router._replace(weights=igo.compute_itimes(snapshot, igo.download_congestions(sys.argv[3])))
+(orig_lat, orig_lon), (dest_lat, dest_lon) = json.loads(sys.argv[4])
+orig, dest = igo.nearest_nodes(node_index, [orig_lon, dest_lon], [orig_lat, dest_lat]).tolist()
+ipath = igo.router_shortest_path(router, orig, dest)
+igo.image_bytes(igo.plot_path(graph_map, ipath, 800), 'PNG', compress_level=1)
+answered = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_answer': answered - start,
+                  'heavy_modules': [name for name in json.loads(sys.argv[5]) if name in sys.modules]}))
+'''
+# Encodings compared by bench_render
+ENCODINGS = [('PNG', {'compress_level': 1}), ('PNG', {'compress_level': 6}),
+             ('PNG', {'compress_level': 9}), ('JPEG', {'quality': 75})]
+
+
+def load_igraph():
+    """Loads the graph of Barcelona (downloading it the first time) and
+    builds its intelligent version with the current congestions.
+
+    Returns:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute.
+    way_index: Dictionary returned by build_way_index.
+    congestions: List with the way id number and its current congestion.
+    """
+
+    if igo.exists_graph(GRAPH_FILENAME):
+        graph = igo.load_graph(GRAPH_FILENAME)
+    else:
+        graph = build.download_graph(PLACE)
+        igo.save_graph(graph, GRAPH_FILENAME)
+    highways = igo.download_highways(HIGHWAYS_URL)
+    way_index = None
+    if igo.exists_graph(WAY_INDEX_FILENAME):
+        way_index = igo.load_way_index(WAY_INDEX_FILENAME)
+    if way_index is None:
+        way_index = igo.build_way_index(graph, highways, igo.build_node_index(graph))
+        igo.save_way_index(way_index, WAY_INDEX_FILENAME)
+    congestions = igo.download_congestions(CONGESTIONS_URL)
+    return igo.build_igraph(graph, highways, congestions, way_index), way_index, congestions
+
+
+def path_itime(igraph, path):
+    """Given a graph and a path, returns the total itime of the path counting
+    1 for the edges without itime, as networkx does."""
+
+    return sum(igraph[u][v].get('itime', 1) for u, v in zip(path[:-1], path[1:]))
+
+
+def random_route(router, nodes):
+    """Returns a random pair of connected nodes."""
+
+    while True:
+        orig, dest = random.choice(nodes), random.choice(nodes)
+        try:
+            igo.router_shortest_path(router, orig, dest)
+            return orig, dest
+        except nx.NetworkXNoPath:
+            pass
+
+
+def summary(times):
+    """Returns a dictionary with the number of times and their mean, median
+    and 99th percentile in milliseconds."""
+
+    times = sorted(times)
+    p99 = times[min(len(times) - 1, int(0.99 * len(times)))]
+    return {'n': len(times), 'mean_ms': 1000 * statistics.mean(times),
+            'p50_ms': 1000 * statistics.median(times), 'p99_ms': 1000 * p99}
+
+
+def report(name, times):
+    """Prints the mean, median and 99th percentile of a list of times."""
+
+    result = summary(times)
+    print("%-12s mean %8.3f ms  p50 %8.3f ms  p99 %8.3f ms" % (
+        name, result['mean_ms'], result['p50_ms'], result['p99_ms']))
+
+
+def bench_routing(igraph, queries=QUERIES):
+    """Checks that the CSR router finds paths as good as networkx Dijkstra
+    for random pairs of nodes and compares the latency of both.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    queries: Number of random origin/destination pairs.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    start = time.perf_counter()
+    router = igo.build_router(igraph)
+    print("Router built in %.3f s." % (time.perf_counter() - start))
+    nodes = list(igraph.nodes)
+    random.seed(0)
+    nx_times, router_times = [], []
+    mismatches = 0
+    for _ in range(queries):
+        orig, dest = random.choice(nodes), random.choice(nodes)
+        start = time.perf_counter()
+        try:
+            expected = nx.shortest_path(igraph, orig, dest, weight='itime')
+        except nx.NetworkXNoPath:
+            expected = None
+        nx_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        try:
+            path = igo.router_shortest_path(router, orig, dest)
+        except nx.NetworkXNoPath:
+            path = None
+        router_times.append(time.perf_counter() - start)
+        if (expected is None) != (path is None):
+            mismatches += 1
+        elif expected is not None and abs(path_itime(igraph, expected) - path_itime(igraph, path)) > 1e-6:
+            mismatches += 1
+    print("%d of %d paths differ from networkx." % (mismatches, queries))
+    report("networkx", nx_times)
+    report("router", router_times)
+
+
+def bench_snapping(graph, points=POINTS):
+    """Compares the time per point of snapping random points of the graph
+    area one at a time with osmnx and in a single batch with the node index.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona.
+    points: Number of random points to snap.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    x = np.array([data['x'] for _, data in graph.nodes(data=True)])
+    y = np.array([data['y'] for _, data in graph.nodes(data=True)])
+    rng = np.random.default_rng(0)
+    X = rng.uniform(x.min(), x.max(), points)
+    Y = rng.uniform(y.min(), y.max(), points)
+    start = time.perf_counter()
+    node_index = igo.build_node_index(graph)
+    print("Node index built in %.3f s." % (time.perf_counter() - start))
+    # One point at a time is slow, so only a sample is measured
+    sample = min(points, 100)
+    start = time.perf_counter()
+    for i in range(sample):
+        ox.distance.nearest_nodes(graph, X[i], Y[i])
+    single = (time.perf_counter() - start) / sample
+    start = time.perf_counter()
+    igo.nearest_nodes(node_index, X, Y)
+    batch = (time.perf_counter() - start) / points
+    print("osmnx one by one  %10.3f us/point" % (1e6 * single))
+    print("node index batch  %10.3f us/point" % (1e6 * batch))
+
+
+def bench_startup(igraph, way_index):
+    """Compares the time needed to load the graph from the pickle file and
+    from the memory-mapped graph snapshot.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    way_index: Dictionary returned by build_way_index.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    directory = tempfile.mkdtemp()
+    pickle_filename = os.path.join(directory, 'graph.pickle')
+    snapshot_dirname = os.path.join(directory, 'graph.snapshot')
+    igo.save_graph(igraph, pickle_filename)
+    igo.save_graph_snapshot(igraph, way_index, snapshot_dirname)
+    start = time.perf_counter()
+    igo.load_graph(pickle_filename)
+    print("pickle load             %8.3f ms" % (1000 * (time.perf_counter() - start)))
+    start = time.perf_counter()
+    snapshot = igo.load_graph_snapshot(snapshot_dirname)
+    print("snapshot map            %8.3f ms" % (1000 * (time.perf_counter() - start)))
+    start = time.perf_counter()
+    igo.snapshot_router(snapshot)
+    print("snapshot router         %8.3f ms" % (1000 * (time.perf_counter() - start)))
+    start = time.perf_counter()
+    igo.snapshot_graph(snapshot)
+    igo.snapshot_way_index(snapshot)
+    print("snapshot graph and ways %8.3f ms" % (1000 * (time.perf_counter() - start)))
+
+
+def bench_render(igraph, renders=RENDERS):
+    """Renders a random route and compares the time and size of encoding it
+    in memory with several formats against saving it to a file and reading
+    it back, as the bot used to do.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    renders: Number of times every encoding is repeated.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    router = igo.build_router(igraph)
+    random.seed(0)
+    ipath = igo.router_shortest_path(router, *random_route(router, list(igraph.nodes)))
+    start = time.perf_counter()
+    image = igo.plot_path(igraph, ipath, SIZE)
+    print("plot_path render         %8.3f ms" % (1000 * (time.perf_counter() - start)))
+    filename = os.path.join(tempfile.mkdtemp(), 'mapa.png')
+    start = time.perf_counter()
+    for _ in range(renders):
+        image.save(filename)
+        with open(filename, 'rb') as file:
+            size = len(file.read())
+        os.remove(filename)
+    print("file PNG                 %8.3f ms %8d bytes" % (1000 * (time.perf_counter() - start) / renders, size))
+    for image_format, options in ENCODINGS:
+        start = time.perf_counter()
+        for _ in range(renders):
+            size = len(igo.image_bytes(image, image_format, **options))
+        print("memory %-4s %-12s %8.3f ms %8d bytes" % (
+            image_format, ','.join('%s=%s' % item for item in options.items()),
+            1000 * (time.perf_counter() - start) / renders, size))
+
+
+def plot_path_per_edge(igraph, ipath, SIZE):
+    """Plots a path as plot_path used to do, with a straight line for every
+    edge, to compare both versions."""
+
+    m = tiles.static_map(SIZE, SIZE)
+    m.add_marker(CircleMarker((igraph.nodes[ipath[0]]['x'], igraph.nodes[ipath[0]]['y']), 'red', 8))
+    m.add_marker(CircleMarker((igraph.nodes[ipath[-1]]['x'], igraph.nodes[ipath[-1]]['y']), 'red', 8))
+    for u, v in zip(ipath[:-1], ipath[1:]):
+        m.add_line(Line([(igraph.nodes[u]['x'], igraph.nodes[u]['y']),
+                         (igraph.nodes[v]['x'], igraph.nodes[v]['y'])], 'blue', 5))
+    return m.render()
+
+
+def bench_polyline(igraph, renders=RENDERS):
+    """Compares drawing random routes with a line per edge, as plot_path
+    used to do, with a single simplified polyline that follows the geometry
+    of the edges, in time and size of the encoded image.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    renders: Number of random routes.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    router = igo.build_router(igraph)
+    nodes = list(igraph.nodes)
+    random.seed(0)
+    edge_times, polyline_times = [], []
+    edge_sizes, polyline_sizes = [], []
+    edges, points, kept = 0, 0, 0
+    for _ in range(renders):
+        ipath = igo.router_shortest_path(router, *random_route(router, nodes))
+        start = time.perf_counter()
+        image = plot_path_per_edge(igraph, ipath, SIZE)
+        edge_times.append(time.perf_counter() - start)
+        edge_sizes.append(len(igo.image_bytes(image, 'PNG', compress_level=1)))
+        start = time.perf_counter()
+        image = igo.plot_path(igraph, ipath, SIZE)
+        polyline_times.append(time.perf_counter() - start)
+        polyline_sizes.append(len(igo.image_bytes(image, 'PNG', compress_level=1)))
+        coordinates = igo.path_coordinates(igraph, ipath)
+        m = tiles.static_map(SIZE, SIZE)
+        m.add_line(Line(coordinates, 'blue', 5))
+        edges += len(ipath) - 1
+        points += len(coordinates)
+        kept += len(tiles.simplify_polyline(coordinates, m._calculate_zoom()))
+    report("per edge", edge_times)
+    report("polyline", polyline_times)
+    print("PNG size per edge %8d bytes, polyline %8d bytes" % (
+        statistics.mean(edge_sizes), statistics.mean(polyline_sizes)))
+    print("%d edges, %d points of geometry, %d drawn after simplifying." % (edges, points, kept))
+
+
+def bench_load(igraph, way_index, processes=2, threads=4):
+    """Simulates several users asking for routes at the same time through a
+    RequestPool, as the bot does, and reports the latency of the requests
+    for a growing number of concurrent users.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    way_index: Dictionary returned by build_way_index.
+    processes: Number of routing processes of the pool.
+    threads: Number of rendering threads of the pool.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    directory = tempfile.mkdtemp()
+    snapshot_dirname = os.path.join(directory, 'graph.snapshot')
+    weights_filename = os.path.join(directory, 'weights.npy')
+    igo.save_graph_snapshot(igraph, way_index, snapshot_dirname)
+    router = igo.build_router(igraph)
+    workers.save_weights(router, weights_filename)
+    pool = workers.RequestPool(snapshot_dirname, processes, threads)
+    nodes = list(igraph.nodes)
+    random.seed(0)
+    routes = [random_route(router, nodes) for _ in range(max(CONCURRENT_USERS) * REQUESTS_PER_USER)]
+
+    def request(orig, dest):
+        start = time.perf_counter()
+        ipath = pool.route(router, weights_filename, orig, dest)
+        pool.render(workers.render_path, igraph, ipath, SIZE)
+        return time.perf_counter() - start
+
+    # The first request starts the processes
+    request(*routes[0])
+    for users in CONCURRENT_USERS:
+        with concurrent.futures.ThreadPoolExecutor(users) as executor:
+            times = list(executor.map(lambda route: request(*route), routes[:users * REQUESTS_PER_USER]))
+        report("%d users" % users, times)
+
+
+def bench_itimes(igraph, way_index, congestions, repeats=10):
+    """Compares computing the itimes of all the edges one by one, as
+    build_igraph used to do, with the vectorized compute_itimes.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    way_index: Dictionary returned by build_way_index.
+    congestions: List with the way id number and its current congestion.
+    repeats: Number of times every version is repeated.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for u, v, data in igraph.edges(data=True):
+            data['itime'] = igo.edge_itime(data, 2)
+        for way_id, density in congestions:
+            igo.add_itime_edges(igraph, way_index.get(way_id, []), density)
+    print("edge by edge     %8.3f ms" % (1000 * (time.perf_counter() - start) / repeats))
+    start = time.perf_counter()
+    table = igo.graph_arrays(igraph, way_index)
+    print("edge table       %8.3f ms (once per graph)" % (1000 * (time.perf_counter() - start)))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        igo.compute_itimes(table, congestions)
+    print("compute_itimes   %8.3f ms" % (1000 * (time.perf_counter() - start) / repeats))
+
+
+def bench_hierarchy(igraph, queries=QUERIES, repeats=10):
+    """Measures the time to build and customize the contraction hierarchy of
+    the graph, checks that its paths are as good as networkx Dijkstra and
+    compares its query latency with the plain CSR router, for random pairs
+    of nodes and for neighbouring ones. The first query after a
+    customization is measured apart, as it converts the arrays it reads.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    queries: Number of random origin/destination pairs.
+    repeats: Number of times the customization is repeated.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    router = igo.build_router(igraph)
+    start = time.perf_counter()
+    topology = igo.build_hierarchy(router)
+    print("Topology built in %.3f s (once per graph), %d arcs and %d triangles." % (
+        time.perf_counter() - start, len(topology.arc_targets), len(topology.triangle_uw)))
+    start = time.perf_counter()
+    for _ in range(repeats):
+        hierarchy_router = igo.customize_router(router, topology)
+    print("customization    %8.3f ms" % (1000 * (time.perf_counter() - start) / repeats))
+    nodes = list(igraph.nodes)
+    random.seed(0)
+    orig = random.choice(nodes)
+    start = time.perf_counter()
+    try:
+        igo.router_shortest_path(hierarchy_router, orig, random.choice(nodes))
+    except nx.NetworkXNoPath:
+        pass
+    print("first query      %8.3f ms" % (1000 * (time.perf_counter() - start)))
+    router_times, hierarchy_times = [], []
+    mismatches = 0
+    for _ in range(queries):
+        orig, dest = random.choice(nodes), random.choice(nodes)
+        try:
+            expected = nx.shortest_path(igraph, orig, dest, weight='itime')
+        except nx.NetworkXNoPath:
+            expected = None
+        start = time.perf_counter()
+        try:
+            igo.router_shortest_path(router, orig, dest)
+        except nx.NetworkXNoPath:
+            pass
+        router_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        try:
+            path = igo.router_shortest_path(hierarchy_router, orig, dest)
+        except nx.NetworkXNoPath:
+            path = None
+        hierarchy_times.append(time.perf_counter() - start)
+        if (expected is None) != (path is None):
+            mismatches += 1
+        elif expected is not None and abs(path_itime(igraph, expected) - path_itime(igraph, path)) > 1e-6:
+            mismatches += 1
+    print("%d of %d paths differ from networkx." % (mismatches, queries))
+    report("router", router_times)
+    report("hierarchy", hierarchy_times)
+    router_times, hierarchy_times = [], []
+    for orig in random.sample(nodes, min(queries, len(nodes))):
+        for dest in list(igraph[orig])[:1]:
+            start = time.perf_counter()
+            igo.router_shortest_path(router, orig, dest)
+            router_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            igo.router_shortest_path(hierarchy_router, orig, dest)
+            hierarchy_times.append(time.perf_counter() - start)
+    report("router near", router_times)
+    report("hier. near", hierarchy_times)
+
+
+def bench_many(igraph, queries=QUERIES):
+    """Compares routing from one origin to several destinations with one
+    search per destination and with a single one-to-many search, checking
+    that both give the same itimes, and measures the time of isochrones.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph.
+    queries: Number of random origins.
+
+    Returns:
+    ----------
+    Nothing. Prints the results.
+    """
+
+    router = igo.build_router(igraph)
+    nodes = list(igraph.nodes)
+    random.seed(0)
+    for count in DESTINATIONS:
+        separate_times, single_times = [], []
+        mismatches = 0
+        for _ in range(queries):
+            orig = random.choice(nodes)
+            dests = [random.choice(nodes) for _ in range(count)]
+            start = time.perf_counter()
+            expected = []
+            for dest in dests:
+                try:
+                    expected.append(path_itime(igraph, igo.router_shortest_path(router, orig, dest)))
+                except nx.NetworkXNoPath:
+                    expected.append(None)
+            separate_times.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            routes = igo.router_shortest_paths(router, orig, dests)
+            single_times.append(time.perf_counter() - start)
+            for itime, route in zip(expected, routes):
+                if (itime is None) != (route is None):
+                    mismatches += 1
+                elif itime is not None and abs(itime - path_itime(igraph, route[1])) > 1e-6:
+                    mismatches += 1
+        print("%d destinations, %d routes differ." % (count, mismatches))
+        report("separate", separate_times)
+        report("one-to-many", single_times)
+    for minutes in ISOCHRONE_MINUTES:
+        times = []
+        for _ in range(queries // 10 or 1):
+            start = time.perf_counter()
+            reachable = igo.router_isochrone(router, random.choice(nodes), 60 * minutes)
+            times.append(time.perf_counter() - start)
+        report("%d min" % minutes, times)
+        print("%d nodes reachable in the last one." % len(reachable))
+
+
+def record_file(URL, FILENAME):
+    """Downloads a file and stores it as it is."""
+
+    with urllib.request.urlopen(URL) as response, open(FILENAME, 'wb') as file:
+        file.write(response.read())
+
+
+def record_fixtures(DIRNAME, snapshots=1, interval=300):
+    """Records everything the replay needs from the network in a directory:
+    the graph, the highways file, congestion snapshots, a geocode table of
+    TRACE_PLACES, the tiles of Barcelona and a synthetic trace of commands.
+    Recording again adds new congestion snapshots and keeps the rest.
+
+    Parameters:
+    ----------
+    DIRNAME: Name of the directory of the fixtures.
+    snapshots: Number of congestion snapshots to record.
+    interval: Seconds between two congestion snapshots. The open data portal
+    updates them every five minutes.
+
+    Returns:
+    ----------
+    Nothing. Only stores the fixtures.
+    """
+
+    os.makedirs(os.path.join(DIRNAME, 'congestions'), exist_ok=True)
+    graph_filename = os.path.join(DIRNAME, 'graph.pickle')
+    if not igo.exists_graph(graph_filename):
+        if igo.exists_graph(GRAPH_FILENAME):
+            graph = igo.load_graph(GRAPH_FILENAME)
+        else:
+            graph = build.download_graph(PLACE)
+        igo.save_graph(graph, graph_filename)
+    highways_filename = os.path.join(DIRNAME, 'highways.csv')
+    if not os.path.exists(highways_filename):
+        record_file(HIGHWAYS_URL, highways_filename)
+    for i in range(snapshots):
+        if i > 0:
+            time.sleep(interval)
+        record_file(CONGESTIONS_URL, os.path.join(DIRNAME, 'congestions', '%d.csv' % int(time.time())))
+    # The answers of the remote geocoder are kept in the cache file
+    geocoder = igo.Geocoder(CACHE_FILENAME=os.path.join(DIRNAME, 'geocode.json'))
+    for place in TRACE_PLACES:
+        geocoder.geocode(place)
+    tiles.prefetch_tiles(tiles.TileCache(os.path.join(DIRNAME, 'tiles'), max_bytes=float('inf')), zooms=TILE_ZOOMS)
+    trace_filename = os.path.join(DIRNAME, 'trace.json')
+    if not os.path.exists(trace_filename):
+        with open(trace_filename, 'w') as file:
+            json.dump(synthetic_trace(), file)
+
+
+def synthetic_trace(seed=0):
+    """Returns a list of commands of TRACE_USERS users, as [user, command,
+    place], where every user first fixes a position with /pos and then
+    mostly asks for routes with /go."""
+
+    rng = random.Random(seed)
+    trace = [[user, 'pos', rng.choice(TRACE_PLACES)] for user in range(TRACE_USERS)]
+    while len(trace) < TRACE_COMMANDS:
+        command = 'go' if rng.random() < 0.7 else 'pos'
+        trace.append([rng.randrange(TRACE_USERS), command, rng.choice(TRACE_PLACES)])
+    return trace
+
+
+def timed(times, function, *args, **kwargs):
+    """Calls a function, appends the seconds it took to times and returns
+    its result."""
+
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    times.append(time.perf_counter() - start)
+    return result
+
+
+def git_commit():
+    """Returns the current git commit, or None if it is unknown."""
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_first_answer(SNAPSHOT_DIRNAME, TILES_DIRNAME, CONGESTIONS_URL, positions):
+    """Starts a new interpreter that imports the bot and answers a first
+    route from the graph snapshot, as the bot does after starting.
+
+    Parameters:
+    ----------
+    SNAPSHOT_DIRNAME: Name of the directory of the graph snapshot.
+    TILES_DIRNAME: Name of the directory of the tiles, used offline.
+    CONGESTIONS_URL: Url of the congestions.
+    positions: (latitude, longitude) of the origin and the destination.
+
+    Returns:
+    ----------
+    times: Dictionary with the seconds needed to import the bot and to
+    answer, and the list of heavy modules that were imported.
+    """
+
+    output = subprocess.run([sys.executable, '-c', FIRST_ANSWER_SCRIPT, SNAPSHOT_DIRNAME, TILES_DIRNAME,
+                             CONGESTIONS_URL, json.dumps(positions), json.dumps(HEAVY_MODULES)],
+                            capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def replay_fixtures(DIRNAME, repeats=REPEATS):
+    """Times every stage of the igo pipeline and replays the trace of
+    commands using only the fixtures recorded by record_fixtures, so the
+    results do not depend on the network and can be compared between
+    commits.
+
+    Parameters:
+    ----------
+    DIRNAME: Name of the directory of the fixtures.
+    repeats: Number of times every stage is repeated.
+
+    Returns:
+    ----------
+    results: Dictionary with the times of every stage and of every command
+    of the trace, ready to be stored as json.
+    """
+
+    stages = {}
+    for name in ['load_graph', 'parse_highways', 'parse_congestions', 'build_way_index',
+                 'build_igraph', 'compute_itimes', 'snap', 'route', 'plot_path', 'encode',
+                 'import', 'first_answer']:
+        stages[name] = []
+    highways_url = 'file:' + urllib.request.pathname2url(os.path.abspath(os.path.join(DIRNAME, 'highways.csv')))
+    congestions_urls = ['file:' + urllib.request.pathname2url(os.path.abspath(filename))
+                        for filename in sorted(glob.glob(os.path.join(DIRNAME, 'congestions', '*.csv')))]
+    tiles.configure(tiles.TileCache(os.path.join(DIRNAME, 'tiles'), offline=True))
+    for _ in range(repeats):
+        graph = timed(stages['load_graph'], igo.load_graph, os.path.join(DIRNAME, 'graph.pickle'))
+        highways = timed(stages['parse_highways'], igo.download_highways, highways_url)
+    snapshots = [timed(stages['parse_congestions'], igo.download_congestions, url) for url in congestions_urls]
+    node_index = igo.build_node_index(graph)
+    for _ in range(repeats):
+        way_index = timed(stages['build_way_index'], igo.build_way_index, graph, highways, node_index)
+    for congestions in snapshots:
+        igraph = timed(stages['build_igraph'], igo.build_igraph, graph, highways, congestions, way_index)
+    table = igo.graph_arrays(igraph, way_index)
+    for _ in range(repeats):
+        for congestions in snapshots:
+            timed(stages['compute_itimes'], igo.compute_itimes, table, congestions)
+    router = igo.build_router(igraph)
+    geocoder = igo.Geocoder(igo.build_gazetteer(graph), os.path.join(DIRNAME, 'geocode.json'))
+    positions = [geocoder.geocode(place) for place in TRACE_PLACES]
+    for _ in range(repeats):
+        for lat, lon in positions:
+            timed(stages['snap'], igo.nearest_nodes, node_index, lon, lat)
+    for (lat, lon), destination in zip(positions, TRACE_PLACES[1:] + TRACE_PLACES[:1]):
+        ipath = timed(stages['route'], igo.get_shortest_path_with_itimes, igraph, lat, lon, destination,
+                      router, node_index, geocoder=geocoder)
+        image = timed(stages['plot_path'], igo.plot_path, igraph, ipath, SIZE)
+        timed(stages['encode'], igo.image_bytes, image, 'PNG', compress_level=1)
+    # Start the bot from the graph snapshot in new interpreters
+    snapshot_dirname = os.path.join(tempfile.mkdtemp(), 'graph.snapshot')
+    igo.save_graph_snapshot(igraph, way_index, snapshot_dirname)
+    for _ in range(repeats):
+        startup = bench_first_answer(os.path.abspath(snapshot_dirname), os.path.abspath(os.path.join(DIRNAME, 'tiles')),
+                                     congestions_urls[0], positions[:2])
+        stages['import'].append(startup['import'])
+        stages['first_answer'].append(startup['first_answer'])
+    # Replay the trace as the bot does, with a route cache
+    with open(os.path.join(DIRNAME, 'trace.json')) as file:
+        trace = json.load(file)
+    cache = igo.RouteCache()
+    users = {}
+    commands = {'go': [], 'pos': []}
+    start = time.perf_counter()
+    for user, command, place in trace:
+        if command == 'pos':
+            users[user] = timed(commands['pos'], geocoder.geocode, place)
+        else:
+            command_start = time.perf_counter()
+            lat, lon = users[user]
+            ipath = igo.get_shortest_path_with_itimes(igraph, lat, lon, place, router, node_index,
+                                                      cache, 0, geocoder)
+            igo.image_bytes(igo.plot_path(igraph, ipath, SIZE), 'PNG', compress_level=1)
+            commands['go'].append(time.perf_counter() - command_start)
+    trace_seconds = time.perf_counter() - start
+    return {
+        'version': RESULTS_VERSION,
+        'commit': git_commit(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'fixtures': {'nodes': len(graph), 'edges': graph.number_of_edges(), 'highways': len(highways),
+                     'congestion_snapshots': len(snapshots), 'trace_commands': len(trace)},
+        'stages': {name: summary(times) for name, times in stages.items() if times},
+        'heavy_modules': startup['heavy_modules'],
+        'trace': {'seconds': trace_seconds, 'route_cache_hit_rate': cache.hit_rate(),
+                  'commands': {name: summary(times) for name, times in commands.items() if times}},
+    }
+
+
+def compare_results(old, new):
+    """Given the results of two replays, prints the mean time of every stage
+    and command in both and the ratio between them."""
+
+    rows = [(name, old['stages'].get(name), result) for name, result in new['stages'].items()]
+    rows += [('/' + name, old['trace']['commands'].get(name), result)
+             for name, result in new['trace']['commands'].items()]
+    for name, before, after in rows:
+        if before is None:
+            print("%-18s %10s %10.3f ms" % (name, '-', after['mean_ms']))
+        else:
+            print("%-18s %10.3f %10.3f ms  x%.2f" % (
+                name, before['mean_ms'], after['mean_ms'], after['mean_ms'] / max(before['mean_ms'], 1e-9)))
+
+
+if __name__ == '__main__':
+    # Usage:
+    #   python bench.py                          live benchmarks
+    #   python bench.py record DIR [SNAPSHOTS]   record the fixtures in DIR
+    #   python bench.py replay DIR [OUTPUT]      replay them and write json
+    #   python bench.py compare OLD NEW          compare two replays
+    if len(sys.argv) > 2 and sys.argv[1] == 'record':
+        record_fixtures(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1)
+    elif len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        results = json.dumps(replay_fixtures(sys.argv[2]), indent=2)
+        if len(sys.argv) > 3:
+            with open(sys.argv[3], 'w') as file:
+                file.write(results)
+        else:
+            print(results)
+    elif len(sys.argv) > 3 and sys.argv[1] == 'compare':
+        with open(sys.argv[2]) as old_file, open(sys.argv[3]) as new_file:
+            compare_results(json.load(old_file), json.load(new_file))
+    else:
+        igraph, way_index, congestions = load_igraph()
+        bench_itimes(igraph, way_index, congestions)
+        bench_startup(igraph, way_index)
+        bench_snapping(igraph)
+        bench_routing(igraph)
+        bench_hierarchy(igraph)
+        bench_many(igraph)
+        bench_render(igraph)
+        bench_polyline(igraph)
+        bench_load(igraph, way_index)
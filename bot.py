@@ -1,26 +1,367 @@
-import random
 import igo
-import osmnx as ox
+import tiles
+import workers
+import telemetry
+import webhook
 import time
 import os
-
-from staticmap import StaticMap, CircleMarker
-
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+import threading
+import io
+import collections
+import logging
+import sys
+import json
+import queue
+import multiprocessing
+import numpy as np
+import networkx as nx
+
+from staticmap import CircleMarker
+
+from telegram import Bot, Update
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters
+from telegram.utils.request import Request
 
 # Required parameters
 PLACE = 'Barcelona, Catalonia'
+PBF_FILENAME = None  # Local .osm.pbf extract to build the graph offline (None to download it)
+PBF_BBOX = (2.05, 41.31, 2.24, 41.47)  # (west, south, east, north) of the graph read from the extract
+PBF_INDEX_FILENAME = None  # File with the nodes of the extract while reading it (None to keep them in memory)
+HIGHWAYS_FILENAME = None  # Local copy of the highways file (None to download it from HIGHWAYS_URL)
 GRAPH_FILENAME = 'barcelona.graph'
+GRAPH_SNAPSHOT_DIRNAME = 'barcelona.snapshot'
+GAZETTEER_FILENAME = 'barcelona.places'
+GEOCODE_CACHE_FILENAME = 'geocode.json'
+TILES_DIRNAME = 'tiles'
+TILES_MAX_BYTES = 512 * 2**20  # Maximum size of the tiles stored on disk
+OFFLINE_TILES = False  # True to only use the tiles in TILES_DIRNAME
+BASE_MAP_ZOOMS = range(11, 15)  # Zoom levels of Barcelona kept in memory
+BASE_MAP_DIRNAME = 'base_map'  # Images of the base map mapped by every process
 SIZE = 800
+# Format and options of the images sent to the users
+IMAGE_FORMAT = 'PNG'
+IMAGE_OPTIONS = {'compress_level': 1}
+UPDATE_MINUTES = 15  # Minutes between congestion updates
+HISTORY_DIRNAME = 'history'  # Congestions of the last updates, to know the usual ones
+HISTORY_SIZE = 4 * 24 * 28  # Updates kept in the history, four weeks
+MAX_CONGESTION_MINUTES = 45  # Older live congestions are replaced by the usual ones
+CACHE_SIZE = 1024  # Maximum number of routes and maps kept in memory
+WEIGHTS_DIRNAME = 'weights'  # Itimes of every snapshot for the routing processes
+DISPATCHER_WORKERS = 8  # Threads that answer the Telegram updates
+ROUTING_PROCESSES = 2  # Processes that compute routes (0 to route in the threads)
+HIERARCHY = True  # Route with a contraction hierarchy customized on every update
+HIERARCHY_DIRNAME = 'hierarchy'  # Topology of the hierarchy mapped by every process
+RENDER_THREADS = 4  # Threads that render maps
+MAX_PENDING_REQUESTS = 32  # Slow requests answered or waiting at once, the rest are asked to retry
+MAX_DESTINATIONS = 5  # Destinations of a single /go
+MAX_REACH_MINUTES = 30  # Maximum time of a /reach map
+TRAFFIC_ZOOM = 15  # Zoom level of the /traffic maps around the user
+METRICS_PORT = 9100  # Local port of the metrics endpoint (None to disable it)
+SLOW_REQUEST_SECONDS = 2  # Requests that take longer are logged with their stages
+PROFILE_RATE = 0.0  # Fraction of requests profiled, stored if they are slow
+PROFILE_DIRNAME = 'profiles'
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s %(message)s'
+# Webhook mode. Telegram needs https, so WEBHOOK_URL is usually a reverse
+# proxy that forwards to WEBHOOK_PORT.
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')  # Public url of the webhook, without the path (None to set it by hand)
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_PROCESSES = 4  # Bot processes that answer the updates
+USERS_FILENAME = 'users.sqlite3'  # Positions of the users shared by the bot processes
+PUBLISHED_SNAPSHOT_FILENAME = 'snapshot.json'  # Current congestions published by the leader
+# Url of the Telegram Bot API, such as the one of fake_telegram.py (None for
+# the real one)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
 
-init_time = -1
+# Everything a /go request needs to route, built from the same congestions.
+# A new snapshot is built for every update and replaces the previous one at
+# once, so requests that already took a snapshot keep using a consistent one.
+Snapshot = collections.namedtuple('Snapshot', ['router', 'node_index', 'congestions', 'time', 'weights_filename'])
+
 users = {}  # Map with user's Telegram ID and its position.
-graph = None
-highways = {}
-igraph = None
-congestions = []
+edge_table = None  # Arrays of the graph snapshot
+graph_map = None  # Arrays of the graph snapshot used to draw the routes
+base_router = None  # Router of the graph without itimes
+topology = None  # Contraction hierarchy of base_router when routing in the threads
+geocoder = None
+snapshot = None
+pool = None
+history = None  # Congestions of the last updates
+live_time = 0.0  # Time when the live congestions last changed
+pending_requests = threading.BoundedSemaphore(MAX_PENDING_REQUESTS)
+# Requests of every chat that wait for the earlier ones of the same chat.
+# A chat is in it while one of its requests is being answered.
+chat_requests = {}
+chat_lock = threading.Lock()
+# Identical geocodes, routes and maps requested at once are computed once
+flights = igo.SingleFlight()
+# Information about the congestion updates
+metrics = {'updates': 0, 'unchanged_updates': 0, 'predicted_updates': 0, 'update_errors': 0,
+           'last_update_seconds': 0.0, 'last_update_edges': 0}
+# Information about the last download of the congestions, used to skip the
+# update when they have not changed
+congestions_feed = {}
+# Latency of every stage of the requests and errors by stage
+stats = telemetry.Telemetry(SLOW_REQUEST_SECONDS, PROFILE_RATE, PROFILE_DIRNAME)
+logger = logging.getLogger('igo')
+# Message sent to the user when a request fails at every stage
+ERROR_MESSAGES = {
+    'position': "ERROR. Ensure you share your location or use /pos to fix a position.",
+    'geocode': "ERROR. The place could not be found. Try with another name.",
+    'snap': "ERROR. The place is too far from the streets of Barcelona.",
+    'route': "ERROR. The route could not be computed. Try again later.",
+    'render': "ERROR. The map could not be drawn. Try again later.",
+    None: "ERROR. Something went wrong. Try again later.",
+}
+BUSY_MESSAGE = "I'm busy right now. Try again in a few seconds."
+# Routes and rendered maps of the current snapshot. The time of the snapshot
+# identifies its congestions.
+route_cache = igo.RouteCache(CACHE_SIZE, 60 * UPDATE_MINUTES)
+map_cache = igo.RouteCache(CACHE_SIZE, 60 * UPDATE_MINUTES)
+# Congestion maps of the current snapshot: the whole city under None and the
+# maps around the users under the (zoom, x, y) of their tile. They are kept
+# while the congestions do not change.
+traffic_cache = igo.RouteCache(CACHE_SIZE, 60 * MAX_CONGESTION_MINUTES)
+
+
+def load_graph():
+    """Map the arrays of the graph snapshot (building it the first time) and
+    return the node index of the graph. The networkx graph is not created:
+    routes are computed and drawn over the arrays."""
+
+    global edge_table, graph_map, base_router
+    graph_snapshot = None
+    if os.path.isdir(GRAPH_SNAPSHOT_DIRNAME):
+        graph_snapshot = igo.load_graph_snapshot(GRAPH_SNAPSHOT_DIRNAME)
+    if graph_snapshot is None:
+        logger.info("Snapshot not found or outdated. Starting the creation of the graph.")
+        # The build tooling is slow to import and only needed this time
+        import build
+        build.build_snapshot(PLACE, HIGHWAYS_URL, GRAPH_SNAPSHOT_DIRNAME, GAZETTEER_FILENAME,
+                            PBF_FILENAME, PBF_BBOX, HIGHWAYS_FILENAME, PBF_INDEX_FILENAME)
+        graph_snapshot = igo.load_graph_snapshot(GRAPH_SNAPSHOT_DIRNAME)
+    logger.info("Loading the graph and the way index from the snapshot.")
+    # The itimes are computed over the arrays of the snapshot, in the same
+    # order as in the routing processes
+    edge_table = graph_snapshot
+    base_router = igo.snapshot_router(edge_table)
+    graph_map = igo.snapshot_map(edge_table, base_router.index)
+    return igo.snapshot_node_index(edge_table)
+
+
+def load_topology():
+    """Return the topology of the contraction hierarchy of the graph, mapped
+    from HIERARCHY_DIRNAME so that every process shares it. It is built and
+    saved the first time."""
+
+    topology = igo.load_hierarchy(HIERARCHY_DIRNAME, base_router)
+    if topology is None:
+        logger.info("Building the contraction hierarchy.")
+        igo.save_hierarchy(igo.build_hierarchy(base_router), base_router, HIERARCHY_DIRNAME)
+        topology = igo.load_hierarchy(HIERARCHY_DIRNAME, base_router)
+    return topology
+
+
+def load_base_map(tile_cache):
+    """Return the base map of Barcelona, mapped from BASE_MAP_DIRNAME so
+    that every process shares it. It is assembled from the tiles and saved
+    the first time."""
+
+    logger.info("Preparing the base map.")
+    return tiles.BaseMap(tile_cache, zooms=BASE_MAP_ZOOMS, DIRNAME=BASE_MAP_DIRNAME)
+
+
+def load_services(routing_processes):
+    """Prepare the geocoder, the base map and the pool that answer the
+    requests. With no routing processes, routes are computed in the threads
+    of this process."""
+
+    global topology, geocoder, pool
+    if HIERARCHY:
+        # The routing processes map the same one
+        shared_topology = load_topology()
+        if routing_processes == 0:
+            topology = shared_topology
+    gazetteer = {}
+    if os.path.exists(GAZETTEER_FILENAME):
+        gazetteer = igo.load_gazetteer(GAZETTEER_FILENAME)
+    geocoder = igo.Geocoder(gazetteer, GEOCODE_CACHE_FILENAME)
+    tile_cache = tiles.TileCache(TILES_DIRNAME, TILES_MAX_BYTES, OFFLINE_TILES)
+    tiles.configure(tile_cache, load_base_map(tile_cache))
+    pool = workers.RequestPool(GRAPH_SNAPSHOT_DIRNAME, routing_processes, RENDER_THREADS,
+                               HIERARCHY_DIRNAME if HIERARCHY else None)
+
+
+def load_data():
+    """Load the graph, prepare everything needed to answer, download the
+    congestions and build the first snapshot. Called once before the bot
+    starts answering."""
+
+    global snapshot
+    node_index = load_graph()
+    load_services(ROUTING_PROCESSES)
+    snapshot = first_snapshot(node_index)
+    prerender_traffic(snapshot)
+
+
+def first_snapshot(node_index):
+    """Download the congestions and return the first snapshot. If they
+    cannot be downloaded, the usual congestions of the history are used."""
+
+    global history, live_time
+    history = igo.CongestionHistory(HISTORY_DIRNAME, edge_table.way_ids, HISTORY_SIZE)
+    logger.info("Way index ready. Starting congestions download.")
+    snapshot_time = time.time()
+    try:
+        congestions = igo.download_congestions(CONGESTIONS_URL, congestions_feed)
+    except Exception as e:
+        if len(history) == 0:
+            raise
+        metrics['update_errors'] += 1
+        logger.error("Congestions download failed, using the usual ones: %r", e)
+        congestions = []
+    else:
+        history.add(congestions, snapshot_time)
+        live_time = snapshot_time
+    logger.info("Congestions ready. Computing the itimes.")
+    snapshot = new_snapshot(node_index, history.fill(congestions, snapshot_time), snapshot_time)
+    logger.info("itimes properly computed.")
+    return snapshot
+
+
+def new_snapshot(node_index, congestions, snapshot_time, previous=None):
+    """Compute the itimes of the given congestions, store them for the
+    routing processes and return the snapshot with everything. If the
+    previous snapshot is given, only the itimes of the ways whose congestion
+    has changed are recomputed."""
+
+    if previous is None:
+        itime = igo.compute_itimes(edge_table, congestions)
+    else:
+        itime, touched = igo.update_itimes(edge_table, previous.router.weights, previous.congestions, congestions)
+        metrics['last_update_edges'] = touched
+    router = base_router._replace(weights=itime)
+    if topology is not None:
+        router = igo.customize_router(router, topology)
+    weights_filename = os.path.join(WEIGHTS_DIRNAME, '%d.npy' % int(1000 * snapshot_time))
+    workers.save_weights(router, weights_filename)
+    return Snapshot(router, node_index, congestions, snapshot_time, weights_filename)
+
+
+def update_snapshot():
+    """Download the current congestions and replace the snapshot with a new
+    one built from them, filling the ways without data with their usual
+    level. If there have been no new congestions for MAX_CONGESTION_MINUTES,
+    the usual ones are used. The current snapshot is not modified. Return
+    True if the snapshot has been replaced."""
+
+    global snapshot, live_time
+    start_time = time.time()
+    old = snapshot
+    try:
+        congestions = igo.download_congestions(CONGESTIONS_URL, congestions_feed)
+        failed = False
+    except Exception as e:
+        metrics['update_errors'] += 1
+        logger.error("Congestions download failed: %r", e)
+        congestions, failed = None, True
+    if congestions is not None:
+        history.add(congestions, start_time)
+        live_time = start_time
+        congestions = history.fill(congestions, start_time)
+    elif start_time - live_time > 60 * MAX_CONGESTION_MINUTES and len(history) > 0:
+        # The live congestions are too old to be trusted
+        metrics['predicted_updates'] += 1
+        logger.info("No new congestions for %d minutes. Using the usual ones.", (start_time - live_time) / 60)
+        congestions = history.fill([], start_time)
+    else:
+        if not failed:
+            # The congestions have not changed, so the snapshot is still valid
+            metrics['unchanged_updates'] += 1
+            logger.info("Congestions have not changed since the last update.")
+        return False
+    # The itimes of the current snapshot are not modified
+    snapshot = new_snapshot(old.node_index, congestions, start_time, old)
+    # Remove the itimes and maps of older snapshots. The previous one is kept
+    # for the requests that are still using it.
+    kept = (os.path.splitext(old.weights_filename)[0], os.path.splitext(snapshot.weights_filename)[0])
+    for name in os.listdir(WEIGHTS_DIRNAME):
+        filename = os.path.join(WEIGHTS_DIRNAME, name)
+        if os.path.splitext(filename)[0] not in kept:
+            os.remove(filename)
+    metrics['updates'] += 1
+    metrics['last_update_seconds'] = time.time() - start_time
+    logger.info("itimes properly updated. %d edges recomputed in %.3f seconds.",
+                metrics['last_update_edges'], metrics['last_update_seconds'])
+    prerender_traffic(snapshot)
+    return True
+
+
+def snapshot_age():
+    """Return the seconds since the congestions of the snapshot were
+    downloaded."""
+
+    return time.time() - snapshot.time
+
+
+def publish_current():
+    """Publish the current snapshot for the bot processes of the webhook
+    mode, with its congestion map of the whole city. The map is drawn once
+    here and stored next to the itimes, so the bot processes only read it."""
+
+    traffic_filename = os.path.splitext(snapshot.weights_filename)[0] + '.' + IMAGE_FORMAT.lower()
+    try:
+        picture_bytes = workers.render_traffic(edge_table, snapshot.congestions, SIZE, None, None,
+                                               IMAGE_FORMAT, **IMAGE_OPTIONS)
+        temporary = traffic_filename + '.tmp'
+        with open(temporary, 'wb') as file:
+            file.write(picture_bytes)
+        os.replace(temporary, traffic_filename)
+    except Exception as e:
+        # The bot processes draw it themselves
+        logger.error("Congestion map could not be drawn: %r", e)
+        traffic_filename = None
+    webhook.publish_snapshot(PUBLISHED_SNAPSHOT_FILENAME, snapshot.time, snapshot.weights_filename,
+                             snapshot.congestions, traffic_filename)
+
+
+def load_published(node_index, published):
+    """Replace the snapshot with one published by the leader process. Its
+    itimes are mapped from the file written by the leader, so all the
+    processes share them, and its congestion map is the one drawn by the
+    leader."""
+
+    global snapshot
+    router = base_router._replace(weights=np.load(published['weights_filename'], mmap_mode='r'))
+    if topology is not None:
+        router = igo.customize_router(router, topology)
+    congestions = [tuple(congestion) for congestion in published['congestions']]
+    current = Snapshot(router, node_index, congestions, published['time'], published['weights_filename'])
+    if published.get('traffic_filename') is None:
+        prerender_traffic(current)
+    else:
+        with open(published['traffic_filename'], 'rb') as file:
+            traffic_cache.put(None, current.time, file.read())
+    snapshot = current
+
+
+def updater_loop(publish=False):
+    """Update the snapshot every UPDATE_MINUTES forever, publishing every new
+    one if publish is True. It runs in its own thread so that no request has
+    to wait for an update."""
+
+    while True:
+        time.sleep(60 * UPDATE_MINUTES)
+        try:
+            if update_snapshot() and publish:
+                publish_current()
+        except Exception as e:
+            # Keep routing with the old snapshot until the next update
+            metrics['update_errors'] += 1
+            logger.error("Congestions update failed: %r", e)
+
 
 def start(update, context):
     """Welcome the user and provide a link to /help command."""
@@ -45,8 +386,10 @@ def help(update, context):
               \n%s /author : Information about who has implemented the bot
               \n%s /where : User's current location
               \n%s /pos : Fix a fake location. Indicate the place name or its coordinates.
-              \n%s /go : Picture with the best route from user's location to the chosen destination. Indicate the name of the destination.
-              """ % (emo, emo, emo, emo, emo, emo)
+              \n%s /go : Picture with the best route from user's location to the chosen destination. Indicate the name of the destination, or several names separated by ; to compare them.
+              \n%s /reach : Picture with the streets that can be reached from user's location. Indicate the minutes.
+              \n%s /traffic : Picture with the current traffic of Barcelona. Use /traffic here for the streets around user's location.
+              """ % (emo, emo, emo, emo, emo, emo, emo, emo)
     context.bot.send_message(chat_id=update.effective_chat.id, text=message)
 
 
@@ -64,89 +407,333 @@ def coordinates(update, context):
     users[update.effective_chat.id] = [update.message.location.latitude, update.message.location.longitude]
 
 
+def render_position(lat, lon):
+    """Render a map with a position marked and return the encoded image."""
+
+    # Creates the map
+    map = tiles.static_map(840, 840)
+    # Mark user's location
+    map.add_marker(CircleMarker((lon, lat), 'red', 14))
+    picture = map.render()
+    return igo.image_bytes(picture, IMAGE_FORMAT, **IMAGE_OPTIONS)
+
+
+def geocode(place):
+    """Return the position of a place, sharing the search with identical
+    requests that are running."""
+
+    return flights.do(('geocode', igo.normalize_place(place)), geocoder.geocode, place)
+
+
+def route(current, orig, dest):
+    """Return the route between two nodes with the itimes of the snapshot
+    current. Routes are cached, and identical requests that arrive while it
+    is computed wait for it."""
+
+    ipath = route_cache.get((orig, dest), current.time)
+    if ipath is None:
+        ipath = flights.do(('route', current.time, orig, dest), compute_route, current, orig, dest)
+    return ipath
+
+
+def compute_route(current, orig, dest):
+    """Compute the route between two nodes and cache it."""
+
+    ipath = pool.route(current.router, current.weights_filename, orig, dest)
+    route_cache.put((orig, dest), current.time, ipath)
+    return ipath
+
+
+def route_picture(current, ipath):
+    """Return the encoded map of a route. Maps are cached, and identical
+    requests that arrive while it is drawn wait for it."""
+
+    # The same route always gives the same map
+    key = (ipath[0], ipath[-1])
+    picture_bytes = map_cache.get(key, current.time)
+    if picture_bytes is None:
+        picture_bytes = flights.do(('map', current.time) + key, render_route, current, ipath)
+    return picture_bytes
+
+
+def render_route(current, ipath):
+    """Draw the map of a route and cache it."""
+
+    picture_bytes = pool.render(workers.render_path, graph_map, ipath, SIZE, IMAGE_FORMAT, **IMAGE_OPTIONS)
+    map_cache.put((ipath[0], ipath[-1]), current.time, picture_bytes)
+    return picture_bytes
+
+
+def traffic_picture(current, key):
+    """Return the encoded congestion map of the snapshot current, the whole
+    city if key is None and otherwise the tile (zoom, x, y) in its center.
+    Maps are cached, and identical requests that arrive while it is drawn
+    wait for it."""
+
+    picture_bytes = traffic_cache.get(key, current.time)
+    if picture_bytes is None:
+        picture_bytes = flights.do(('traffic', current.time, key), render_traffic_map, current, key)
+    return picture_bytes
+
+
+def render_traffic_map(current, key):
+    """Draw a congestion map and cache it."""
+
+    center = zoom = None
+    if key is not None:
+        zoom, x, y = key
+        center = (tiles.tile_to_lon(x + 0.5, zoom), tiles.tile_to_lat(y + 0.5, zoom))
+    picture_bytes = pool.render(workers.render_traffic, edge_table, current.congestions, SIZE, center, zoom,
+                                IMAGE_FORMAT, **IMAGE_OPTIONS)
+    traffic_cache.put(key, current.time, picture_bytes)
+    return picture_bytes
+
+
+def prerender_traffic(current):
+    """Draw the congestion map of the whole city for the snapshot current in
+    the background, so that /traffic is answered at once. Processes that do
+    not answer the users do not draw it."""
+
+    if pool is None:
+        return
+
+    def prerender():
+        try:
+            traffic_picture(current, None)
+        except Exception as e:
+            logger.error("Congestion map could not be drawn: %r", e)
+
+    threading.Thread(target=prerender, daemon=True).start()
+
+
+def in_order(update, context, handler):
+    """Answer the update with handler in the threads of the dispatcher,
+    after the earlier requests of the same chat, so that a /pos is always
+    applied before the /go that follows it. Requests of different chats are
+    answered at once."""
+
+    chat_id = update.effective_chat.id
+    with chat_lock:
+        if chat_id in chat_requests:
+            chat_requests[chat_id].append((update, context, handler))
+            return
+        chat_requests[chat_id] = collections.deque()
+    context.dispatcher.run_async(answer_chat, chat_id, update, context, handler, update=update)
+
+
+def answer_chat(chat_id, update, context, handler):
+    """Answer a request of a chat and then the ones that arrived meanwhile,
+    in order."""
+
+    while True:
+        try:
+            handler(update, context)
+        except Exception as e:
+            # The next requests of the chat are still answered
+            logger.error("Request of chat %d failed: %r", chat_id, e)
+        with chat_lock:
+            if not chat_requests[chat_id]:
+                del chat_requests[chat_id]
+                return
+            update, context, handler = chat_requests[chat_id].popleft()
+
+
+def ordered(handler):
+    """Return a callback that answers with handler after the earlier
+    requests of the same chat."""
+
+    def order(update, context):
+        in_order(update, context, handler)
+
+    return order
+
+
+def admitted(handler):
+    """Return a callback that answers with handler in the threads of the
+    dispatcher, after the earlier requests of the same chat, if less than
+    MAX_PENDING_REQUESTS requests are being answered or waiting, and
+    otherwise asks the user to retry, so that the waiting time stays bounded
+    under load."""
+
+    def answer(update, context):
+        try:
+            handler(update, context)
+        finally:
+            pending_requests.release()
+
+    def admit(update, context):
+        if not pending_requests.acquire(blocking=False):
+            stats.increment('igo_rejected_requests_total', (('command', handler.__name__),))
+            context.bot.send_message(chat_id=update.effective_chat.id, text=BUSY_MESSAGE)
+            return
+        in_order(update, context, answer)
+
+    return admit
+
+
+def reply_error(update, context, trace, error):
+    """Log a failed request and tell the user what went wrong according to
+    the stage where it failed."""
+
+    logger.error("/%s failed at stage %s: %r", trace.command, trace.stage, error)
+    if trace.stage == 'send':
+        # Telegram cannot be reached, so the user cannot be told either
+        return
+    message = ERROR_MESSAGES.get(trace.stage, ERROR_MESSAGES[None])
+    if isinstance(error, nx.NetworkXNoPath):
+        message = "ERROR. There is no route by car to the destination."
+    context.bot.send_message(chat_id=update.effective_chat.id, text=message)
+
+
 def where(update, context):
     """Plot a map with the current user location."""
 
+    trace = stats.request('where')
     try:
-        file = "%d.png" % random.randint(1000000, 9999999)
-        # Creates the map
-        map = StaticMap(840, 840)
-        # Get latitude and longitude from the user
-        lat = users[update.effective_chat.id][0]
-        lon = users[update.effective_chat.id][1]
-        # Mark user's location
-        map.add_marker(CircleMarker((lon, lat), 'red', 14))
-        picture = map.render()
-        picture.save(file)
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(file, 'rb'))
-        os.remove(file)
+        with trace:
+            with trace.span('position'):
+                # Get latitude and longitude from the user
+                lat, lon = users[update.effective_chat.id]
+            with trace.span('render'):
+                picture_bytes = pool.render(render_position, lat, lon)
+            with trace.span('send'):
+                context.bot.send_photo(
+                    chat_id=update.effective_chat.id,
+                    photo=io.BytesIO(picture_bytes))
     except Exception as e:
-        print(e)
-        context.bot.send_message(
-          chat_id=update.effective_chat.id,
-          text="ERROR. Ensure you share your location or use /pos to fix a position.")
+        reply_error(update, context, trace, e)
 
 
 def go(update, context):
     """Plot a map with the shortest path according to the itime concept from
     user's position to the chosen destination point."""
 
-    global init_time, graph, highways, igraph, congestions
-    # If the graph has not been created yet
-    if graph is None:
-        print("Starting the creation of the graph.")
-        graph = igo.download_graph(PLACE)
-        print("Graph created properly. Starting highways download.")
-        highways = igo.download_highways(HIGHWAYS_URL)
-        print("Highways downloaded properly. Starting congestions download.")
-        # Set the time when congestions are downloaded
-        init_time = time.time()
-        print("Init time set to: ", init_time)
-        congestions = igo.download_congestions(CONGESTIONS_URL)
-        print("Congestions downloaded properly. Starting igraph creation.")
-        igraph = igo.build_igraph(graph, highways, congestions)
-        print("igraph properly created.")
-    else:
-        # Get the current time
-        current_time = time.time()
-        print("The current time is: ", current_time)
-        # If the difference between the last congestions update time and
-        # the current time is greater than 15, update the congestions
-        time_delta = current_time - init_time
-        time_delta = time_delta/60
-        print("It have been ", time_delta, " minutes since the last update.")
-        if time_delta >= 15:
-            congestions = igo.download_congestions(CONGESTIONS_URL)
-            print("Congestions downloaded properly. Starting igraph creation.")
-            igraph = igo.build_igraph(graph, highways, congestions)
-            print("igraph properly created.")
-        else:
-            print("Congestions are on date. ", time_delta, " have passed.")
-
+    # Use the same snapshot for the whole request
+    current = snapshot
     # Read the destination
     destination = update.message.text[4:]
+    if ';' in destination:
+        go_many(update, context, current, destination.split(';'))
+        return
+    trace = stats.request('go')
     try:
-        # If latitud and longitud are set
-        lat, lon = users[update.effective_chat.id]
-        print("Searching the shortest path.")
-        # Find shortest path and plot it
-        ipath = igo.get_shortest_path_with_itimes(igraph, lat, lon, destination)
-        print("Shortest path found. Ploting it.")
-        picture = igo.plot_path(igraph, ipath, SIZE)
-        file = "%d.png" % random.randint(1000000, 9999999)
-        picture.save(file)
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(file, 'rb'))
-        os.remove(file)
+        with trace:
+            with trace.span('position'):
+                lat, lon = users[update.effective_chat.id]
+            with trace.span('geocode'):
+                dest_lat, dest_lon = geocode(destination)
+            with trace.span('snap'):
+                orig, dest = igo.nearest_nodes(current.node_index, [lon, dest_lon], [lat, dest_lat]).tolist()
+            with trace.span('route'):
+                ipath = route(current, orig, dest)
+            with trace.span('render'):
+                picture_bytes = route_picture(current, ipath)
+            with trace.span('send'):
+                context.bot.send_photo(
+                    chat_id=update.effective_chat.id,
+                    photo=io.BytesIO(picture_bytes))
     except Exception as e:
-        # If neither latitud or longitud are set
-        print(e)
+        reply_error(update, context, trace, e)
+
+
+def go_many(update, context, current, destinations):
+    """Plot a map with the shortest paths from user's position to several
+    destinations, found with a single search, and send their itimes."""
+
+    destinations = [destination.strip() for destination in destinations if destination.strip()]
+    destinations = destinations[:MAX_DESTINATIONS]
+    trace = stats.request('go_many')
+    try:
+        with trace:
+            with trace.span('position'):
+                lat, lon = users[update.effective_chat.id]
+            with trace.span('geocode'):
+                positions = [geocode(destination) for destination in destinations]
+            with trace.span('snap'):
+                X = [lon] + [dest_lon for _, dest_lon in positions]
+                Y = [lat] + [dest_lat for dest_lat, _ in positions]
+                nodes = igo.nearest_nodes(current.node_index, X, Y).tolist()
+            with trace.span('route'):
+                routes = pool.route_many(current.router, current.weights_filename, nodes[0], nodes[1:])
+            ipaths = [route for _, route in filter(None, routes)]
+            # Describe every destination with the color of its path
+            lines = []
+            color = 0
+            for destination, route in zip(destinations, routes):
+                if route is None:
+                    lines.append("%s: unreachable" % destination)
+                else:
+                    lines.append("%s (%s): %.1f min" % (destination, igo.PATH_COLORS[color % len(igo.PATH_COLORS)], route[0] / 60))
+                    color += 1
+            picture_bytes = None
+            if ipaths:
+                with trace.span('render'):
+                    picture_bytes = pool.render(workers.render_paths, graph_map, ipaths, SIZE, IMAGE_FORMAT, **IMAGE_OPTIONS)
+            with trace.span('send'):
+                if picture_bytes is not None:
+                    context.bot.send_photo(
+                        chat_id=update.effective_chat.id,
+                        photo=io.BytesIO(picture_bytes))
+                context.bot.send_message(chat_id=update.effective_chat.id, text="\n".join(lines))
+    except Exception as e:
+        reply_error(update, context, trace, e)
+
+
+def reach(update, context):
+    """Plot a map with the streets that can be reached from user's position
+    in the given minutes according to the itime concept."""
+
+    current = snapshot
+    try:
+        minutes = float(update.message.text[7:])
+    except ValueError:
         context.bot.send_message(
           chat_id=update.effective_chat.id,
-          text="ERROR. Ensure you share your location or use /pos to fix a position.")
+          text="ERROR. Indicate the minutes, for instance /reach 10.")
+        return
+    minutes = min(max(minutes, 1), MAX_REACH_MINUTES)
+    trace = stats.request('reach')
+    try:
+        with trace:
+            with trace.span('position'):
+                lat, lon = users[update.effective_chat.id]
+            with trace.span('snap'):
+                orig = int(igo.nearest_nodes(current.node_index, lon, lat))
+            with trace.span('route'):
+                itimes = pool.isochrone(current.router, current.weights_filename, orig, 60 * minutes)
+            with trace.span('render'):
+                picture_bytes = pool.render(workers.render_isochrone, graph_map, itimes, 60 * minutes, SIZE, IMAGE_FORMAT, **IMAGE_OPTIONS)
+            with trace.span('send'):
+                context.bot.send_photo(
+                    chat_id=update.effective_chat.id,
+                    photo=io.BytesIO(picture_bytes))
+    except Exception as e:
+        reply_error(update, context, trace, e)
+
+
+def traffic(update, context):
+    """Plot a map with the current congestion of the streets, of the whole
+    city or, with /traffic here, around user's position."""
+
+    current = snapshot
+    here = update.message.text[9:].strip().lower() == 'here'
+    trace = stats.request('traffic')
+    try:
+        with trace:
+            key = None
+            if here:
+                with trace.span('position'):
+                    lat, lon = users[update.effective_chat.id]
+                    key = (TRAFFIC_ZOOM, int(tiles.lon_to_tile(lon, TRAFFIC_ZOOM)),
+                           int(tiles.lat_to_tile(lat, TRAFFIC_ZOOM)))
+            with trace.span('render'):
+                picture_bytes = traffic_picture(current, key)
+            with trace.span('send'):
+                context.bot.send_photo(
+                    chat_id=update.effective_chat.id,
+                    photo=io.BytesIO(picture_bytes))
+    except Exception as e:
+        reply_error(update, context, trace, e)
 
 
 def pos(update, context):
@@ -154,37 +741,155 @@ def pos(update, context):
     be set with coordinates or with its name. """
 
     location = update.message.text[4:]
+    trace = stats.request('pos')
     try:
-        # If location's coordinates are given
-        cc = []
-        # Separate them
-        for coordinate in location.split():
-            l.append(float(coordinate))
-        lat_pos, lon_pos = cc[0], cc[1]
-    except:
-        # If location's name is given
-        location = location + ",Barcelona,Catalonia"
-        lat_pos, lon_pos = ox.geocode(location)
-    users[update.effective_chat.id] = [lat_pos, lon_pos]
-
-
-# Access token from token.txt.
-TOKEN = open('token.txt').read().strip()
-
-
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
-
-
-# Indicates the relationship between the Telegram commands
-# and the functions of bot.py
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(CommandHandler('help', help))
-dispatcher.add_handler(CommandHandler('where', where))
-dispatcher.add_handler(CommandHandler('go', go))
-dispatcher.add_handler(CommandHandler('pos', pos))
-dispatcher.add_handler(MessageHandler(Filters.location, coordinates))
-
-# Start the bot.
-updater.start_polling()
+        with trace:
+            try:
+                # If location's coordinates are given
+                cc = []
+                # Separate them
+                for coordinate in location.split():
+                    cc.append(float(coordinate))
+                lat_pos, lon_pos = cc[0], cc[1]
+            except (ValueError, IndexError):
+                # If location's name is given
+                with trace.span('geocode'):
+                    lat_pos, lon_pos = geocode(location)
+            users[update.effective_chat.id] = [lat_pos, lon_pos]
+    except Exception as e:
+        reply_error(update, context, trace, e)
+
+
+def add_handlers(dispatcher):
+    """Indicate the relationship between the Telegram commands and the
+    functions of bot.py."""
+
+    # /start forgets the position, so it is ordered with the requests that use it
+    dispatcher.add_handler(CommandHandler('start', ordered(start)))
+    dispatcher.add_handler(CommandHandler('author', author))
+    dispatcher.add_handler(CommandHandler('help', help))
+    # The slow commands run in the threads of the dispatcher so that they do not
+    # delay the rest of updates, as long as there are not too many waiting.
+    # The requests of a chat are still answered in order.
+    dispatcher.add_handler(CommandHandler('where', admitted(where)))
+    dispatcher.add_handler(CommandHandler('go', admitted(go)))
+    dispatcher.add_handler(CommandHandler('reach', admitted(reach)))
+    dispatcher.add_handler(CommandHandler('traffic', admitted(traffic)))
+    dispatcher.add_handler(CommandHandler('pos', admitted(pos)))
+    # Shared locations are applied in order with /pos and the requests that
+    # use them
+    dispatcher.add_handler(MessageHandler(Filters.location, ordered(coordinates)))
+
+
+def register_gauges():
+    """Expose the metrics of the updates, the snapshots and the tiles."""
+
+    stats.gauge('igo_congestion_snapshot_age_seconds', snapshot_age, "Seconds since the congestions were downloaded.")
+    stats.gauge('igo_live_congestions_age_seconds', lambda: time.time() - live_time,
+                "Seconds since the live congestions last changed.")
+    stats.gauge('igo_graph_snapshot_age_seconds', lambda: time.time() - os.path.getmtime(GRAPH_SNAPSHOT_DIRNAME),
+                "Seconds since the graph snapshot was built.")
+    stats.gauge('igo_route_cache_hit_rate', route_cache.hit_rate)
+    stats.gauge('igo_map_cache_hit_rate', map_cache.hit_rate)
+    stats.gauge('igo_traffic_cache_hit_rate', traffic_cache.hit_rate)
+    stats.gauge('igo_shared_requests', lambda: flights.shared, "Geocodes, routes and maps shared with an identical request.")
+    for name in metrics:
+        stats.gauge('igo_congestion_' + name, lambda name=name: metrics[name])
+    # Processes that draw no maps have no tile cache
+    if tiles.tile_cache is not None:
+        for name in tiles.tile_cache.counts:
+            stats.gauge('igo_tiles_' + name, lambda name=name: tiles.tile_cache.counts[name])
+
+
+def telegram_bot(TOKEN):
+    """Return the Telegram bot of the token, using TELEGRAM_API_URL if it is
+    set."""
+
+    # Every thread of the dispatcher may be sending at once, as with Updater
+    request = Request(con_pool_size=DISPATCHER_WORKERS + 4)
+    return Bot(TOKEN, base_url=TELEGRAM_API_URL + '/bot' if TELEGRAM_API_URL else None, request=request)
+
+
+def run_polling(TOKEN):
+    """Run the bot in a single process that asks Telegram for the updates."""
+
+    updater = Updater(token=TOKEN, use_context=True, workers=DISPATCHER_WORKERS,
+                      base_url=TELEGRAM_API_URL + '/bot' if TELEGRAM_API_URL else None)
+    add_handlers(updater.dispatcher)
+    # Build the first snapshot and keep it updated in the background.
+    load_data()
+    threading.Thread(target=updater_loop, daemon=True).start()
+    register_gauges()
+    if METRICS_PORT is not None:
+        stats.serve(METRICS_PORT)
+    # Start the bot.
+    updater.start_polling()
+
+
+def webhook_worker(number, updates, TOKEN):
+    """Answer the updates that the leader process puts in the queue updates.
+    Every bot process of the webhook mode runs it. The graph snapshot, the
+    itimes, the topology of the hierarchy and the base map are mapped from
+    the files written by the leader, so they are shared with the other
+    processes, and the positions of the users are kept in a shared store."""
+
+    global users
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    users = webhook.PositionStore(USERS_FILENAME)
+    node_index = load_graph()
+    # The bot processes route in their own threads
+    load_services(0)
+    webhook.follow_snapshots(PUBLISHED_SNAPSHOT_FILENAME, lambda published: load_published(node_index, published))
+    register_gauges()
+    if METRICS_PORT is not None:
+        stats.serve(METRICS_PORT + 1 + number)
+    bot = telegram_bot(TOKEN)
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=DISPATCHER_WORKERS)
+    add_handlers(dispatcher)
+    threading.Thread(target=dispatcher.start, daemon=True).start()
+    while True:
+        dispatcher.update_queue.put(Update.de_json(json.loads(updates.get()), bot))
+
+
+def run_webhook(TOKEN):
+    """Run the bot with WEBHOOK_PROCESSES processes that answer the updates
+    sent by Telegram to a webhook. This process is the leader: it builds and
+    publishes the snapshots, and passes every update to the process of its
+    chat."""
+
+    # The first snapshot, the hierarchy and the base map are saved before the
+    # bot processes start, so that they only have to map them
+    global snapshot
+    node_index = load_graph()
+    if HIERARCHY:
+        load_topology()
+    # The leader draws the congestion map of every snapshot
+    tile_cache = tiles.TileCache(TILES_DIRNAME, TILES_MAX_BYTES, OFFLINE_TILES)
+    tiles.configure(tile_cache, load_base_map(tile_cache))
+    snapshot = first_snapshot(node_index)
+    publish_current()
+    threading.Thread(target=updater_loop, args=(True,), daemon=True).start()
+    register_gauges()
+    if METRICS_PORT is not None:
+        stats.serve(METRICS_PORT)
+    # Spawn the processes, as forking a process with threads is unsafe
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(WEBHOOK_PROCESSES)]
+    for number, updates in enumerate(queues):
+        context.Process(target=webhook_worker, args=(number, updates, TOKEN), daemon=True).start()
+    server = webhook.UpdateServer((WEBHOOK_LISTEN, WEBHOOK_PORT), '/' + TOKEN, queues)
+    if WEBHOOK_URL is not None:
+        telegram_bot(TOKEN).set_webhook(WEBHOOK_URL + '/' + TOKEN)
+    logger.info("Listening to the webhook on port %d.", WEBHOOK_PORT)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    # Usage: python bot.py [webhook]
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    # Access token from token.txt.
+    TOKEN = open('token.txt').read().strip()
+    if len(sys.argv) > 1 and sys.argv[1] == 'webhook':
+        run_webhook(TOKEN)
+    else:
+        run_polling(TOKEN)
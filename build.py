@@ -0,0 +1,442 @@
+import os
+import urllib.request
+from array import array
+import osmium
+import osmnx as ox
+import numpy as np
+import networkx as nx
+from staticmap import CircleMarker, Line
+import igo
+import tiles
+
+# Build-time tooling of iGo: downloading the graph of Barcelona, building the
+# graph snapshot read by the bot and plotting the open data. The bot only
+# imports it when the snapshot does not exist yet, so that osmnx is not
+# loaded to answer requests.
+
+# Ways that cars cannot use, with the same rules as the drive network of osmnx
+EXCLUDED_HIGHWAYS = {'abandoned', 'bridleway', 'bus_guideway', 'construction', 'corridor', 'cycleway',
+                     'elevator', 'escalator', 'footway', 'path', 'pedestrian', 'planned', 'platform',
+                     'proposed', 'raceway', 'service', 'steps', 'track'}
+EXCLUDED_SERVICES = {'alley', 'driveway', 'emergency_access', 'parking', 'parking_aisle', 'private'}
+# Values of the oneway tag of the ways that can only be used in one
+# direction, and those where it is the opposite of the order of the nodes
+ONEWAY_VALUES = {'yes', 'true', '1', '-1', 'reverse', 'T', 'F'}
+REVERSED_VALUES = {'-1', 'reverse', 'T'}
+# Tags of the ways kept in their edges
+WAY_TAGS = ['highway', 'name', 'maxspeed', 'lanes', 'ref', 'junction']
+EARTH_RADIUS = 6371009  # In meters, as osmnx
+# Tags of the points of interest whose names are added to the gazetteer,
+# with the values kept (True for all of them), as the tags of osmnx
+POI_TAGS = {'amenity': True, 'tourism': True, 'shop': True, 'leisure': ['stadium', 'park'],
+            'railway': ['station'], 'public_transport': ['station']}
+
+
+def download_graph(PLACE):
+    """ Given a place, creates a graph of the site.
+
+    Parameters:
+    ----------
+    PLACE: Name of the city and the comunity the graph of which is wanted.
+
+    Returns:
+    ----------
+    graph: The graph of the given location
+    """
+
+    graph = ox.graph_from_place(PLACE, network_type='drive', simplify=True)
+    graph = ox.utils_graph.get_digraph(graph, weight='length')
+    return graph
+
+
+def plot_graph(PLACE):
+    """Given a place, plots a map of the site.
+
+    Parameters:
+    ----------
+    PLACE: The name of the place from wich we want to get the map.
+
+    Returns:
+    ----------
+    Osmnx function that shows the map of the indicated place.
+    """
+
+    return ox.plot_graph(ox.graph_from_place(PLACE, network_type='drive', simplify=True))
+
+
+def plot_highways(highways, name, SIZE):
+    """Given a dictionary that stores the coordinates of the points that
+    form each way, a file name and a size, stores a map of that size in a
+    file with the indicated name.
+
+    Parameters:
+    ----------
+    highways: Dictionary with the identification number of each way as keys
+    and the coordinates of the points that forms it as values.
+    name: The name of the file where the map is going to be stored.
+    SIZE: The size that the map is going to have.
+
+    Returns:
+    ----------
+    Nothing. Plots a map on a given file.
+    """
+
+    mapa_bcn = tiles.static_map(600, 600)
+    # For every way in highways
+    for way in highways:
+        row = highways[way]
+        for i in range(0, len(row), 2):
+            if (i == 0):
+                marker = CircleMarker((row[i], row[i+1]), 'yellow', 3)
+                mapa_bcn.add_marker(marker)
+            elif (i == len(row) - 2):
+                marker = CircleMarker((row[i], row[i+1]), 'blue', 3)
+                mapa_bcn.add_marker(marker)
+            if (i < len(row) - 3):
+                coordinates = [[row[i], row[i+1]], [row[i+2], row[i+3]]]
+                line_outline = Line(coordinates, 'red', 2)
+                line = Line(coordinates, 'black', 3)
+                mapa_bcn.add_line(line_outline)
+                mapa_bcn.add_line(line)
+    image = mapa_bcn.render()
+    image.save(name)
+
+
+def plot_congestions(highways, congestions, name, SIZE):
+    """Given a dictionary and a list with information about ways' congestions
+    and points, plots a map of the city showing congestions information using
+    colors. It loads the map of size SIZExSIZE in the specified file.
+
+    Parameters:
+    ----------
+    highways: Dictionary with the identification numbers of each way as keys
+    and the coordinates of the points that form it as values.
+    congestions: List with the way id number and its current congestion.
+    name: The name of the file where the map is going to be stored.
+    SIZE: The size that tha map is going to have.
+
+    Returns:
+    ----------
+    Nothing. Only plots the map in the given file.
+    """
+
+    mapa_bcn = tiles.static_map(600, 600)
+    for tram in congestions:
+        density = tram[1]
+        color = {0: 'white', 1: 'green', 2: 'yellow', 3: 'purple', 4: 'orange', 5: 'red', 6: 'black'}
+        row = highways[tram[0]]
+        for i in range(0, len(row)-3, 2):
+            coordinates = [[row[i], row[i+1]], [row[i+2], row[i+3]]]
+            line = Line(coordinates, color[density], 3)
+            mapa_bcn.add_line(line)
+    image = mapa_bcn.render()
+    image.save(name)
+
+
+def in_bbox(bbox, x, y):
+    """Given a (west, south, east, north) box or None for the whole world,
+    returns True if the point is inside it."""
+
+    if bbox is None:
+        return True
+    west, south, east, north = bbox
+    return west <= x <= east and south <= y <= north
+
+
+def drivable(tags):
+    """Given the tags of a way, returns True if cars can use it."""
+
+    highway = tags.get('highway')
+    if highway is None or highway in EXCLUDED_HIGHWAYS:
+        return False
+    if tags.get('area') == 'yes' or 'private' in tags.get('access', ''):
+        return False
+    if tags.get('motor_vehicle') == 'no' or tags.get('motorcar') == 'no':
+        return False
+    return tags.get('service') not in EXCLUDED_SERVICES
+
+
+class DrivableWays(osmium.SimpleHandler):
+    """Reads the drivable ways of an OSM extract with the positions of their
+    nodes. The nodes of all the ways are kept in flat arrays, so memory only
+    grows with the drivable ways and not with the size of the extract.
+
+    Parameters:
+    ----------
+    bbox: (west, south, east, north) of the area of the graph. Ways are cut
+    where they leave it. If it is None, the whole extract is read.
+    """
+
+    def __init__(self, bbox=None):
+        super().__init__()
+        self.bbox = bbox
+        self.node_ids = array('q')
+        self.x = array('d')
+        self.y = array('d')
+        # The nodes of way i are from offsets[i] to offsets[i+1]
+        self.offsets = [0]
+        self.way_ids = []
+        self.tags = []
+
+    def way(self, way):
+        if 'highway' not in way.tags:
+            return
+        tags = {tag.k: tag.v for tag in way.tags}
+        if not drivable(tags):
+            return
+        tags = {key: tags[key] for key in WAY_TAGS + ['oneway'] if key in tags}
+        for node in way.nodes:
+            location = node.location
+            if location.valid() and self.inside(location.lon, location.lat):
+                self.node_ids.append(node.ref)
+                self.x.append(location.lon)
+                self.y.append(location.lat)
+            else:
+                # The way leaves the extract or the area
+                self.end_way(way.id, tags)
+        self.end_way(way.id, tags)
+
+    def inside(self, x, y):
+        return in_bbox(self.bbox, x, y)
+
+    def end_way(self, way_id, tags):
+        if len(self.node_ids) - self.offsets[-1] < 2:
+            # A single node is not a street
+            del self.node_ids[self.offsets[-1]:]
+            del self.x[self.offsets[-1]:]
+            del self.y[self.offsets[-1]:]
+            return
+        self.offsets.append(len(self.node_ids))
+        self.way_ids.append(way_id)
+        self.tags.append(tags)
+
+
+def interesting(tags):
+    """Given the tags of an OSM object, returns True if it is a named point
+    of interest of POI_TAGS."""
+
+    if 'name' not in tags:
+        return False
+    for key, values in POI_TAGS.items():
+        value = tags.get(key)
+        if value is not None and (values is True or value in values):
+            return True
+    return False
+
+
+class PointsOfInterest(osmium.SimpleHandler):
+    """Reads the named points of interest of an OSM extract, such as
+    landmarks, hospitals or stations. Nodes are placed at their position and
+    ways (buildings and areas) at the mean of their nodes.
+
+    Parameters:
+    ----------
+    bbox: (west, south, east, north) of the area of the places, or None to
+    read the whole extract.
+    """
+
+    def __init__(self, bbox=None):
+        super().__init__()
+        self.bbox = bbox
+        # Names of the places and their (latitude, longitude)
+        self.places = {}
+
+    def node(self, node):
+        if interesting(node.tags) and node.location.valid():
+            self.add(node.tags['name'], node.location.lon, node.location.lat)
+
+    def way(self, way):
+        if not interesting(way.tags):
+            return
+        locations = [node.location for node in way.nodes if node.location.valid()]
+        if locations:
+            self.add(way.tags['name'], sum(location.lon for location in locations) / len(locations),
+                     sum(location.lat for location in locations) / len(locations))
+
+    def add(self, name, x, y):
+        # The first place with a name wins, as in the gazetteer
+        if in_bbox(self.bbox, x, y):
+            self.places.setdefault(name, (y, x))
+
+
+def pois_from_pbf(PBF_FILENAME, bbox=None, INDEX_FILENAME=None):
+    """Given a local OSM extract, finds its named points of interest
+    without contacting any server.
+
+    Parameters:
+    ----------
+    PBF_FILENAME: Name of the .osm.pbf file of the extract.
+    bbox: (west, south, east, north) of the area of the places, or None to
+    use the whole extract.
+    INDEX_FILENAME: Name of a file where the positions of the nodes are kept
+    while reading, as in graph_from_pbf.
+
+    Returns:
+    ----------
+    places: Dictionary with the names of the places as keys and their
+    (latitude, longitude) as values.
+    """
+
+    pois = PointsOfInterest(bbox)
+    index = 'flex_mem' if INDEX_FILENAME is None else 'sparse_file_array,' + INDEX_FILENAME
+    pois.apply_file(PBF_FILENAME, locations=True, idx=index)
+    return pois.places
+
+
+def download_pois(PLACE):
+    """Given a place, downloads its named points of interest.
+
+    Parameters:
+    ----------
+    PLACE: Name of the city and the comunity of the places.
+
+    Returns:
+    ----------
+    places: Dictionary with the names of the places as keys and their
+    (latitude, longitude) as values.
+    """
+
+    features = ox.geometries_from_place(PLACE, POI_TAGS)
+    places = {}
+    if 'name' not in features:
+        return places
+    for name, geometry in zip(features['name'], features['geometry']):
+        if isinstance(name, str) and name:
+            # Areas are placed at their center
+            point = geometry.centroid
+            places.setdefault(name, (point.y, point.x))
+    return places
+
+
+def great_circle(x1, y1, x2, y2):
+    """Given arrays with the longitudes and latitudes of pairs of points,
+    returns the distances in meters between them."""
+
+    x1, y1, x2, y2 = map(np.radians, (x1, y1, x2, y2))
+    h = np.sin((y2 - y1) / 2)**2 + np.cos(y1) * np.cos(y2) * np.sin((x2 - x1) / 2)**2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(h, 1)))
+
+
+def graph_from_pbf(PBF_FILENAME, bbox=None, INDEX_FILENAME=None):
+    """Given a local OSM extract, creates the graph of its drivable streets
+    without contacting any server. As download_graph, nodes only remain
+    where streets meet or end, with the intermediate points in the geometry
+    of the edges, and only the largest connected part is kept.
+
+    Parameters:
+    ----------
+    PBF_FILENAME: Name of the .osm.pbf file of the extract, which may be
+    larger than the city, such as the one of a metropolitan area.
+    bbox: (west, south, east, north) of the area of the graph, or None to
+    use the whole extract.
+    INDEX_FILENAME: Name of a file where the positions of all the nodes are
+    kept while reading, so that large extracts do not need to fit in memory.
+    If it is None they are kept in memory.
+
+    Returns:
+    ----------
+    graph: Networkx digraph, with the x and y of every node and the osmid,
+    length, maxspeed and the rest of tags of the way of every edge.
+    """
+
+    ways = DrivableWays(bbox)
+    index = 'flex_mem' if INDEX_FILENAME is None else 'sparse_file_array,' + INDEX_FILENAME
+    ways.apply_file(PBF_FILENAME, locations=True, idx=index)
+    node_ids = np.frombuffer(ways.node_ids, dtype=np.int64)
+    x = np.frombuffer(ways.x, dtype=np.float64)
+    y = np.frombuffer(ways.y, dtype=np.float64)
+    offsets = np.array(ways.offsets, dtype=np.int64)
+    # Streets meet at the nodes used more than once and end at the first and
+    # last nodes of the ways
+    _, inverse, counts = np.unique(node_ids, return_inverse=True, return_counts=True)
+    endpoint = counts[inverse] > 1
+    endpoint[offsets[:-1]] = True
+    endpoint[offsets[1:] - 1] = True
+    # Distance from the start of the arrays, to measure the edges
+    distance = np.zeros(len(node_ids))
+    distance[1:] = np.cumsum(great_circle(x[:-1], y[:-1], x[1:], y[1:]))
+    graph = nx.DiGraph(crs='epsg:4326')
+    for i, (way_id, tags) in enumerate(zip(ways.way_ids, ways.tags)):
+        oneway = tags.get('oneway') in ONEWAY_VALUES or tags.get('junction') == 'roundabout'
+        data = {key: value for key, value in tags.items() if key != 'oneway'}
+        data['osmid'] = way_id
+        data['oneway'] = oneway
+        ends = offsets[i] + np.flatnonzero(endpoint[offsets[i]:offsets[i+1]])
+        for start, end in zip(ends[:-1].tolist(), ends[1:].tolist()):
+            u, v = int(node_ids[start]), int(node_ids[end])
+            graph.add_node(u, x=float(x[start]), y=float(y[start]))
+            graph.add_node(v, x=float(x[end]), y=float(y[end]))
+            edge = dict(data, length=float(distance[end] - distance[start]))
+            if end - start > 1:
+                edge['geometry'] = list(zip(x[start:end+1].tolist(), y[start:end+1].tolist()))
+            directions = []
+            if not oneway or tags.get('oneway') not in REVERSED_VALUES:
+                directions.append((u, v, edge))
+            if not oneway or tags.get('oneway') in REVERSED_VALUES:
+                reverse = dict(edge)
+                if 'geometry' in edge:
+                    reverse['geometry'] = edge['geometry'][::-1]
+                directions.append((v, u, reverse))
+            for a, b, edge in directions:
+                # Keep the shortest of parallel streets, as get_digraph
+                if not graph.has_edge(a, b) or graph[a][b]['length'] > edge['length']:
+                    graph.add_edge(a, b, **edge)
+    if len(graph) > 0:
+        largest = max(nx.weakly_connected_components(graph), key=len)
+        graph.remove_nodes_from([node for node in list(graph) if node not in largest])
+    return graph
+
+
+def build_snapshot(PLACE, HIGHWAYS_URL, GRAPH_SNAPSHOT_DIRNAME, GAZETTEER_FILENAME, PBF_FILENAME=None, bbox=None,
+                   HIGHWAYS_FILENAME=None, INDEX_FILENAME=None):
+    """Downloads the graph of a place and the highways, or reads them from
+    local files, and stores the graph snapshot and the gazetteer of streets
+    and points of interest that the bot loads at startup. With PBF_FILENAME
+    and HIGHWAYS_FILENAME nothing is downloaded.
+
+    Parameters:
+    ----------
+    PLACE: Name of the city and the comunity of the graph.
+    HIGHWAYS_URL: Url of the online file with the highways.
+    GRAPH_SNAPSHOT_DIRNAME: Name of the directory of the graph snapshot.
+    GAZETTEER_FILENAME: Name of the file of the gazetteer.
+    PBF_FILENAME: Name of a local .osm.pbf extract to read the graph from,
+    or None to download it.
+    bbox: (west, south, east, north) of the graph read from the extract.
+    HIGHWAYS_FILENAME: Name of a local copy of the highways file, or None to
+    download it from HIGHWAYS_URL.
+    INDEX_FILENAME: Name of the file where the positions of the nodes of
+    the extract are kept while reading it, as in graph_from_pbf.
+
+    Returns:
+    ----------
+    Nothing. Only writes the files.
+    """
+
+    if PBF_FILENAME is not None:
+        graph = graph_from_pbf(PBF_FILENAME, bbox, INDEX_FILENAME)
+        places = pois_from_pbf(PBF_FILENAME, bbox, INDEX_FILENAME)
+    else:
+        graph = download_graph(PLACE)
+        places = download_pois(PLACE)
+    node_index = igo.build_node_index(graph)
+    if HIGHWAYS_FILENAME is not None:
+        # The local copy is read as the recorded fixtures of bench.py
+        HIGHWAYS_URL = 'file:' + urllib.request.pathname2url(os.path.abspath(HIGHWAYS_FILENAME))
+    highways = igo.download_highways(HIGHWAYS_URL)
+    way_index = igo.build_way_index(graph, highways, node_index)
+    igo.save_graph_snapshot(graph, way_index, GRAPH_SNAPSHOT_DIRNAME)
+    igo.save_gazetteer(igo.build_gazetteer(graph, places), GAZETTEER_FILENAME)
+
+
+if __name__ == '__main__':
+    # Usage: python build.py [EXTRACT.osm.pbf [HIGHWAYS.csv [NODES.index]]]
+    # Builds the files of the bot before starting it, with the same names
+    import sys
+    import bot
+    PBF_FILENAME = sys.argv[1] if len(sys.argv) > 1 else bot.PBF_FILENAME
+    HIGHWAYS_FILENAME = sys.argv[2] if len(sys.argv) > 2 else bot.HIGHWAYS_FILENAME
+    INDEX_FILENAME = sys.argv[3] if len(sys.argv) > 3 else bot.PBF_INDEX_FILENAME
+    build_snapshot(bot.PLACE, bot.HIGHWAYS_URL, bot.GRAPH_SNAPSHOT_DIRNAME, bot.GAZETTEER_FILENAME,
+                   PBF_FILENAME, bot.PBF_BBOX, HIGHWAYS_FILENAME, INDEX_FILENAME)
+    print("Graph snapshot stored in %s." % bot.GRAPH_SNAPSHOT_DIRNAME)
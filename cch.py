@@ -0,0 +1,389 @@
+import collections
+import threading
+import numpy as np
+
+# Parts of the graph with at most this number of nodes are not dissected
+LEAF_SIZE = 16
+
+# Metric-independent part of a customizable contraction hierarchy, computed
+# once per graph. Nodes are numbered by rank (the order in which they are
+# contracted). The arcs go from a node to the higher ranked nodes it is
+# connected to after contracting the lower ones: the arcs of node r are
+# arc_targets[arc_offsets[r]:arc_offsets[r+1]], sorted, and arc_sources has
+# the lower node of every arc. parent is the lowest
+# of them (the elimination tree). The triangles (v, u, w) with v < u < w are
+# stored as the arcs vu, vw and uw, sorted by the level of v so that every
+# level can be customized at once.
+Topology = collections.namedtuple('Topology', [
+    'rank', 'order', 'arc_offsets', 'arc_sources', 'arc_targets', 'parent', 'level_offsets',
+    'triangle_vu', 'triangle_vw', 'triangle_uw', 'uw_offsets', 'uw_triangles',
+    'edge_arcs', 'edge_up'])
+
+# Lists of the last arrays searched, as (array, list) pairs, since single
+# elements of Python lists are much faster to read than those of arrays.
+# The array is kept so that its id is not reused while it is in the cache.
+search_lists = collections.OrderedDict()
+SEARCH_LISTS_SIZE = 16
+search_lists_lock = threading.Lock()
+# Arrays of the searches of every thread, reused by all its queries
+buffers = threading.local()
+
+# Weights of the arcs of a topology for a given metric: upward (from the
+# lower ranked node to the higher) and downward, after the customization and
+# before it (the original edges, inf if there is none).
+Metric = collections.namedtuple('Metric', ['topology', 'up', 'down', 'original_up', 'original_down'])
+
+
+def dissection_order(n, sources, targets, x, y):
+    """Given an undirected graph with coordinates, orders its nodes by
+    geometric nested dissection: the nodes are split in two halves by the
+    median of their longest coordinate, the nodes of one half that touch the
+    other half form a separator, which goes last, and both halves are ordered
+    in the same way. Nodes of small separators at the top give few shortcuts.
+
+    Parameters:
+    ----------
+    n: Number of nodes.
+    sources, targets: Arrays with the endpoints of the edges.
+    x, y: Arrays with the coordinates of the nodes.
+
+    Returns:
+    ----------
+    order: Array with the nodes from the first to be contracted to the last.
+    """
+
+    order = []
+    # Parts still to be ordered with their edges. A part without edges is a
+    # separator whose two halves are already ordered.
+    stack = [(np.arange(n), sources, targets)]
+    while stack:
+        nodes, part_sources, part_targets = stack.pop()
+        if part_sources is None or len(nodes) <= LEAF_SIZE:
+            order.extend(nodes.tolist())
+            continue
+        coordinate = x if np.ptp(x[nodes]) >= np.ptp(y[nodes]) else y
+        sorted_nodes = nodes[np.argsort(coordinate[nodes], kind='stable')]
+        left = np.zeros(n, dtype=bool)
+        left[sorted_nodes[:len(nodes) // 2]] = True
+        # Edges across the cut
+        cut = left[part_sources] != left[part_targets]
+        left_boundary = np.unique(np.where(left[part_sources[cut]], part_sources[cut], part_targets[cut]))
+        right_boundary = np.unique(np.where(left[part_sources[cut]], part_targets[cut], part_sources[cut]))
+        separator = left_boundary if len(left_boundary) <= len(right_boundary) else right_boundary
+        removed = np.zeros(n, dtype=bool)
+        removed[separator] = True
+        inside = ~removed[part_sources] & ~removed[part_targets]
+        part_sources, part_targets = part_sources[inside], part_targets[inside]
+        same = left[part_sources] == left[part_targets]
+        part_sources, part_targets = part_sources[same], part_targets[same]
+        left_nodes = sorted_nodes[:len(nodes) // 2]
+        right_nodes = sorted_nodes[len(nodes) // 2:]
+        left_nodes = left_nodes[~removed[left_nodes]]
+        right_nodes = right_nodes[~removed[right_nodes]]
+        on_left = left[part_sources]
+        # Processed in this order: left, right and the separator
+        stack.append((separator, None, None))
+        stack.append((right_nodes, part_sources[~on_left], part_targets[~on_left]))
+        stack.append((left_nodes, part_sources[on_left], part_targets[on_left]))
+    return np.array(order, dtype=np.int64)
+
+
+def build(offsets, targets, x, y):
+    """Given the CSR adjacency of a directed graph and the coordinates of its
+    nodes, computes the metric-independent part of its customizable
+    contraction hierarchy. It does not depend on the weights, so it only has
+    to be computed once per graph.
+
+    Parameters:
+    ----------
+    offsets, targets: CSR arrays of the graph, as in igo.Router.
+    x, y: Arrays with the coordinates of the nodes.
+
+    Returns:
+    ----------
+    topology: Topology of the hierarchy.
+    """
+
+    n = len(offsets) - 1
+    offsets = np.asarray(offsets)
+    sources = np.repeat(np.arange(n), np.diff(offsets))
+    targets = np.asarray(targets, dtype=np.int64)
+    loops = sources == targets
+    order = dissection_order(n, sources[~loops], targets[~loops], np.asarray(x), np.asarray(y))
+    rank = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    # Contract the nodes in order, joining the higher neighbours of every
+    # node. Passing them to the lowest one is enough, as it will pass them on.
+    up = [set() for _ in range(n)]
+    for a, b in zip(rank[sources[~loops]].tolist(), rank[targets[~loops]].tolist()):
+        if a < b:
+            up[a].add(b)
+        else:
+            up[b].add(a)
+    parent = np.full(n, -1, dtype=np.int64)
+    for r in range(n):
+        if up[r]:
+            p = min(up[r])
+            parent[r] = p
+            up[p] |= up[r]
+            up[p].discard(p)
+    arc_offsets = np.zeros(n + 1, dtype=np.int64)
+    arc_offsets[1:] = np.cumsum([len(neighbours) for neighbours in up])
+    arc_targets = np.array([u for neighbours in up for u in sorted(neighbours)], dtype=np.int64)
+    arc_sources = np.repeat(np.arange(n), np.diff(arc_offsets))
+    arc_keys = arc_sources * n + arc_targets
+    # Level of every node: one more than the highest level below it
+    level = np.zeros(n, dtype=np.int64)
+    for r in range(n):
+        row = arc_targets[arc_offsets[r]:arc_offsets[r+1]]
+        level[row] = np.maximum(level[row], level[r] + 1)
+    # Triangles of every node with two of its higher neighbours
+    vu, vw, uw, triangle_level = [], [], [], []
+    pairs = {}
+    for r in range(n):
+        k = arc_offsets[r+1] - arc_offsets[r]
+        if k < 2:
+            continue
+        if k not in pairs:
+            pairs[k] = np.triu_indices(k, 1)
+        i, j = pairs[k]
+        row = arc_targets[arc_offsets[r]:arc_offsets[r+1]]
+        vu.append(arc_offsets[r] + i)
+        vw.append(arc_offsets[r] + j)
+        uw.append(np.searchsorted(arc_keys, row[i] * n + row[j]))
+        triangle_level.append(np.full(len(i), level[r]))
+    if vu:
+        vu, vw, uw = np.concatenate(vu), np.concatenate(vw), np.concatenate(uw)
+        triangle_level = np.concatenate(triangle_level)
+    else:
+        vu = vw = uw = triangle_level = np.zeros(0, dtype=np.int64)
+    by_level = np.argsort(triangle_level, kind='stable')
+    vu, vw, uw = vu[by_level], vw[by_level], uw[by_level]
+    level_offsets = np.searchsorted(triangle_level[by_level], np.arange(level.max() + 2))
+    # Triangles of every arc uw, to unpack the shortcuts
+    uw_triangles = np.argsort(uw, kind='stable')
+    uw_offsets = np.searchsorted(uw[uw_triangles], np.arange(len(arc_targets) + 1))
+    # Arc of every edge of the graph and its direction
+    low = np.minimum(rank[sources], rank[targets])
+    high = np.maximum(rank[sources], rank[targets])
+    edge_arcs = np.searchsorted(arc_keys, low * n + high)
+    edge_arcs[loops] = -1
+    edge_up = rank[sources] < rank[targets]
+    return Topology(rank, order, arc_offsets, arc_sources, arc_targets, parent, level_offsets,
+                    vu.astype(np.int32), vw.astype(np.int32), uw.astype(np.int32),
+                    uw_offsets, uw_triangles.astype(np.int32), edge_arcs, edge_up)
+
+
+def customize(topology, weights):
+    """Given the topology of a hierarchy and the weights of the edges of the
+    graph, computes the weights of all the arcs. Every triangle v < u < w
+    gives a path u-v-w that bounds the arc uw, and the triangles are
+    processed level by level in vectorized passes.
+
+    Parameters:
+    ----------
+    topology: Topology returned by build.
+    weights: Array with the weight of every edge of the graph in CSR order.
+
+    Returns:
+    ----------
+    metric: Metric with the weights of the arcs.
+    """
+
+    weights = np.asarray(weights, dtype=np.float64)
+    up = np.full(len(topology.arc_targets), np.inf)
+    down = np.full(len(topology.arc_targets), np.inf)
+    edges = topology.edge_arcs >= 0
+    forward = edges & topology.edge_up
+    backward = edges & ~topology.edge_up
+    np.minimum.at(up, topology.edge_arcs[forward], weights[forward])
+    np.minimum.at(down, topology.edge_arcs[backward], weights[backward])
+    original_up, original_down = up.copy(), down.copy()
+    offsets = topology.level_offsets
+    for level in range(len(offsets) - 1):
+        vu = topology.triangle_vu[offsets[level]:offsets[level+1]]
+        vw = topology.triangle_vw[offsets[level]:offsets[level+1]]
+        uw = topology.triangle_uw[offsets[level]:offsets[level+1]]
+        # u -> v -> w and w -> v -> u
+        np.minimum.at(up, uw, down[vu] + up[vw])
+        np.minimum.at(down, uw, down[vw] + up[vu])
+    return Metric(topology, up, down, original_up, original_down)
+
+
+def as_list(array):
+    """Given an array, returns it as a list, converting it only the first
+    time it is searched."""
+
+    with search_lists_lock:
+        entry = search_lists.get(id(array))
+        if entry is not None and entry[0] is array:
+            search_lists.move_to_end(id(array))
+            return entry[1]
+    values = array.tolist()
+    with search_lists_lock:
+        search_lists[id(array)] = (array, values)
+        while len(search_lists) > SEARCH_LISTS_SIZE:
+            search_lists.popitem(last=False)
+    return values
+
+
+def search_buffers(n):
+    """Returns the two pairs of distance and arc arrays of n nodes of the
+    current thread, for the forward and the backward search. All their
+    entries are inf and -1 between queries."""
+
+    if getattr(buffers, 'size', None) != n:
+        buffers.size = n
+        buffers.arrays = [(np.full(n, np.inf), np.full(n, -1, dtype=np.int64)) for _ in range(2)]
+    return buffers.arrays
+
+
+def ancestors(topology, start):
+    """Given a topology and a node (by rank), returns the node and all its
+    ancestors in the elimination tree, from the lowest to the root."""
+
+    parent = as_list(topology.parent)
+    chain = []
+    v = start
+    while v != -1:
+        chain.append(v)
+        v = parent[v]
+    return chain
+
+
+def upward_search(metric, forward_chain, backward_chain, forward, forward_pred, backward, backward_pred):
+    """Given a metric and the ancestors of a source and a target (by rank),
+    as returned by ancestors, computes the distances going up from the
+    source and going up to the target, writing them and the arc used to
+    reach every node in the given arrays, which must be inf and -1 for the
+    ancestors and are only written there. Above the lowest common ancestor a
+    node is only relaxed if it is closer than the best meeting node found.
+    Returns the meeting node, or -1 if there is none."""
+
+    offsets = as_list(metric.topology.arc_offsets)
+    arc_targets = metric.topology.arc_targets
+
+    def relax(v, weights, dist, pred):
+        # Improve the nodes above v through its arcs
+        first, last = offsets[v], offsets[v+1]
+        if first < last:
+            row = arc_targets[first:last]
+            candidates = weights[first:last] + dist[v]
+            better = (candidates < dist[row]).nonzero()[0]
+            dist[row[better]] = candidates[better]
+            pred[row[better]] = first + better
+
+    forward[forward_chain[0]] = 0
+    backward[backward_chain[0]] = 0
+    common = set(forward_chain)
+    # Both chains are the same from the lowest common ancestor up
+    split = len(backward_chain)
+    for i, v in enumerate(backward_chain):
+        if v in common:
+            split = i
+            break
+    below = len(forward_chain) - (len(backward_chain) - split)
+    for v in forward_chain[:below]:
+        if forward[v] < np.inf:
+            relax(v, metric.up, forward, forward_pred)
+    for v in backward_chain[:split]:
+        if backward[v] < np.inf:
+            relax(v, metric.down, backward, backward_pred)
+    best, meeting = np.inf, -1
+    for v in backward_chain[split:]:
+        if forward[v] + backward[v] < best:
+            best, meeting = forward[v] + backward[v], v
+        if forward[v] < best:
+            relax(v, metric.up, forward, forward_pred)
+        if backward[v] < best:
+            relax(v, metric.down, backward, backward_pred)
+    return meeting
+
+
+def unpack(metric, arc, upward):
+    """Given a metric and an arc, returns the edges of the graph (by rank)
+    that form it, in order. upward is True to go from the lower node of the
+    arc to the higher one."""
+
+    topology = metric.topology
+    edges = []
+    stack = [(arc, upward)]
+    while stack:
+        arc, upward = stack.pop()
+        low = int(topology.arc_sources[arc])
+        high = int(topology.arc_targets[arc])
+        if upward and metric.original_up[arc] == metric.up[arc]:
+            edges.append((low, high))
+            continue
+        if not upward and metric.original_down[arc] == metric.down[arc]:
+            edges.append((high, low))
+            continue
+        # Find the triangle that gives the weight of the shortcut
+        triangles = topology.uw_triangles[topology.uw_offsets[arc]:topology.uw_offsets[arc+1]]
+        vu = topology.triangle_vu[triangles]
+        vw = topology.triangle_vw[triangles]
+        if upward:
+            found = (metric.down[vu] + metric.up[vw] == metric.up[arc]).nonzero()[0][0]
+            # low -> v and then v -> high, pushed in reverse order
+            stack.append((vw[found], True))
+            stack.append((vu[found], False))
+        else:
+            found = (metric.down[vw] + metric.up[vu] == metric.down[arc]).nonzero()[0][0]
+            stack.append((vu[found], True))
+            stack.append((vw[found], False))
+    return edges
+
+
+def shortest_path(metric, source, target):
+    """Given a metric and two nodes of the graph (by their index in the CSR
+    arrays), finds the path with the smallest weight between them with a
+    bidirectional upward search over the elimination tree.
+
+    Parameters:
+    ----------
+    metric: Metric returned by customize.
+    source: Index of the origin node.
+    target: Index of the destination node.
+
+    Returns:
+    ----------
+    path: List with the indices of the nodes of the path, or None if the
+    nodes are not connected.
+    """
+
+    topology = metric.topology
+    (forward, forward_pred), (backward, backward_pred) = search_buffers(len(topology.rank))
+    forward_chain = ancestors(topology, int(topology.rank[source]))
+    backward_chain = ancestors(topology, int(topology.rank[target]))
+    try:
+        # The path goes up from the source to the meeting node and then down
+        meeting = upward_search(metric, forward_chain, backward_chain, forward, forward_pred, backward, backward_pred)
+        if meeting == -1:
+            return None
+        arcs = path_arcs(topology, meeting, forward_pred, backward_pred)
+    finally:
+        # Only the ancestors have been written
+        forward[forward_chain], forward_pred[forward_chain] = np.inf, -1
+        backward[backward_chain], backward_pred[backward_chain] = np.inf, -1
+    path = [int(topology.rank[source])]
+    for arc, upward in arcs:
+        path.extend(b for _, b in unpack(metric, arc, upward))
+    return topology.order[path].tolist()
+
+
+def path_arcs(topology, meeting, forward_pred, backward_pred):
+    """Given a topology, the meeting node of a query and the arcs used to
+    reach every node by its forward and backward searches, returns the arcs
+    of the path, with True for the ones that go up."""
+
+    arcs = []
+    v = meeting
+    while forward_pred[v] != -1:
+        arcs.append((forward_pred[v], True))
+        v = int(topology.arc_sources[forward_pred[v]])
+    arcs.reverse()
+    v = meeting
+    while backward_pred[v] != -1:
+        arcs.append((backward_pred[v], False))
+        v = int(topology.arc_sources[backward_pred[v]])
+    return arcs
@@ -0,0 +1,147 @@
+import sys
+import json
+import time
+import email.parser
+import threading
+import http.server
+import urllib.request
+
+# Chat of the updates sent when no other is given
+CHAT_ID = 1
+
+
+class FakeTelegram(http.server.ThreadingHTTPServer):
+    """Local HTTP server that answers the Bot API methods used by the bot as
+    Telegram would, so that the webhook mode can be run and measured without
+    Telegram. It sends the updates to the webhook set by the bot and keeps
+    the messages and photos that the bot sends.
+
+    Parameters:
+    ----------
+    address: (host, port) where the server listens. The bot uses it with
+    TELEGRAM_API_URL = 'http://host:port'.
+    """
+
+    def __init__(self, address):
+        self.webhook_url = None
+        self.update_id = 0
+        self.message_id = 0
+        # (time, chat_id, method, text) of every message sent by the bot
+        self.sent = []
+        self.condition = threading.Condition()
+        super().__init__(address, FakeTelegramHandler)
+
+    def send_update(self, text=None, location=None, chat_id=CHAT_ID):
+        """Sends an update with a text message or a location, given as
+        (lat, lon), to the webhook of the bot. Returns the time when it was
+        sent."""
+
+        with self.condition:
+            self.update_id += 1
+            self.message_id += 1
+            update_id, message_id = self.update_id, self.message_id
+        message = {'message_id': message_id, 'date': int(time.time()),
+                   'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Test'},
+                   'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Test'}}
+        if location is not None:
+            message['location'] = {'latitude': location[0], 'longitude': location[1]}
+        else:
+            message['text'] = text
+            if text.startswith('/'):
+                # Commands are recognised by their entity
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        body = json.dumps({'update_id': update_id, 'message': message}).encode('utf-8')
+        request = urllib.request.Request(self.webhook_url, body, {'Content-Type': 'application/json'})
+        sent = time.time()
+        urllib.request.urlopen(request).read()
+        return sent
+
+    def wait(self, count, seconds=60):
+        """Waits until the bot has sent count messages in total, at most the
+        given seconds. Returns the sent messages."""
+
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.sent) >= count, seconds)
+            return list(self.sent)
+
+
+class FakeTelegramHandler(http.server.BaseHTTPRequestHandler):
+    """Handler of the requests of a FakeTelegram, such as
+    POST /bot<token>/sendMessage."""
+
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = self.parse(body)
+        server = self.server
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'GuideBot', 'username': 'guide_bot'}
+        elif method == 'setWebhook':
+            server.webhook_url = data['url']
+            result = True
+        elif method == 'deleteWebhook':
+            server.webhook_url = None
+            result = True
+        elif method in ('sendMessage', 'sendPhoto'):
+            chat_id = int(data['chat_id'])
+            with server.condition:
+                server.message_id += 1
+                server.sent.append((time.time(), chat_id, method, data.get('text')))
+                server.condition.notify_all()
+                result = {'message_id': server.message_id, 'date': int(time.time()),
+                          'chat': {'id': chat_id, 'type': 'private'}}
+            if method == 'sendMessage':
+                result['text'] = data['text']
+            else:
+                result['photo'] = [{'file_id': 'photo', 'file_unique_id': 'photo', 'width': 1, 'height': 1}]
+        else:
+            self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        self.reply(200, {'ok': True, 'result': result})
+
+    def parse(self, body):
+        """Returns the parameters of a request, sent as json or, with files,
+        as multipart/form-data. The content of the files is not kept."""
+
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            header = ('Content-Type: %s\r\n\r\n' % content_type).encode('utf-8')
+            message = email.parser.BytesParser().parsebytes(header + body)
+            data = {}
+            for part in message.get_payload():
+                if part.get_filename() is None:
+                    data[part.get_param('name', header='content-disposition')] = part.get_payload(decode=True).decode('utf-8')
+            return data
+        return json.loads(body) if body else {}
+
+    def reply(self, status, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    # Usage: python fake_telegram.py [port]
+    # Then run TELEGRAM_API_URL=http://127.0.0.1:port python bot.py webhook
+    # and type the messages of the user, such as /go Sagrada Familia.
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    server = FakeTelegram(('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Fake Telegram listening on port %d." % port)
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        if server.webhook_url is None:
+            print("The bot has not set its webhook yet.")
+            continue
+        count = len(server.sent)
+        sent = server.send_update(line)
+        for answered, chat_id, method, text in server.wait(count + 1, 30)[count:]:
+            print("%s after %.3f s: %s" % (method, answered - sent, text or ''))
@@ -1,29 +1,49 @@
-import osmnx as ox
-import sklearn
 import pickle
+import os
+import json
+import heapq
+import collections
+import threading
+import time
+import bisect
+import io
+import difflib
+import unicodedata
+import numpy as np
+from scipy.spatial import cKDTree
 import networkx as nx
 import csv
 import urllib.request
-from staticmap import StaticMap, CircleMarker, Line
+import urllib.error
+import hashlib
+import re
+import zlib
+from staticmap import CircleMarker, Line
+import tiles
+import cch
 
 PLACE = 'Barcelona,Catalonia'
-
-
-def download_graph(PLACE):
-    """ Given a place, creates a graph of the site.
-
-    Parameters:
-    ----------
-    PLACE: Name of the city and the comunity the graph of which is wanted.
-
-    Returns:
-    ----------
-    graph: The graph of the given location
-    """
-
-    graph = ox.graph_from_place(PLACE, network_type='drive', simplify=True)
-    graph = ox.utils_graph.get_digraph(graph, weight='length')
-    return graph
+# Version of the on-disk way index format. Increase it whenever the way the
+# index is built changes so that stale files are rebuilt.
+WAY_INDEX_VERSION = 1
+# Version of the binary graph snapshot format.
+GRAPH_SNAPSHOT_VERSION = 3
+# Version of the on-disk contraction hierarchy format.
+HIERARCHY_VERSION = 1
+# Extra time added by each level of congestion, as a fraction of the time
+# needed to cross the street without traffic. A blocked street (level 6) is
+# not removed from the graph, but it is avoided whenever possible.
+CONGESTION_FACTORS = np.array([1, 0, 1/4, 3/4, 3/2, 3, 100])
+# Speed limit in km/h of the streets without maxspeed, by highway class.
+DEFAULT_MAXSPEEDS = {
+    'motorway': 80, 'motorway_link': 60, 'trunk': 80, 'trunk_link': 50,
+    'primary': 50, 'primary_link': 50, 'secondary': 50, 'secondary_link': 50,
+    'tertiary': 50, 'tertiary_link': 50, 'unclassified': 30,
+    'residential': 30, 'living_street': 20, 'service': 20}
+DEFAULT_MAXSPEED = 30
+FEED_TIMEOUT = 30  # Seconds to wait for the open data server
+HISTORY_SIZE = 4 * 24 * 28  # Congestion snapshots kept, four weeks of updates every 15 minutes
+PROFILE_MINUTES = 15  # Length of the intervals of the day of the congestion profiles
 
 
 def save_graph(graph, GRAPH_FILENAME):
@@ -81,43 +101,87 @@ def exists_graph(GRAPH_FILENAME):
     return True
 
 
-def plot_graph(PLACE):
-    """Given a place, plots a map of the site.
+def open_feed(URL, feed=None):
+    """Given the url of an open data file, opens it. If the information of a
+    previous download is given, the server is asked to only send the file
+    if it has changed since then.
 
     Parameters:
     ----------
-    PLACE: The name of the place from wich we want to get the map.
+    URL: Url of the file.
+    feed: Dictionary with the ETag and Last-Modified date of the last
+    download, as left by read_feed.
 
     Returns:
     ----------
-    Osmnx function that shows the map of the indicated place.
+    response: The open response, or None if the server says that the file
+    has not changed.
     """
 
-    return ox.plot_graph(ox.graph_from_place(PLACE, network_type='drive', simplify=True))
+    request = urllib.request.Request(URL)
+    if feed is not None:
+        if feed.get('etag'):
+            request.add_header('If-None-Match', feed['etag'])
+        if feed.get('last_modified'):
+            request.add_header('If-Modified-Since', feed['last_modified'])
+    try:
+        return urllib.request.urlopen(request, timeout=FEED_TIMEOUT)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            # Not modified
+            return None
+        raise
 
 
-def download_highways(HIGHWAYS_URL):
-    """Given a file url, read it and download its content, storing it
-    in a dictionary.
+def read_feed(URL, parse, feed=None, **csv_options):
+    """Given the url of a csv file and a function that parses its rows,
+    downloads and parses the file line by line while it arrives, without
+    keeping the whole file in memory.
 
     Parameters:
     ----------
-    HIGHWAYS_URL: Url from a csv exel file that provides information about
-    Barcelona's highways.
+    URL: Url of the file.
+    parse: Function that receives the csv reader and returns the result.
+    feed: Dictionary where the ETag, Last-Modified date and hash of the
+    content of the last download are kept. If it is given and the file has
+    not changed since then, it is not parsed again.
+    csv_options: Options of csv.reader, such as the delimiter.
 
     Returns:
     ----------
-    hw: Dictionary with way identification numbers as keys and the coordinates
-    of each the points of each street as values.
+    The result of parse, or None if the file has not changed.
     """
 
-    # Read the file in csv format
-    with urllib.request.urlopen(HIGHWAYS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
+    response = open_feed(URL, feed)
+    if response is None:
+        return None
+    digest = hashlib.sha1()
+
+    def lines():
+        for line in response:
+            digest.update(line)
+            yield line.decode('utf-8')
+
+    with response:
+        result = parse(csv.reader(lines(), **csv_options))
+        headers = response.headers
+    if feed is not None:
+        # Some servers do not support conditional requests, so the content
+        # is compared too
+        unchanged = feed.get('hash') == digest.hexdigest()
+        feed['etag'] = headers.get('ETag')
+        feed['last_modified'] = headers.get('Last-Modified')
+        feed['hash'] = digest.hexdigest()
+        if unchanged:
+            return None
+    return result
+
+
+def parse_highways(reader):
+    """Given a csv reader of the highways file, returns the dictionary of
+    highways described in download_highways."""
+
     next(reader)
-    points = []
-    tram_id = []
     hw = {}
     # For every line in the file
     for line in reader:
@@ -128,95 +192,211 @@ def download_highways(HIGHWAYS_URL):
     return hw
 
 
-def plot_highways(highways, name, SIZE):
-    """Given a dictionary that stores the coordinates of the points that
-    form each way, a file name and a size, stores a map of that size in a
-    file with the indicated name.
+def download_highways(HIGHWAYS_URL, feed=None):
+    """Given a file url, read it and download its content, storing it
+    in a dictionary.
 
     Parameters:
     ----------
-    highways: Dictionary with the identification number of each way as keys
-    and the coordinates of the points that forms it as values.
-    name: The name of the file where the map is going to be stored.
-    SIZE: The size that the map is going to have.
+    HIGHWAYS_URL: Url from a csv exel file that provides information about
+    Barcelona's highways.
+    feed: Dictionary with the information of the last download, as in
+    read_feed. If it is given and the file has not changed, returns None.
 
     Returns:
     ----------
-    Nothing. Plots a map on a given file.
+    hw: Dictionary with way identification numbers as keys and the coordinates
+    of each the points of each street as values.
     """
 
-    mapa_bcn = StaticMap(600, 600)
-    # For every way in highways
-    for way in highways:
-        row = highways[way]
-        for i in range(0, len(row), 2):
-            if (i == 0):
-                marker = CircleMarker((row[i], row[i+1]), 'yellow', 3)
-                mapa_bcn.add_marker(marker)
-            elif (i == len(row) - 2):
-                marker = CircleMarker((row[i], row[i+1]), 'blue', 3)
-                mapa_bcn.add_marker(marker)
-            if (i < len(row) - 3):
-                coordinates = [[row[i], row[i+1]], [row[i+2], row[i+3]]]
-                line_outline = Line(coordinates, 'red', 2)
-                line = Line(coordinates, 'black', 3)
-                mapa_bcn.add_line(line_outline)
-                mapa_bcn.add_line(line)
-    image = mapa_bcn.render()
-    image.save(name)
+    # Read the file in csv format
+    return read_feed(HIGHWAYS_URL, parse_highways, feed, delimiter=',', quotechar='"')
+
+
+def parse_congestions(reader):
+    """Given a csv reader of the congestions file, returns the list of
+    congestions described in download_congestions."""
+
+    congestion = []
+    for line in reader:
+        congestion.append((int(line[0]), int(line[2])))
+    return congestion
 
 
-def download_congestions(CONGESTIONS_URL):
+def download_congestions(CONGESTIONS_URL, feed=None):
     """Given a file url, reads its content and stores it in a list.
 
     Parameters:
     ----------
     CONGESTIONS_URL: Url of the online file where the data about highways'
     congestion is.
+    feed: Dictionary with the information of the last download, as in
+    read_feed. If it is given and the file has not changed, returns None.
 
     Returns:
     ----------
     congestion: List with the way id number and its current congestion.
     """
 
-    with urllib.request.urlopen(CONGESTIONS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#', quotechar='"')
-    congestion = []
-    for line in reader:
-        congestion.append((int(line[0]), int(line[2])))
-    return congestion
+    return read_feed(CONGESTIONS_URL, parse_congestions, feed, delimiter='#', quotechar='"')
 
 
-def plot_congestions(highways, congestions, name, SIZE):
-    """Given a dictionary and a list with information about ways' congestions
-    and points, plots a map of the city showing congestions information using
-    colors. It loads the map of size SIZExSIZE in the specified file.
+def day_intervals(times, minutes=PROFILE_MINUTES):
+    """Given an array of unix times, returns the interval of the given
+    minutes of the local day where each one is."""
 
-    Parameters:
-    ----------
-    highways: Dictionary with the identification numbers of each way as keys
-    and the coordinates of the points that form it as values.
-    congestions: List with the way id number and its current congestion.
-    name: The name of the file where the map is going to be stored.
-    SIZE: The size that tha map is going to have.
+    times = np.asarray(times, dtype=np.float64)
+    offsets = np.array([time.localtime(t).tm_gmtoff for t in times.ravel()], dtype=np.float64).reshape(times.shape)
+    return ((times + offsets) % 86400 // (60 * minutes)).astype(np.int64)
 
-    Returns:
+
+class CongestionHistory:
+    """Ring buffer with the last congestion snapshots, kept in memory and on
+    disk as one int8 array per snapshot with the level of every way (0 when
+    it is not known). It gives the usual level of every way at every time of
+    the day, which is used when the live congestions are missing or old.
+
+    Parameters:
     ----------
-    Nothing. Only plots the map in the given file.
+    HISTORY_DIRNAME: Name of the directory where the buffer is stored.
+    way_ids: Sorted array with the identifiers of the ways, such as the
+    way_ids of a GraphSnapshot. If the stored buffer has other ways, the
+    levels of the common ones are kept.
+    size: Maximum number of snapshots. The oldest one is replaced.
     """
 
-    mapa_bcn = StaticMap(600, 600)
-    for tram in congestions:
-        density = tram[1]
-        color = {0: 'white', 1: 'green', 2: 'yellow', 3: 'purple', 4: 'orange', 5: 'red', 6: 'black'}
-        row = highways[tram[0]]
-        for i in range(0, len(row)-3, 2):
-            coordinates = [[row[i], row[i+1]], [row[i+2], row[i+3]]]
-            line = Line(coordinates, color[density], 3)
-            mapa_bcn.add_line(line)
-    image = mapa_bcn.render()
-    image.save(name)
+    def __init__(self, HISTORY_DIRNAME, way_ids, size=HISTORY_SIZE):
+        os.makedirs(HISTORY_DIRNAME, exist_ok=True)
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)
+        self.lock = threading.Lock()
+        densities_filename = os.path.join(HISTORY_DIRNAME, 'densities.npy')
+        times_filename = os.path.join(HISTORY_DIRNAME, 'times.npy')
+        ways_filename = os.path.join(HISTORY_DIRNAME, 'way_ids.npy')
+        old = None
+        if os.path.exists(ways_filename):
+            old = np.load(ways_filename), np.load(densities_filename), np.load(times_filename)
+            if np.array_equal(old[0], self.way_ids) and len(old[2]) == size:
+                self.densities = np.load(densities_filename, mmap_mode='r+')
+                self.times = np.load(times_filename, mmap_mode='r+')
+                return
+        self.densities = np.lib.format.open_memmap(densities_filename, mode='w+', dtype=np.int8,
+                                                   shape=(size, len(self.way_ids)))
+        self.times = np.lib.format.open_memmap(times_filename, mode='w+', dtype=np.float64, shape=(size,))
+        if old is not None:
+            # Keep the newest snapshots of the ways that are still known
+            old_ways, old_densities, old_times = old
+            rows = np.argsort(-old_times)[:size]
+            rows = rows[old_times[rows] > 0]
+            columns, known = self.columns(old_ways)
+            self.densities[:len(rows), columns[known]] = old_densities[rows][:, known]
+            self.times[:len(rows)] = old_times[rows]
+            self.flush()
+        np.save(ways_filename, self.way_ids)
+
+    def columns(self, way_ids):
+        """Given an array of way identifiers, returns their columns in the
+        buffer and a boolean array that tells which ones are known."""
+
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        if len(self.way_ids) == 0:
+            return np.zeros(len(way_ids), dtype=np.int64), np.zeros(len(way_ids), dtype=bool)
+        columns = np.minimum(np.searchsorted(self.way_ids, way_ids), len(self.way_ids) - 1)
+        return columns, self.way_ids[columns] == way_ids
+
+    def flush(self):
+        """Writes the changes of the buffer to disk."""
+
+        self.densities.flush()
+        self.times.flush()
+
+    def __len__(self):
+        """Returns the number of snapshots stored."""
+
+        return int(np.count_nonzero(self.times))
+
+    def add(self, congestions, snapshot_time):
+        """Stores the congestions downloaded at the given time in place of
+        the oldest snapshot."""
+
+        row = np.zeros(len(self.way_ids), dtype=np.int8)
+        if len(congestions) > 0:
+            way_ids, densities = np.array(congestions, dtype=np.int64).reshape(-1, 2).T
+            columns, known = self.columns(way_ids)
+            densities = densities[known]
+            densities[(densities < 0) | (densities >= len(CONGESTION_FACTORS))] = 0
+            row[columns[known]] = densities
+        with self.lock:
+            slot = int(np.argmin(self.times))
+            # The slot is empty until the whole row has been written
+            self.times[slot] = 0
+            self.densities[slot] = row
+            self.times[slot] = snapshot_time
+            self.flush()
+
+    def snapshots(self):
+        """Returns a copy of the times and the levels of the stored
+        snapshots."""
+
+        with self.lock:
+            filled = np.flatnonzero(self.times)
+            return np.array(self.times[filled]), np.array(self.densities[filled])
+
+    def profiles(self, way_ids=None, minutes=PROFILE_MINUTES):
+        """Returns the mean level of congestion of some ways in every interval
+        of the given minutes of the day, computed over all the snapshots.
+
+        Parameters:
+        ----------
+        way_ids: Array with the identifiers of the ways, or None for all the
+        ways of the buffer.
+        minutes: Length of the intervals.
+
+        Returns:
+        ----------
+        profiles: Array with a row per way and a column per interval of the
+        day, starting at midnight. It is NaN where the level is not known.
+        """
+
+        times, densities = self.snapshots()
+        if way_ids is not None:
+            columns, known = self.columns(way_ids)
+            densities = densities[:, columns] * known
+        # Matrix with a row per interval and a one in the columns of its
+        # snapshots, so that sums and counts are matrix products
+        intervals = np.zeros((1440 // minutes, len(times)), dtype=np.float32)
+        intervals[day_intervals(times, minutes), np.arange(len(times))] = 1
+        sums = intervals @ densities.astype(np.float32)
+        counts = intervals @ (densities > 0).astype(np.float32)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).T.astype(np.float64)
+
+    def predict(self, when, minutes=PROFILE_MINUTES):
+        """Returns the usual congestions at the time of the day of the given
+        unix time, as a list of (way id, level) like download_congestions,
+        with only the ways whose level is known at that time."""
+
+        times, densities = self.snapshots()
+        densities = densities[day_intervals(times, minutes) == day_intervals(when, minutes)]
+        counts = np.count_nonzero(densities > 0, axis=0)
+        known = counts > 0
+        levels = densities[:, known].sum(axis=0, dtype=np.int64) / counts[known]
+        return list(zip(self.way_ids[known].tolist(), np.rint(levels).astype(np.int64).tolist()))
+
+    def fill(self, congestions, when, minutes=PROFILE_MINUTES):
+        """Given the live congestions, returns them with the usual level of
+        the ways that have no data at the given unix time. If congestions is
+        empty, only the usual levels are returned."""
+
+        predicted = dict(self.predict(when, minutes))
+        live = set()
+        filled = []
+        for way_id, density in congestions:
+            live.add(way_id)
+            if not 0 < density < len(CONGESTION_FACTORS) and way_id in predicted:
+                density = predicted[way_id]
+            filled.append((way_id, density))
+        # The live ones go last, so they win where ways share an edge
+        return [(way_id, density) for way_id, density in predicted.items() if way_id not in live] + filled
 
 
 def congestion_time(density, usual_time):
@@ -238,18 +418,101 @@ def congestion_time(density, usual_time):
     Double indicating the extra time added by traffic to the route.
     """
 
-    if density == 0:
-        return usual_time
-    elif density == 1:
-        return 0
-    elif density == 2:
-        return usual_time / 4
-    elif density == 3:
-        return 3*usual_time/4
-    elif density == 4:
-        return 3*usual_time/2
-    elif density == 5:
-        return 3*usual_time
+    if not 0 <= density < len(CONGESTION_FACTORS):
+        # Unknown level, the same as no data
+        density = 0
+    return CONGESTION_FACTORS[density] * usual_time
+
+
+def maxspeed_value(maxspeed):
+    """Given the maxspeed attribute of an edge, returns it as a number.
+
+    Parameters:
+    ----------
+    maxspeed: Maximum speed as a number, a string such as '50' or '30 mph',
+    or a list of them when the edge joins several ways.
+
+    Returns:
+    ----------
+    Float with the maximum speed in km/h (the mean if there are several),
+    or nan if it is unknown.
+    """
+
+    if isinstance(maxspeed, list):
+        speeds = [maxspeed_value(speed) for speed in maxspeed]
+        speeds = [speed for speed in speeds if speed == speed]
+        return sum(speeds) / len(speeds) if speeds else float('nan')
+    if isinstance(maxspeed, (int, float)):
+        return float(maxspeed) if maxspeed > 0 else float('nan')
+    match = re.match(r'\s*(\d+(\.\d+)?)', str(maxspeed))
+    if match is None or float(match.group(1)) <= 0:
+        return float('nan')
+    if 'mph' in str(maxspeed):
+        return 1.609344 * float(match.group(1))
+    return float(match.group(1))
+
+
+def edge_maxspeed(data):
+    """Given the attributes of an edge, returns its maximum speed in km/h.
+    If the edge has no valid maxspeed, the usual limit of its highway class
+    is used instead.
+
+    Parameters:
+    ----------
+    data: Dictionary with the attributes of the edge.
+
+    Returns:
+    ----------
+    Float with the maximum speed.
+    """
+
+    maxspeed = maxspeed_value(data.get('maxspeed'))
+    if maxspeed == maxspeed:
+        return maxspeed
+    highway = data.get('highway')
+    if isinstance(highway, list):
+        highway = highway[0]
+    return float(DEFAULT_MAXSPEEDS.get(highway, DEFAULT_MAXSPEED))
+
+
+def edge_itime(data, density):
+    """Given the attributes of an edge and the congestion of its highway,
+    calculates the itime of the edge.
+
+    Parameters:
+    ----------
+    data: Dictionary with the attributes of the edge. It must contain the
+    length (in m) and it should contain the maxspeed (in km/h).
+    density: Level of congestion of the highway.
+
+    Returns:
+    ----------
+    Double with the itime of the edge.
+    """
+
+    # Get the time that takes to cross the street without traffic
+    usual_time = data['length'] / (10 * edge_maxspeed(data) / 36)
+    # Add the congestion time
+    return usual_time + congestion_time(density, usual_time)
+
+
+def add_itime_edges(graph, edges, density):
+    """Given a graph, a list of edges that form a highway and the congestion
+    of that highway, calculates the itime of every edge and imputes it.
+
+    Parameters:
+    ----------
+    graph: The graph with edges with the average itime.
+    edges: List of (u, v) tuples with the edges of the highway.
+    density: Level of congestion of the highway.
+
+    Returns:
+    ----------
+    Nothing. Modifies the attribute itime of the edges in the graph.
+    """
+
+    for u, v in edges:
+        graph[u][v]['itime'] = edge_itime(graph[u][v], density)
 
 
 def add_itime(graph, nodes, density):
@@ -267,22 +530,167 @@ def add_itime(graph, nodes, density):
     ----------
     Nothing. Modifies the attribute itme of the edges in the graph.
     """
-    # For every node in the path
-    for i in range(0, len(nodes)-1):
-        way_length = 0
-        # Get the distance in m and the speed in km/h
-        way_lenght = graph[nodes[i]][nodes[i+1]]['length']
-        way_speed_limit = graph[nodes[i]][nodes[i+1]]['maxspeed']
-        # Convert the speed into m/s
-        way_speed_limit = float(10*way_speed_limit/36)
-        # Get the time that takes to cross the street without traffic
-        usual_time = float(way_lenght / way_speed_limit)
-        # Add the congestion time
-        itime = usual_time + congestion_time(density, usual_time)
-        graph[nodes[i]][nodes[i+1]]['itime'] = itime
-
-
-def build_igraph(graph, highways, congestions):
+
+    add_itime_edges(graph, list(zip(nodes[:-1], nodes[1:])), density)
+
+
+# Spatial index over the nodes of a graph. Longitudes are scaled by the cosine
+# of the mean latitude so that euclidean distances in the tree are
+# proportional to distances on the ground at the scale of a city.
+NodeIndex = collections.namedtuple('NodeIndex', ['tree', 'nodes', 'scale'])
+
+
+def build_node_index(graph):
+    """Given a graph, builds a KD-tree over the coordinates of its nodes to
+    find nearest nodes quickly. It has to be built only once per graph.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona.
+
+    Returns:
+    ----------
+    node_index: NodeIndex with the tree, the node identifiers in the order
+    of the tree and the scale applied to the longitudes.
+    """
+
+    nodes = np.array(list(graph.nodes), dtype=np.int64)
+    x = np.array([graph.nodes[node]['x'] for node in nodes.tolist()], dtype=np.float64)
+    y = np.array([graph.nodes[node]['y'] for node in nodes.tolist()], dtype=np.float64)
+    scale = np.cos(np.radians(y.mean()))
+    tree = cKDTree(np.column_stack((x * scale, y)))
+    return NodeIndex(tree, nodes, scale)
+
+
+def snapshot_node_index(snapshot):
+    """Given a graph snapshot, builds the same node index as
+    build_node_index without creating the networkx graph.
+
+    Parameters:
+    ----------
+    snapshot: GraphSnapshot returned by load_graph_snapshot.
+
+    Returns:
+    ----------
+    node_index: NodeIndex of the graph of the snapshot.
+    """
+
+    x = np.asarray(snapshot.x, dtype=np.float64)
+    y = np.asarray(snapshot.y, dtype=np.float64)
+    scale = np.cos(np.radians(y.mean()))
+    tree = cKDTree(np.column_stack((x * scale, y)))
+    return NodeIndex(tree, snapshot.nodes, scale)
+
+
+def nearest_nodes(node_index, X, Y):
+    """Given a node index and the coordinates of some points, finds the
+    nearest node of the graph to every point in a single vectorized query.
+
+    Parameters:
+    ----------
+    node_index: NodeIndex returned by build_node_index.
+    X: Longitude of the points. A number or a list of numbers.
+    Y: Latitude of the points. A number or a list of numbers.
+
+    Returns:
+    ----------
+    The identifier of the nearest node if X and Y are numbers, or an array
+    with the identifier of the nearest node to every point otherwise.
+    """
+
+    X = np.asarray(X, dtype=np.float64)
+    Y = np.asarray(Y, dtype=np.float64)
+    points = np.column_stack((X.ravel() * node_index.scale, Y.ravel()))
+    _, positions = node_index.tree.query(points)
+    nearest = node_index.nodes[positions]
+    if X.ndim == 0:
+        return int(nearest[0])
+    return nearest
+
+
+def build_way_index(graph, highways, node_index=None):
+    """Given a graph and the information about highways, finds for every way
+    the ordered list of edges of the graph that it covers. The coordinates of
+    the way are matched to the graph only once, so the result can be reused
+    every time the congestions are updated.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona.
+    highways: Dictionary containing information about the coordinates of the
+    points that form each way.
+    node_index: NodeIndex of the graph. It is built if it is not given.
+
+    Returns:
+    ----------
+    way_index: Dictionary with way identification numbers as keys and the
+    list of (u, v) edges of the graph that form the way as values.
+    """
+
+    if node_index is None:
+        node_index = build_node_index(graph)
+    # Get the nearest nodes to the points of all the ways at once
+    X = [x for coord in highways.values() for x in coord[0:len(coord)-1:2]]
+    Y = [y for coord in highways.values() for y in coord[1:len(coord):2]]
+    snapped = nearest_nodes(node_index, X, Y).tolist()
+    way_index = {}
+    first = 0
+    for way_id, coord in highways.items():
+        way_nodes = snapped[first:first + len(coord)//2]
+        first += len(coord)//2
+        edges = []
+        for origin_node, destination_node in zip(way_nodes[:-1], way_nodes[1:]):
+            try:
+                # Get the nodes that have to be visited to go from the origin
+                # to the destination
+                nodes = nx.shortest_path(graph, origin_node, destination_node, weight='length')
+            except nx.NetworkXNoPath:
+                # Nodes are not connected
+                continue
+            edges.extend(zip(nodes[:-1], nodes[1:]))
+        way_index[way_id] = edges
+    return way_index
+
+
+def save_way_index(way_index, WAY_INDEX_FILENAME):
+    """ Given a way index and the name of a file, saves the index to file
+    together with the version of the format.
+
+    Parameters:
+    ----------
+    way_index: Dictionary returned by build_way_index.
+    WAY_INDEX_FILENAME: name of the file where the index is going to be stored
+
+    Returns:
+    ----------
+    Nothing. Only saves the index.
+    """
+
+    with open(WAY_INDEX_FILENAME, 'wb') as file:
+        pickle.dump({'version': WAY_INDEX_VERSION, 'way_index': way_index}, file)
+
+
+def load_way_index(WAY_INDEX_FILENAME):
+    """ Given the name of a file, loads the way index stored in it.
+
+    Parameters:
+    ----------
+    WAY_INDEX_FILENAME: name of the file where the way index is stored
+
+    Returns:
+    ----------
+    way_index: Dictionary with the way index, or None if the file was written
+    with another version of the format and has to be rebuilt.
+    """
+
+    with open(WAY_INDEX_FILENAME, 'rb') as file:
+        content = pickle.load(file)
+    if content.get('version') != WAY_INDEX_VERSION:
+        return None
+    return content['way_index']
+
+
+def build_igraph(graph, highways, congestions, way_index=None, history=None, snapshot_time=None):
     """Given a graph and the information about highways and its congestions,
     imputs to every edge a  new attribute called itime.
     Itime would aproximately simulate the time it would take to go through
@@ -298,121 +706,1401 @@ def build_igraph(graph, highways, congestions):
     points that form each way.
     congestions: List that contains the way identifier, as well as the
     current level of traffic.
+    way_index: Dictionary returned by build_way_index. If it is not given it
+    is computed from the highways, which is much slower.
+    history: CongestionHistory. If it is given, the ways without live data
+    take their usual level at snapshot_time, and congestions can be None
+    when there is no live data at all.
+    snapshot_time: Unix time of the congestions, now if it is not given.
 
     Returns:
     ----------
     graph: Modified version of the original graph with a new attribute itime
-    set in most edges.
+    set in every edge.
     """
 
-    # Travel through all edges and imput them the average itime attribute
-    # supposing traffic level 2
-    for edge in graph.edges(data=True):
-        try:
-            edge[2]['itime'] =  edge[2]['length'] / (10 * float(edge[2]['maxspeed']) / 36)
-            edge[2]['itime'] = edge[2]['itime'] + congestion_time(2, edge[2]['itime'])
-        except:
-            pass
-    # For every street with traffic information, modifie the itime in order
-    # to be precise
-    for way in congestions:
-        density = way[1]
-        way_id = way[0]
-        coord = highways[way_id]
-        for i in range(0, len(coord)-3, 2):
-            # Get the neareest nodes to the coordinates of the points
-            origin_node = ox.distance.nearest_nodes(graph, coord[i], coord[i+1])
-            destination_node = ox.distance.nearest_nodes(graph, coord[i+2], coord[i+3])
-            try:
-                # Get the nodes that have to be visited to go from the origin
-                # to the destination
-                nodes = nx.shortest_path(graph, origin_node, destination_node, weight='length')
-                # Modify the itimes of the edges between these nodes taking
-                # into account the real congestion of these way.
-                add_itime(graph, nodes, density)
-            except:
-                # Nodes are not connected
-                pass
+    if way_index is None:
+        way_index = build_way_index(graph, highways)
+    if history is not None:
+        congestions = history.fill(congestions or [], time.time() if snapshot_time is None else snapshot_time)
+    # Compute all the itimes at once over the arrays of the edges
+    table = graph_arrays(graph, way_index)
+    set_itimes(graph, table, compute_itimes(table, congestions))
     return graph
 
 
-def get_shortest_path_with_itimes(igraph, origin_lat, origin_lon, destination="Sagrada Família"):
-    """Given the intelligent version of the graph, the coordinates of the
-    origin point and the name of the destination, determines the shortest
-    path between these two points.
+# Compact version of the igraph used to route. Nodes are renumbered from 0 to
+# n-1 and the edges leaving node i are targets[offsets[i]:offsets[i+1]],
+# with their itimes in the same positions of weights. hierarchy is the
+# customized contraction hierarchy of the weights, if any.
+Router = collections.namedtuple('Router', ['nodes', 'index', 'x', 'y', 'offsets', 'targets', 'weights', 'hierarchy'],
+                                defaults=[None])
+
+
+def build_router(igraph):
+    """Given the intelligent version of the graph, builds a compact routing
+    structure with the adjacency stored in CSR arrays.
 
     Parameters:
     ----------
     igraph: Intelligent version of the graph with edges that have the itime
     attribute.
-    origin_lat: Latitude of the origin point.
-    origin_lon: Longitude of the origin point.
-    destination: String with the name of the destination.
 
     Returns:
     ----------
-    route: List of nodes. The edges between them create the shortest path
-    taking into account traffic congestion.
+    router: Router with the nodes of the graph, a dictionary that maps every
+    node to its position, their coordinates, the CSR offsets and targets and
+    the itime of every edge. As in networkx, edges without itime weigh 1.
     """
 
-    # Add more information about the destination to ensure getting the proper
-    # coordinates
-    destination = destination + ",Barcelona,Catalonia"
-    # Get the coordinates of the destination
-    dest_lat, dest_lon = ox.geocode(destination)
-    # Search the nearest nodes to the origin and destination points
-    # in the osmnx graph
-    orig = ox.distance.nearest_nodes(igraph, origin_lon, origin_lat)
-    dest = ox.distance.nearest_nodes(igraph, dest_lon, dest_lat)
-    # Create the shortest path between the points
-    route = nx.shortest_path(igraph, orig, dest, weight='itime')
+    nodes = np.array(list(igraph.nodes), dtype=np.int64)
+    index = {node: i for i, node in enumerate(nodes.tolist())}
+    x = np.array([igraph.nodes[node]['x'] for node in nodes.tolist()], dtype=np.float64)
+    y = np.array([igraph.nodes[node]['y'] for node in nodes.tolist()], dtype=np.float64)
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    targets = []
+    weights = []
+    for i, node in enumerate(nodes.tolist()):
+        for neighbour, data in igraph[node].items():
+            targets.append(index[neighbour])
+            weights.append(data.get('itime', 1))
+        offsets[i+1] = len(targets)
+    return Router(nodes, index, x, y, offsets,
+                  np.array(targets, dtype=np.int32),
+                  np.array(weights, dtype=np.float64))
+
+
+def router_search(router, source, targets=(), max_itime=float('inf')):
+    """Given a router and the position of a node, runs Dijkstra's algorithm
+    over the CSR arrays from it. The search stops as soon as all the targets
+    are settled, or when the nodes left are further than max_itime.
+
+    Parameters:
+    ----------
+    router: Router returned by build_router.
+    source: Position of the origin node in the router.
+    targets: Positions of the nodes that have to be settled. If there are
+    none, the search goes on until max_itime.
+    max_itime: Maximum itime of the settled nodes.
+
+    Returns:
+    ----------
+    dist: Dictionary with the itime of every node settled or reached. Only
+    the values of the settled nodes are final. The rest are not in it.
+    pred: Dictionary with the position of the previous node in the path of
+    every node in dist, -1 for the source.
+    """
+
+    # Only the nodes reached are visited, so short routes are fast
+    offsets = cch.as_list(router.offsets)
+    adjacency = cch.as_list(router.targets)
+    weights = cch.as_list(router.weights)
+    targets_left = set(targets)
+    stop_at_targets = bool(targets_left)
+    inf = float('inf')
+    dist = {source: 0.0}
+    pred = {source: -1}
+    heap = [(0.0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            # Outdated entry of an already settled node
+            continue
+        if d > max_itime:
+            break
+        targets_left.discard(u)
+        if stop_at_targets and not targets_left:
+            break
+        for k in range(offsets[u], offsets[u+1]):
+            v = adjacency[k]
+            nd = d + weights[k]
+            if nd < dist.get(v, inf):
+                dist[v] = nd
+                pred[v] = u
+                heapq.heappush(heap, (nd, v))
+    return dist, pred
+
+
+def router_route(router, pred, target):
+    """Given a router, the predecessors found by router_search and the
+    position of a node, returns the path to the node going back from it."""
+
+    route = []
+    u = target
+    while u != -1:
+        route.append(int(router.nodes[u]))
+        u = pred[u]
+    route.reverse()
     return route
 
 
-def plot_path(igraph, ipath, SIZE):
-    """Given a graph, a size and a path, plots the map of that size with a
-    drawn path into a file. This path is the shortest one from the between the
-    first and the last point in the ipath.
+def router_shortest_path(router, orig, dest):
+    """Given a router and two nodes of the graph, finds the path with the
+    smallest itime between them using Dijkstra's algorithm over the CSR
+    arrays. The search stops as soon as the destination is settled.
 
     Parameters:
     ----------
-    igraph: Intelligent version of the graph with edges that have the itime
-    attribute.
-    ipath: List of nodes that form the shortest possible path between two
-    points taking into account the traffic.
-    SIZE: The size that the map will have.
+    router: Router returned by build_router. If it has a hierarchy, the
+    bidirectional upward search of the hierarchy is used instead.
+    orig: Identifier of the origin node.
+    dest: Identifier of the destination node.
 
     Returns:
     ----------
-    The image of the map as well as storing it in the file 'mapa.png'.
+    route: List of nodes from orig to dest with the same itime as the one
+    given by nx.shortest_path(igraph, orig, dest, weight='itime'). Both
+    paths are equal unless there are ties.
     """
 
-    m = StaticMap(SIZE, SIZE)
-    # Mark the origin and the destination nodes.
-    nix = igraph.nodes[ipath[0]]['x']
-    niy = igraph.nodes[ipath[0]]['y']
-    ndx = igraph.nodes[ipath[len(ipath)-1]]['x']
-    ndy = igraph.nodes[ipath[len(ipath)-1]]['y']
-    s_marker = CircleMarker((nix, niy), 'red', 8)
-    e_marker = CircleMarker((ndx, ndy), 'red', 8)
-    m.add_marker(s_marker)
-    m.add_marker(e_marker)
-    # Store the first node coordinates
-    ni = [nix, niy]
-    # For each node in ipath
-    for i in range(len(ipath)-1):
-        # Store the following node
-        nfx = igraph.nodes[ipath[i+1]]['x']
-        nfy = igraph.nodes[ipath[i+1]]['y']
-        nf = [nfx, nfy]
-        # Store the coordinates of both connected nodes
-        coordinates = [ni, nf]
-        # Plot a line simulating the edge between them
-        line = Line(coordinates, 'blue', 5)
-        m.add_line(line)
-        # Repeat the process for the next node
-        ni = nf
-    # Create and save the image in a file
-    image = m.render()
-    image.save('mapa.png')
-    return image
+    source = router.index[orig]
+    target = router.index[dest]
+    if router.hierarchy is not None:
+        path = cch.shortest_path(router.hierarchy, source, target)
+        if path is None:
+            raise nx.NetworkXNoPath("No path between %s and %s." % (orig, dest))
+        return router.nodes[path].tolist()
+    dist, pred = router_search(router, source, [target])
+    if target not in dist:
+        raise nx.NetworkXNoPath("No path between %s and %s." % (orig, dest))
+    return router_route(router, pred, target)
+
+
+def router_shortest_paths(router, orig, dests):
+    """Given a router, a node of the graph and several destination nodes,
+    finds the paths with the smallest itime from the node to all of them
+    with a single search, which stops once all of them are settled.
+
+    Parameters:
+    ----------
+    router: Router returned by build_router.
+    orig: Identifier of the origin node.
+    dests: List with the identifiers of the destination nodes.
+
+    Returns:
+    ----------
+    routes: List with the itime and the route to every destination, in the
+    same order, or None for the destinations that cannot be reached.
+    """
+
+    targets = [router.index[dest] for dest in dests]
+    dist, pred = router_search(router, router.index[orig], targets)
+    routes = []
+    for target in targets:
+        if target not in dist:
+            routes.append(None)
+        else:
+            routes.append((dist[target], router_route(router, pred, target)))
+    return routes
+
+
+def router_isochrone(router, orig, max_itime):
+    """Given a router, a node of the graph and an itime, finds all the nodes
+    that can be reached from the node within that itime.
+
+    Parameters:
+    ----------
+    router: Router returned by build_router.
+    orig: Identifier of the origin node.
+    max_itime: Maximum itime, in seconds.
+
+    Returns:
+    ----------
+    itimes: Dictionary with the reachable nodes and the itime to reach them.
+    """
+
+    dist, _ = router_search(router, router.index[orig], max_itime=max_itime)
+    return {int(router.nodes[i]): d for i, d in dist.items() if d <= max_itime}
+
+
+def build_hierarchy(router):
+    """Given a router, computes the part of its contraction hierarchy that
+    does not depend on the itimes. It only has to be computed once per graph
+    and then customized with customize_router for every set of itimes.
+
+    Parameters:
+    ----------
+    router: Router returned by build_router or snapshot_router.
+
+    Returns:
+    ----------
+    topology: cch.Topology of the graph of the router.
+    """
+
+    return cch.build(router.offsets, router.targets, router.x, router.y)
+
+
+def customize_router(router, topology):
+    """Given a router and the topology of its hierarchy, returns the router
+    with the hierarchy customized for its current itimes, so that
+    router_shortest_path uses it. Customizing is much faster than building
+    the topology, so it can be done every time the itimes change."""
+
+    return router._replace(hierarchy=cch.customize(topology, router.weights))
+
+
+def save_hierarchy(topology, router, HIERARCHY_DIRNAME):
+    """Given the topology of the hierarchy of a router, saves it as binary
+    arrays in a directory, one .npy file per array plus a header that
+    identifies the graph. The arrays can be memory-mapped by load_hierarchy.
+
+    Parameters:
+    ----------
+    topology: cch.Topology returned by build_hierarchy.
+    router: Router the topology was built from.
+    HIERARCHY_DIRNAME: name of the directory where the topology is stored.
+
+    Returns:
+    ----------
+    Nothing. Only saves the topology.
+    """
+
+    os.makedirs(HIERARCHY_DIRNAME, exist_ok=True)
+    header_filename = os.path.join(HIERARCHY_DIRNAME, 'header.json')
+    if os.path.exists(header_filename):
+        os.remove(header_filename)
+    for name, array in topology._asdict().items():
+        np.save(os.path.join(HIERARCHY_DIRNAME, name + '.npy'), array)
+    # The header is written last so that an interrupted save is not loaded
+    with open(header_filename, 'w') as file:
+        json.dump(hierarchy_header(router), file)
+
+
+def hierarchy_header(router):
+    """Given a router, returns the header that identifies the topology of
+    its hierarchy on disk."""
+
+    return {'version': HIERARCHY_VERSION, 'nodes': len(router.nodes), 'edges': len(router.targets),
+            'targets': zlib.crc32(np.ascontiguousarray(router.targets))}
+
+
+def load_hierarchy(HIERARCHY_DIRNAME, router):
+    """Given the name of a directory written by save_hierarchy and a router,
+    maps the topology of the hierarchy of the router in memory, so that
+    several processes loading it share the pages.
+
+    Parameters:
+    ----------
+    HIERARCHY_DIRNAME: name of the directory where the topology is stored.
+    router: Router returned by build_router or snapshot_router.
+
+    Returns:
+    ----------
+    topology: cch.Topology with read-only arrays, or None if there is no
+    topology or it was saved for another graph or version of the format.
+    """
+
+    header_filename = os.path.join(HIERARCHY_DIRNAME, 'header.json')
+    if not os.path.exists(header_filename):
+        return None
+    with open(header_filename) as file:
+        header = json.load(file)
+    if header != hierarchy_header(router):
+        return None
+    return cch.Topology(*[np.load(os.path.join(HIERARCHY_DIRNAME, name + '.npy'), mmap_mode='r')
+                          for name in cch.Topology._fields])
+
+
+# Arrays of a graph snapshot as stored on disk. The CSR adjacency is the same
+# as in Router and the edges of way way_ids[i] are the edge positions
+# way_edges[way_offsets[i]:way_offsets[i+1]]. The points of the geometry of
+# edge k between its two nodes are in geometry_x and geometry_y, from
+# geometry_offsets[k] to geometry_offsets[k+1].
+GraphSnapshot = collections.namedtuple('GraphSnapshot', [
+    'nodes', 'x', 'y', 'offsets', 'targets', 'length', 'maxspeed', 'itime',
+    'way_ids', 'way_offsets', 'way_edges', 'geometry_offsets', 'geometry_x', 'geometry_y'])
+
+
+def graph_arrays(graph, way_index):
+    """Given a graph and its way index, stores their information in columns,
+    one array per attribute. The edges are in the CSR order of Router.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona, with or without the itime attribute.
+    way_index: Dictionary returned by build_way_index.
+
+    Returns:
+    ----------
+    arrays: GraphSnapshot with the arrays of the graph. Edges without
+    maxspeed have the one of their highway class and edges without itime
+    have nan.
+    """
+
+    nodes = list(graph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    offsets = np.zeros(len(nodes) + 1, dtype=np.int64)
+    targets, length, maxspeed, itime = [], [], [], []
+    geometry_offsets, geometry = [0], []
+    positions = {}
+    for i, node in enumerate(nodes):
+        for neighbour, data in graph[node].items():
+            positions[(node, neighbour)] = len(targets)
+            targets.append(index[neighbour])
+            length.append(data['length'])
+            maxspeed.append(edge_maxspeed(data))
+            itime.append(data.get('itime', float('nan')))
+            # The nodes are stored apart
+            geometry.extend(edge_coordinates(graph, node, neighbour)[1:-1])
+            geometry_offsets.append(len(geometry))
+        offsets[i+1] = len(targets)
+    geometry = np.array(geometry, dtype=np.float64).reshape(-1, 2)
+    way_ids = sorted(way_index)
+    way_offsets = np.zeros(len(way_ids) + 1, dtype=np.int64)
+    way_edges = []
+    for i, way_id in enumerate(way_ids):
+        way_edges.extend(positions[edge] for edge in way_index[way_id])
+        way_offsets[i+1] = len(way_edges)
+    return GraphSnapshot(
+        np.array(nodes, dtype=np.int64),
+        np.array([graph.nodes[node]['x'] for node in nodes], dtype=np.float64),
+        np.array([graph.nodes[node]['y'] for node in nodes], dtype=np.float64),
+        offsets,
+        np.array(targets, dtype=np.int32),
+        np.array(length, dtype=np.float64),
+        np.array(maxspeed, dtype=np.float64),
+        np.array(itime, dtype=np.float64),
+        np.array(way_ids, dtype=np.int64),
+        way_offsets,
+        np.array(way_edges, dtype=np.int64),
+        np.array(geometry_offsets, dtype=np.int64),
+        geometry[:, 0].copy(),
+        geometry[:, 1].copy())
+
+
+def compute_itimes(arrays, congestions):
+    """Given the arrays of a graph and the congestions, computes the itime of
+    every edge in a single vectorized pass. Edges without traffic information
+    have a congestion of level 2 and, when several ways share an edge, the
+    last one in congestions wins, as in build_igraph.
+
+    Parameters:
+    ----------
+    arrays: GraphSnapshot, in memory or loaded with load_graph_snapshot.
+    congestions: List that contains the way identifier, as well as the
+    current level of traffic.
+
+    Returns:
+    ----------
+    itime: Array with the itime of every edge in CSR order, which can be used
+    as the weights of a Router.
+    """
+
+    density = edge_densities(arrays, congestions)
+    return edge_itimes(arrays, density)
+
+
+def edge_itimes(arrays, density, edges=slice(None)):
+    """Given the arrays of a graph and the level of congestion of some of
+    its edges, all of them by default, returns the itimes of those edges."""
+
+    # Time to cross the edges without traffic, converting km/h into m/s
+    usual_time = arrays.length[edges] / (10 * arrays.maxspeed[edges] / 36)
+    return usual_time * (1 + CONGESTION_FACTORS[density])
+
+
+def update_itimes(arrays, itime, old_congestions, new_congestions):
+    """Given the itimes computed with the old congestions, returns the
+    itimes of the new ones, recomputing only the edges of the ways whose
+    level has changed. The result is the same as compute_itimes with the new
+    congestions. The given itimes are not modified.
+
+    Parameters:
+    ----------
+    arrays: GraphSnapshot, in memory or loaded with load_graph_snapshot.
+    itime: Array returned by compute_itimes with old_congestions.
+    old_congestions: List with the way id number and its congestion used to
+    compute itime.
+    new_congestions: List with the way id number and its current congestion.
+
+    Returns:
+    ----------
+    itime: Array with the itime of every edge with the new congestions. It
+    is the given one if nothing has changed.
+    touched: Number of edges whose itime has been recomputed.
+    """
+
+    old = np.array(old_congestions, dtype=np.int64).reshape(-1, 2)
+    new = np.array(new_congestions, dtype=np.int64).reshape(-1, 2)
+    if not np.array_equal(old[:, 0], new[:, 0]):
+        # When several ways share an edge the last one wins, so a different
+        # order of the ways may change any edge
+        itime = compute_itimes(arrays, new_congestions)
+        return itime, len(itime)
+    changed = new[old[:, 1] != new[:, 1], 0]
+    edges = np.unique(way_edges(arrays, way_positions(arrays, changed)))
+    if len(edges) == 0:
+        return itime, 0
+    congested, densities = congested_edges(arrays, new_congestions)
+    # Edges of the changed ways without a level in the new congestions have
+    # an average one
+    density = np.full(len(edges), 2, dtype=np.int64)
+    known = np.isin(edges, congested)
+    density[known] = densities[np.searchsorted(congested, edges[known])]
+    itime = np.array(itime)
+    itime[edges] = edge_itimes(arrays, density, edges)
+    return itime, len(edges)
+
+
+def way_positions(arrays, way_ids):
+    """Given the arrays of a graph and some way identifiers, returns the
+    positions of the ways in the way index, or -1 for the ways that are not
+    in it."""
+
+    way_ids = np.asarray(way_ids, dtype=np.int64)
+    if len(arrays.way_ids) == 0:
+        return np.full(len(way_ids), -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(arrays.way_ids, way_ids), len(arrays.way_ids) - 1)
+    return np.where(arrays.way_ids[position] == way_ids, position, -1)
+
+
+def way_edges(arrays, positions):
+    """Given the arrays of a graph and the positions of some ways in the way
+    index, returns the edges of every way, in order. Positions of -1 have
+    no edges."""
+
+    positions = positions[positions >= 0]
+    starts = arrays.way_offsets[positions]
+    counts = arrays.way_offsets[positions + 1] - starts
+    # Positions in way_edges of the edges of every way, in order
+    first = np.cumsum(counts) - counts
+    return arrays.way_edges[np.repeat(starts - first, counts) + np.arange(counts.sum())]
+
+
+def congested_edges(arrays, congestions):
+    """Given the arrays of a graph and the congestions, returns the sorted
+    edges of the congested ways and the level of congestion of each. When
+    several ways share an edge, the last one in congestions wins."""
+
+    congestions = np.array(congestions, dtype=np.int64).reshape(-1, 2)
+    positions = way_positions(arrays, congestions[:, 0])
+    known = positions >= 0
+    densities = congestions[known, 1]
+    # Unknown levels are the same as no data
+    densities[(densities < 0) | (densities >= len(CONGESTION_FACTORS))] = 0
+    edges = way_edges(arrays, positions[known])
+    starts = arrays.way_offsets[positions[known]]
+    densities = np.repeat(densities, arrays.way_offsets[positions[known] + 1] - starts)
+    # Keep the last density of every edge
+    edges, last = np.unique(edges[::-1], return_index=True)
+    return edges, densities[::-1][last]
+
+
+def edge_densities(arrays, congestions, default=2):
+    """Given the arrays of a graph and the congestions, returns an array with
+    the level of congestion of every edge in CSR order. When several ways
+    share an edge, the last one in congestions wins. Edges without traffic
+    information have the default level."""
+
+    density = np.full(len(arrays.length), default, dtype=np.int64)
+    edges, densities = congested_edges(arrays, congestions)
+    density[edges] = densities
+    return density
+
+
+def set_itimes(graph, arrays, itime):
+    """Given a graph, its arrays and the itime of every edge in CSR order,
+    stores the itimes as attributes of the edges of the graph.
+
+    Parameters:
+    ----------
+    graph: Graph the arrays were built from.
+    arrays: GraphSnapshot of the graph.
+    itime: Array returned by compute_itimes.
+
+    Returns:
+    ----------
+    Nothing. Modifies the attribute itime of the edges in the graph.
+    """
+
+    nodes = arrays.nodes.tolist()
+    offsets = arrays.offsets.tolist()
+    targets = arrays.targets.tolist()
+    itime = itime.tolist()
+    for i, node in enumerate(nodes):
+        adjacency = graph[node]
+        for k in range(offsets[i], offsets[i+1]):
+            adjacency[nodes[targets[k]]]['itime'] = itime[k]
+
+
+def save_graph_snapshot(graph, way_index, SNAPSHOT_DIRNAME):
+    """Given a graph and its way index, saves them as binary arrays in a
+    directory, one .npy file per array plus a header with the version of the
+    format. The arrays can be memory-mapped by load_graph_snapshot.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona, with or without the itime attribute.
+    way_index: Dictionary returned by build_way_index.
+    SNAPSHOT_DIRNAME: name of the directory where the snapshot is stored.
+
+    Returns:
+    ----------
+    Nothing. Only saves the snapshot.
+    """
+
+    arrays = graph_arrays(graph, way_index)
+    os.makedirs(SNAPSHOT_DIRNAME, exist_ok=True)
+    for name, array in arrays._asdict().items():
+        np.save(os.path.join(SNAPSHOT_DIRNAME, name + '.npy'), array)
+    # The header is written last so that an interrupted save is not loaded
+    with open(os.path.join(SNAPSHOT_DIRNAME, 'header.json'), 'w') as file:
+        json.dump({'version': GRAPH_SNAPSHOT_VERSION, 'nodes': len(arrays.nodes),
+                   'edges': len(arrays.targets), 'ways': len(arrays.way_ids)}, file)
+
+
+def load_graph_snapshot(SNAPSHOT_DIRNAME):
+    """Given the name of a directory written by save_graph_snapshot, maps its
+    arrays in memory. Nothing is read until it is used, and several processes
+    loading the same snapshot share the pages.
+
+    Parameters:
+    ----------
+    SNAPSHOT_DIRNAME: name of the directory where the snapshot is stored.
+
+    Returns:
+    ----------
+    snapshot: GraphSnapshot with read-only arrays, or None if the snapshot
+    was written with another version of the format and has to be rebuilt.
+    """
+
+    with open(os.path.join(SNAPSHOT_DIRNAME, 'header.json')) as file:
+        header = json.load(file)
+    if header.get('version') != GRAPH_SNAPSHOT_VERSION:
+        return None
+    return GraphSnapshot(*[np.load(os.path.join(SNAPSHOT_DIRNAME, name + '.npy'), mmap_mode='r')
+                           for name in GraphSnapshot._fields])
+
+
+def snapshot_router(snapshot):
+    """Given a graph snapshot, builds its router without creating the
+    networkx graph. As in build_router, edges without itime weigh 1.
+
+    Parameters:
+    ----------
+    snapshot: GraphSnapshot returned by load_graph_snapshot.
+
+    Returns:
+    ----------
+    router: Router of the graph of the snapshot.
+    """
+
+    index = {node: i for i, node in enumerate(snapshot.nodes.tolist())}
+    weights = np.where(np.isnan(snapshot.itime), 1.0, snapshot.itime)
+    return Router(snapshot.nodes, index, snapshot.x, snapshot.y,
+                  snapshot.offsets, snapshot.targets, weights)
+
+
+def snapshot_graph(snapshot):
+    """Given a graph snapshot, rebuilds the networkx graph with the x and y
+    attributes of the nodes and the length, maxspeed and itime of the edges
+    when they are known. Edges whose geometry is not a straight line have it
+    as a list of (x, y) points in the geometry attribute.
+
+    Parameters:
+    ----------
+    snapshot: GraphSnapshot returned by load_graph_snapshot.
+
+    Returns:
+    ----------
+    graph: networkx DiGraph equivalent to the saved graph.
+    """
+
+    graph = nx.DiGraph()
+    nodes = snapshot.nodes.tolist()
+    graph.add_nodes_from((node, {'x': x, 'y': y})
+                         for node, x, y in zip(nodes, snapshot.x.tolist(), snapshot.y.tolist()))
+    offsets = snapshot.offsets.tolist()
+    targets = snapshot.targets.tolist()
+    length = snapshot.length.tolist()
+    maxspeed = snapshot.maxspeed.tolist()
+    itime = snapshot.itime.tolist()
+    x = snapshot.x.tolist()
+    y = snapshot.y.tolist()
+    geometry_offsets = snapshot.geometry_offsets.tolist()
+    geometry = list(zip(snapshot.geometry_x.tolist(), snapshot.geometry_y.tolist()))
+    for i, node in enumerate(nodes):
+        for k in range(offsets[i], offsets[i+1]):
+            data = {'length': length[k]}
+            # nan is the only value different from itself
+            if maxspeed[k] == maxspeed[k]:
+                data['maxspeed'] = maxspeed[k]
+            if itime[k] == itime[k]:
+                data['itime'] = itime[k]
+            j = targets[k]
+            if geometry_offsets[k+1] > geometry_offsets[k]:
+                data['geometry'] = ([(x[i], y[i])] + geometry[geometry_offsets[k]:geometry_offsets[k+1]]
+                                    + [(x[j], y[j])])
+            graph.add_edge(node, nodes[j], **data)
+    return graph
+
+
+# Arrays of a graph snapshot and the position of every node in them, which
+# the plotting functions can use instead of the networkx graph.
+SnapshotMap = collections.namedtuple('SnapshotMap', ['arrays', 'index'])
+
+
+def snapshot_map(snapshot, index=None):
+    """Given a graph snapshot, returns what plot_path, plot_paths and
+    plot_isochrone need to draw over its arrays, without creating the
+    networkx graph.
+
+    Parameters:
+    ----------
+    snapshot: GraphSnapshot returned by load_graph_snapshot.
+    index: Dictionary with the position of every node, such as the index of
+    the router of the snapshot. It is built if not given.
+
+    Returns:
+    ----------
+    SnapshotMap of the snapshot.
+    """
+
+    if index is None:
+        index = {node: i for i, node in enumerate(snapshot.nodes.tolist())}
+    return SnapshotMap(snapshot, index)
+
+
+def snapshot_way_index(snapshot):
+    """Given a graph snapshot, rebuilds the way index saved in it.
+
+    Parameters:
+    ----------
+    snapshot: GraphSnapshot returned by load_graph_snapshot.
+
+    Returns:
+    ----------
+    way_index: Dictionary with way identification numbers as keys and the
+    list of (u, v) edges of the graph that form the way as values.
+    """
+
+    nodes = snapshot.nodes.tolist()
+    # Origin node of every edge position
+    sources = np.repeat(np.arange(len(nodes)), np.diff(snapshot.offsets)).tolist()
+    targets = snapshot.targets.tolist()
+    way_offsets = snapshot.way_offsets.tolist()
+    way_edges = snapshot.way_edges.tolist()
+    way_index = {}
+    for i, way_id in enumerate(snapshot.way_ids.tolist()):
+        way_index[way_id] = [(nodes[sources[k]], nodes[targets[k]])
+                             for k in way_edges[way_offsets[i]:way_offsets[i+1]]]
+    return way_index
+
+
+class RouteCache:
+    """Bounded cache of results that depend on the congestions, such as
+    routes or rendered maps. Every entry belongs to an epoch (the identifier
+    of the congestions it was computed with, which must grow with every
+    update). Storing an entry of a newer epoch removes all the older ones.
+    Entries also expire after ttl seconds and the least recently used entry
+    is removed when the cache is full.
+
+    Parameters:
+    ----------
+    maxsize: Maximum number of entries.
+    ttl: Seconds an entry is valid.
+    """
+
+    def __init__(self, maxsize=1024, ttl=900):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.epoch = None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, epoch):
+        """Returns the value stored for key in the given epoch, or None if
+        there is none or it has expired."""
+
+        with self.lock:
+            entry = self.entries.get((epoch, key))
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((epoch, key))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, epoch, value):
+        """Stores value for key in the given epoch. Values of epochs older
+        than the newest one seen are not stored."""
+
+        with self.lock:
+            if self.epoch is not None and epoch < self.epoch:
+                return
+            if epoch != self.epoch:
+                # The congestions have changed
+                self.entries.clear()
+                self.epoch = epoch
+            self.entries[(epoch, key)] = (time.time(), value)
+            self.entries.move_to_end((epoch, key))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        """Returns the fraction of lookups that found a value."""
+
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class SingleFlight:
+    """Runs a function only once for concurrent calls with the same key.
+    Calls that arrive while it is running wait for it and get the same
+    result, or the same exception. Nothing is kept once it finishes, so it
+    is used in front of a RouteCache.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0  # Calls answered with the result of another one
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """Returns function(*args), or the result of the call with the same
+        key that is already running."""
+
+        with self.lock:
+            call = self.calls.get(key)
+            running = call is not None
+            if running:
+                self.shared += 1
+            else:
+                call = self.calls[key] = {'done': threading.Event(), 'value': None, 'error': None}
+        if running:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['value']
+        try:
+            call['value'] = function(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call['done'].set()
+        return call['value']
+
+
+# Generic words at the beginning of Barcelona street names. Places are also
+# indexed without them, so that "Mallorca" finds "Carrer de Mallorca".
+STREET_PREFIXES = ['carrer', 'avinguda', 'passeig', 'placa', 'rambla', 'ronda',
+                   'gran via', 'travessera', 'passatge', 'via', 'calle', 'avenida']
+STREET_ARTICLES = ['de', 'del', 'dels', 'de la', 'de les', "d'", "de l'", 'la', 'les', 'el', 'els', "l'"]
+
+
+def normalize_place(name):
+    """Given the name of a place, returns it in lowercase, without accents
+    and with single spaces, so that different spellings get the same key.
+
+    Parameters:
+    ----------
+    name: Name of the place.
+
+    Returns:
+    ----------
+    String with the normalized name.
+    """
+
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(name.replace(',', ' ').split())
+
+
+def strip_street_type(name):
+    """Given a normalized street name, removes the street type and the
+    article that follows it, e.g. 'carrer de la marina' gives 'marina'."""
+
+    for prefix in STREET_PREFIXES:
+        if name.startswith(prefix + ' '):
+            name = name[len(prefix) + 1:]
+            # Try the longest articles first
+            for article in sorted(STREET_ARTICLES, key=len, reverse=True):
+                if article.endswith("'") and name.startswith(article):
+                    return name[len(article):]
+                if name.startswith(article + ' '):
+                    return name[len(article) + 1:]
+            return name
+    return name
+
+
+def build_gazetteer(graph, places=None):
+    """Given an osmnx graph and optionally some points of interest, builds a
+    gazetteer with the names of its streets and the places. The position of
+    every street is the mean of the coordinates of the nodes of its edges.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph of Barcelona with the name attribute in the edges.
+    places: Dictionary with the names of points of interest as keys and
+    their (latitude, longitude) as values. Streets with the same name win.
+
+    Returns:
+    ----------
+    gazetteer: Dictionary with the names of the streets as keys and their
+    (latitude, longitude) as values.
+    """
+
+    points = collections.defaultdict(list)
+    for u, v, data in graph.edges(data=True):
+        names = data.get('name', [])
+        if isinstance(names, str):
+            names = [names]
+        for name in names:
+            points[name].append(u)
+            points[name].append(v)
+    gazetteer = dict(places or {})
+    for name, nodes in points.items():
+        lat = sum(graph.nodes[node]['y'] for node in nodes) / len(nodes)
+        lon = sum(graph.nodes[node]['x'] for node in nodes) / len(nodes)
+        gazetteer[name] = (lat, lon)
+    return gazetteer
+
+
+def save_gazetteer(gazetteer, GAZETTEER_FILENAME):
+    """ Given a gazetteer and the name of a file, saves it as a csv file with
+    the name, latitude and longitude of every place. More places can be
+    added to the file by hand.
+
+    Parameters:
+    ----------
+    gazetteer: Dictionary with names of places as keys and their
+    (latitude, longitude) as values.
+    GAZETTEER_FILENAME: name of the file where the gazetteer is stored.
+
+    Returns:
+    ----------
+    Nothing. Only saves the gazetteer.
+    """
+
+    with open(GAZETTEER_FILENAME, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file, delimiter=',', quotechar='"')
+        writer.writerow(['name', 'lat', 'lon'])
+        for name, (lat, lon) in sorted(gazetteer.items()):
+            writer.writerow([name, lat, lon])
+
+
+def load_gazetteer(GAZETTEER_FILENAME):
+    """ Given the name of a csv file written by save_gazetteer, loads the
+    gazetteer stored in it.
+
+    Parameters:
+    ----------
+    GAZETTEER_FILENAME: name of the file where the gazetteer is stored.
+
+    Returns:
+    ----------
+    gazetteer: Dictionary with names of places as keys and their
+    (latitude, longitude) as values.
+    """
+
+    with open(GAZETTEER_FILENAME, newline='', encoding='utf-8') as file:
+        reader = csv.reader(file, delimiter=',', quotechar='"')
+        next(reader)
+        return {name: (float(lat), float(lon)) for name, lat, lon in reader}
+
+
+class Geocoder:
+    """Finds the coordinates of places of Barcelona. Places are searched
+    first in a cache of previous answers, then in a local gazetteer by exact
+    name, prefix or similar name, and only when none of them matches with
+    the remote geocoder of osmnx. Names are normalized, so case, accents and
+    spaces do not matter.
+
+    Parameters:
+    ----------
+    gazetteer: Dictionary with names of places as keys and their
+    (latitude, longitude) as values.
+    CACHE_FILENAME: name of a json file where the answers of the remote
+    geocoder are kept between runs. If it is None they are kept in memory.
+    """
+
+    def __init__(self, gazetteer=None, CACHE_FILENAME=None):
+        self.places = {}
+        for name, position in (gazetteer or {}).items():
+            key = normalize_place(name)
+            self.places[key] = position
+            # The full name wins over the short version of another street
+            self.places.setdefault(strip_street_type(key), position)
+        self.names = sorted(self.places)
+        self.cache_filename = CACHE_FILENAME
+        self.cache = {}
+        if CACHE_FILENAME is not None and os.path.exists(CACHE_FILENAME):
+            with open(CACHE_FILENAME, encoding='utf-8') as file:
+                self.cache = {key: tuple(position) for key, position in json.load(file).items()}
+        self.lock = threading.Lock()
+
+    def lookup(self, place):
+        """Returns the (latitude, longitude) of a place without using the
+        network, or None if it is not in the cache or the gazetteer."""
+
+        key = normalize_place(place)
+        if key in self.cache:
+            return self.cache[key]
+        if key in self.places:
+            return self.places[key]
+        # The shortest name that starts with the given one
+        i = bisect.bisect_left(self.names, key)
+        matches = []
+        while key and i < len(self.names) and self.names[i].startswith(key):
+            matches.append(self.names[i])
+            i += 1
+        if matches:
+            return self.places[min(matches, key=len)]
+        matches = difflib.get_close_matches(key, self.names, n=1, cutoff=0.85)
+        if matches:
+            return self.places[matches[0]]
+        return None
+
+    def geocode(self, place):
+        """Returns the (latitude, longitude) of a place of Barcelona, asking
+        the remote geocoder only if it cannot be found locally."""
+
+        position = self.lookup(place)
+        if position is not None:
+            return position
+        # osmnx is slow to import, so it is only imported when needed
+        import osmnx as ox
+        # Add more information about the place to ensure getting the proper
+        # coordinates
+        position = tuple(ox.geocode(place + ",Barcelona,Catalonia"))
+        with self.lock:
+            self.cache[normalize_place(place)] = position
+            if self.cache_filename is not None:
+                with open(self.cache_filename, 'w', encoding='utf-8') as file:
+                    json.dump(self.cache, file)
+        return position
+
+
+def find_destination_nodes(igraph, origin_lat, origin_lon, destinations, node_index=None, geocoder=None):
+    """Given a graph, the coordinates of the origin point and the names of
+    several destinations, finds the nodes of the graph where the routes start
+    and end. All the points are snapped in a single batch.
+
+    Parameters:
+    ----------
+    igraph: Osmnx graph of Barcelona.
+    origin_lat: Latitude of the origin point.
+    origin_lon: Longitude of the origin point.
+    destinations: List of strings with the names of the destinations.
+    node_index: NodeIndex of igraph. It is built if it is not given.
+    geocoder: Geocoder used to find the destinations. If it is not given the
+    remote geocoder of osmnx is used.
+
+    Returns:
+    ----------
+    orig: Nearest node to the origin.
+    dests: List with the nearest node to every destination.
+    """
+
+    # Get the coordinates of the destinations
+    if geocoder is None:
+        geocoder = Geocoder()
+    positions = [geocoder.geocode(destination) for destination in destinations]
+    # Search the nearest nodes to the origin and destination points
+    # in the osmnx graph
+    if node_index is None:
+        node_index = build_node_index(igraph)
+    X = [origin_lon] + [lon for _, lon in positions]
+    Y = [origin_lat] + [lat for lat, _ in positions]
+    nodes = nearest_nodes(node_index, X, Y).tolist()
+    return nodes[0], nodes[1:]
+
+
+def find_route_nodes(igraph, origin_lat, origin_lon, destination, node_index=None, geocoder=None):
+    """Given a graph, the coordinates of the origin point and the name of the
+    destination, finds the nodes of the graph where the route starts and
+    ends.
+
+    Parameters:
+    ----------
+    igraph: Osmnx graph of Barcelona.
+    origin_lat: Latitude of the origin point.
+    origin_lon: Longitude of the origin point.
+    destination: String with the name of the destination.
+    node_index: NodeIndex of igraph. It is built if it is not given.
+    geocoder: Geocoder used to find the destination. If it is not given the
+    remote geocoder of osmnx is used.
+
+    Returns:
+    ----------
+    orig, dest: Nearest nodes to the origin and to the destination.
+    """
+
+    orig, dests = find_destination_nodes(igraph, origin_lat, origin_lon, [destination], node_index, geocoder)
+    return orig, dests[0]
+
+
+def get_shortest_path_with_itimes(igraph, origin_lat, origin_lon, destination="Sagrada Família", router=None, node_index=None, cache=None, epoch=None, geocoder=None):
+    """Given the intelligent version of the graph, the coordinates of the
+    origin point and the name of the destination, determines the shortest
+    path between these two points.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute.
+    origin_lat: Latitude of the origin point.
+    origin_lon: Longitude of the origin point.
+    destination: String with the name of the destination.
+    router: Router built from igraph with build_router. If it is given the
+    path is computed with it instead of networkx.
+    node_index: NodeIndex of igraph. It is built if it is not given.
+    cache: RouteCache where the routes between pairs of nodes are stored.
+    epoch: Identifier of the congestions used to build igraph. Required if
+    cache is given.
+    geocoder: Geocoder used to find the destination. If it is not given the
+    remote geocoder of osmnx is used.
+
+    Returns:
+    ----------
+    route: List of nodes. The edges between them create the shortest path
+    taking into account traffic congestion.
+    """
+
+    orig, dest = find_route_nodes(igraph, origin_lat, origin_lon, destination, node_index, geocoder)
+    if cache is not None:
+        route = cache.get((orig, dest), epoch)
+        if route is not None:
+            return route
+    # Create the shortest path between the points
+    if router is not None:
+        route = router_shortest_path(router, orig, dest)
+    else:
+        route = nx.shortest_path(igraph, orig, dest, weight='itime')
+    if cache is not None:
+        cache.put((orig, dest), epoch, route)
+    return route
+
+
+def get_shortest_paths_with_itimes(igraph, origin_lat, origin_lon, destinations, router=None, node_index=None, geocoder=None):
+    """Given the intelligent version of the graph, the coordinates of the
+    origin point and the names of several destinations, determines the
+    shortest paths from the origin to all of them with a single search.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute.
+    origin_lat: Latitude of the origin point.
+    origin_lon: Longitude of the origin point.
+    destinations: List of strings with the names of the destinations.
+    router: Router built from igraph with build_router. If it is given the
+    paths are computed with it instead of networkx.
+    node_index: NodeIndex of igraph. It is built if it is not given.
+    geocoder: Geocoder used to find the destinations. If it is not given the
+    remote geocoder of osmnx is used.
+
+    Returns:
+    ----------
+    routes: List with the itime and the route to every destination, in the
+    same order, or None for the destinations that cannot be reached.
+    """
+
+    orig, dests = find_destination_nodes(igraph, origin_lat, origin_lon, destinations, node_index, geocoder)
+    if router is not None:
+        return router_shortest_paths(router, orig, dests)
+    itimes, paths = nx.single_source_dijkstra(igraph, orig, weight='itime')
+    return [(itimes[dest], paths[dest]) if dest in paths else None for dest in dests]
+
+
+def plot_path(igraph, ipath, SIZE, filename=None):
+    """Given a graph, a size and a path, plots the map of that size with a
+    drawn path. This path is the shortest one from the between the
+    first and the last point in the ipath. It is drawn as a single line
+    that follows the geometry of the streets, without the points that
+    cannot be seen at the zoom of the map.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute, or SnapshotMap returned by snapshot_map.
+    ipath: List of nodes that form the shortest possible path between two
+    points taking into account the traffic.
+    SIZE: The size that the map will have.
+    filename: Name of a file where the image is also stored, if any.
+
+    Returns:
+    ----------
+    The image of the map.
+    """
+
+    m = tiles.static_map(SIZE, SIZE)
+    # Mark the origin and the destination nodes.
+    s_marker = CircleMarker(node_coordinates(igraph, ipath[0]), 'red', 8)
+    e_marker = CircleMarker(node_coordinates(igraph, ipath[len(ipath)-1]), 'red', 8)
+    m.add_marker(s_marker)
+    m.add_marker(e_marker)
+    # Draw the whole path as a single line that follows the streets
+    if len(ipath) > 1:
+        m.add_line(Line(path_coordinates(igraph, ipath), 'blue', 5))
+    # Keep only the points that can be seen at the zoom of the map
+    zoom = tiles.simplify_lines(m)
+    # Create the image and save it if asked
+    image = m.render(zoom)
+    if filename is not None:
+        image.save(filename)
+    return image
+
+
+def edge_coordinates(graph, u, v):
+    """Given a graph and an edge, returns the (x, y) points of the edge from
+    u to v, following its geometry when it is not a straight line.
+
+    Parameters:
+    ----------
+    graph: Osmnx graph, where the geometry of an edge is a LineString,
+    graph rebuilt by snapshot_graph, where it is a list of points, or
+    SnapshotMap returned by snapshot_map.
+    u, v: Nodes of the edge.
+
+    Returns:
+    ----------
+    List of (x, y) pairs from the position of u to the position of v.
+    """
+
+    if isinstance(graph, SnapshotMap):
+        arrays = graph.arrays
+        i, j = graph.index[u], graph.index[v]
+        k = arrays.offsets[i] + int(np.flatnonzero(arrays.targets[arrays.offsets[i]:arrays.offsets[i+1]] == j)[0])
+        # The geometry of the edge is stored between its two nodes
+        start, end = arrays.geometry_offsets[k], arrays.geometry_offsets[k+1]
+        return ([node_coordinates(graph, u)]
+                + list(zip(arrays.geometry_x[start:end].tolist(), arrays.geometry_y[start:end].tolist()))
+                + [node_coordinates(graph, v)])
+    start = (graph.nodes[u]['x'], graph.nodes[u]['y'])
+    end = (graph.nodes[v]['x'], graph.nodes[v]['y'])
+    geometry = graph[u][v].get('geometry')
+    if geometry is None:
+        return [start, end]
+    if hasattr(geometry, 'coords'):
+        geometry = geometry.coords
+    coordinates = [tuple(point) for point in geometry]
+    # Make sure that the geometry goes from u to v
+    first, last = coordinates[0], coordinates[-1]
+    if (first[0] - start[0])**2 + (first[1] - start[1])**2 > (last[0] - start[0])**2 + (last[1] - start[1])**2:
+        coordinates.reverse()
+    return coordinates
+
+
+def node_coordinates(igraph, node):
+    """Given a graph or a SnapshotMap and a node, returns its (x, y)
+    point."""
+
+    if isinstance(igraph, SnapshotMap):
+        i = igraph.index[node]
+        return (float(igraph.arrays.x[i]), float(igraph.arrays.y[i]))
+    return (igraph.nodes[node]['x'], igraph.nodes[node]['y'])
+
+
+def path_coordinates(igraph, ipath):
+    """Given a graph or a SnapshotMap and a path, returns the (x, y) points
+    of the whole path as a single polyline that follows the geometry of its
+    edges."""
+
+    coordinates = [node_coordinates(igraph, ipath[0])]
+    for u, v in zip(ipath[:-1], ipath[1:]):
+        # The first point is the last one of the previous edge
+        coordinates.extend(edge_coordinates(igraph, u, v)[1:])
+    return coordinates
+
+
+def graph_edges(igraph, nodes):
+    """Given a graph or a SnapshotMap and some nodes, returns the (u, v)
+    edges that leave them."""
+
+    if not isinstance(igraph, SnapshotMap):
+        return igraph.edges(nodes)
+    arrays = igraph.arrays
+    edges = []
+    for u in nodes:
+        i = igraph.index[u]
+        edges.extend((u, v) for v in arrays.nodes[arrays.targets[arrays.offsets[i]:arrays.offsets[i+1]]].tolist())
+    return edges
+
+
+# Colors of the paths drawn on the same map
+PATH_COLORS = ['blue', 'green', 'orange', 'purple', 'brown', 'magenta', 'cyan', 'black']
+# Colors of the parts of an isochrone, from the closest nodes to the furthest
+ISOCHRONE_COLORS = ['green', 'yellow', 'orange', 'red']
+# Color of every level of congestion, from no data to a cut street
+CONGESTION_COLORS = ['white', 'green', 'yellow', 'purple', 'orange', 'red', 'black']
+
+
+def plot_paths(igraph, ipaths, SIZE, filename=None):
+    """Given a graph, a size and several paths from the same origin, plots
+    the map of that size with every path drawn in a different color.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute, or SnapshotMap returned by snapshot_map.
+    ipaths: List of paths, as lists of nodes. The color of path i is
+    PATH_COLORS[i] (repeated if there are more paths than colors).
+    SIZE: The size that the map will have.
+    filename: Name of a file where the image is also stored, if any.
+
+    Returns:
+    ----------
+    The image of the map.
+    """
+
+    m = tiles.static_map(SIZE, SIZE)
+    for i, ipath in enumerate(ipaths):
+        color = PATH_COLORS[i % len(PATH_COLORS)]
+        coordinates = path_coordinates(igraph, ipath)
+        # A path of a single node has no line
+        if len(coordinates) > 1:
+            m.add_line(Line(coordinates, color, 5))
+        m.add_marker(CircleMarker(coordinates[-1], color, 12))
+    # Mark the origin on top of everything
+    m.add_marker(CircleMarker(node_coordinates(igraph, ipaths[0][0]), 'red', 8))
+    image = m.render(tiles.simplify_lines(m))
+    if filename is not None:
+        image.save(filename)
+    return image
+
+
+def plot_isochrone(igraph, itimes, max_itime, SIZE, filename=None):
+    """Given a graph and the itimes to the nodes reachable from a point,
+    plots the map of the given size with the edges between reachable nodes
+    colored by the itime needed to reach them. The edges follow the
+    geometry of the streets and are drawn in a batch per color, as in
+    plot_traffic.
+
+    Parameters:
+    ----------
+    igraph: Intelligent version of the graph with edges that have the itime
+    attribute, or SnapshotMap returned by snapshot_map.
+    itimes: Dictionary returned by router_isochrone.
+    max_itime: Maximum itime of the isochrone, split in as many parts as
+    ISOCHRONE_COLORS.
+    SIZE: The size that the map will have.
+    filename: Name of a file where the image is also stored, if any.
+
+    Returns:
+    ----------
+    The image of the map.
+    """
+
+    parts = len(ISOCHRONE_COLORS)
+    # Points of the edges of every part
+    lines = [[] for _ in range(parts)]
+    drawn = set()
+    for u, v in graph_edges(igraph, itimes):
+        # Both directions of a street are drawn once
+        if v in itimes and (v, u) not in drawn:
+            drawn.add((u, v))
+            part = min(parts - 1, int(parts * max(itimes[u], itimes[v]) / max_itime))
+            lines[part].append(edge_coordinates(igraph, u, v))
+    # Mark the origin, the only node with itime 0
+    origin = node_coordinates(igraph, min(itimes, key=itimes.get))
+    batches = []
+    x, y = [origin[0]], [origin[1]]
+    for color, part in zip(ISOCHRONE_COLORS, lines):
+        if part:
+            points = np.array([point for line in part for point in line])
+            offsets = np.zeros(len(part) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(line) for line in part])
+            batches.append((color, points[:, 0], points[:, 1], offsets))
+            x.extend((points[:, 0].min(), points[:, 0].max()))
+            y.extend((points[:, 1].min(), points[:, 1].max()))
+    # The map shows the whole isochrone, as staticmap would with its lines
+    bbox = (min(x), min(y), max(x), max(y))
+    zoom = min(tiles.bbox_zoom(bbox, SIZE, SIZE), 17)
+    m = tiles.static_map(SIZE, SIZE)
+    image = m.render(zoom=zoom, center=((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2))
+    tiles.draw_polylines(m, image, batches, markers=[CircleMarker(origin, 'red', 12)])
+    if filename is not None:
+        image.save(filename)
+    return image
+
+
+def plot_traffic(arrays, congestions, SIZE, center=None, zoom=None, filename=None):
+    """Given the arrays of a graph and the congestions, plots the map of the
+    given size with the streets that have traffic information colored by
+    their level of congestion. Streets are drawn in a batch per level, over
+    the arrays, instead of as a Line each.
+
+    Parameters:
+    ----------
+    arrays: GraphSnapshot, in memory or loaded with load_graph_snapshot.
+    congestions: List that contains the way identifier, as well as the
+    current level of traffic.
+    SIZE: The size that the map will have.
+    center: (longitude, latitude) of the center of the map, or None for the
+    whole of Barcelona.
+    zoom: Zoom level of the map, when the center is given.
+    filename: Name of a file where the image is also stored, if any.
+
+    Returns:
+    ----------
+    The image of the map.
+    """
+
+    if center is None:
+        min_lon, min_lat, max_lon, max_lat = tiles.BARCELONA_BBOX
+        center = ((min_lon + max_lon) / 2, (min_lat + max_lat) / 2)
+        zoom = tiles.bbox_zoom(tiles.BARCELONA_BBOX, SIZE, SIZE)
+    density = edge_densities(arrays, congestions, default=0)
+    sources = np.repeat(np.arange(len(arrays.x)), np.diff(arrays.offsets))
+    targets = arrays.targets.astype(np.int64)
+    inner = np.diff(arrays.geometry_offsets)
+    batches = []
+    for level, color in enumerate(CONGESTION_COLORS):
+        edges = np.flatnonzero(density == level)
+        if level == 0 or len(edges) == 0:
+            # Streets without information are not drawn
+            continue
+        # Both directions of a street with the same level are drawn once
+        pairs = sources[edges] * len(arrays.x) + targets[edges]
+        reverse = targets[edges] * len(arrays.x) + sources[edges]
+        edges = edges[~(np.isin(reverse, pairs) & (sources[edges] > targets[edges]))]
+        # Every edge is its first node, the points of its geometry and its
+        # last node
+        counts = inner[edges] + 2
+        offsets = np.zeros(len(edges) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        x = np.empty(offsets[-1])
+        y = np.empty(offsets[-1])
+        x[offsets[:-1]], y[offsets[:-1]] = arrays.x[sources[edges]], arrays.y[sources[edges]]
+        x[offsets[1:] - 1], y[offsets[1:] - 1] = arrays.x[targets[edges]], arrays.y[targets[edges]]
+        points = inner[edges]
+        step = np.arange(points.sum()) - np.repeat(np.cumsum(points) - points, points)
+        x[np.repeat(offsets[:-1] + 1, points) + step] = arrays.geometry_x[np.repeat(arrays.geometry_offsets[edges], points) + step]
+        y[np.repeat(offsets[:-1] + 1, points) + step] = arrays.geometry_y[np.repeat(arrays.geometry_offsets[edges], points) + step]
+        batches.append((color, x, y, offsets))
+    m = tiles.static_map(SIZE, SIZE)
+    image = m.render(zoom=zoom, center=center)
+    tiles.draw_polylines(m, image, batches)
+    if filename is not None:
+        image.save(filename)
+    return image
+
+
+def image_bytes(image, FORMAT='PNG', **options):
+    """Given an image, encodes it in memory so that it can be sent without
+    writing any file.
+
+    Parameters:
+    ----------
+    image: PIL image, such as the ones returned by plot_path.
+    FORMAT: Image format, such as 'PNG' or 'JPEG'.
+    options: Options of the encoder of PIL, such as compress_level for PNG
+    (0 to 9) or quality for JPEG (1 to 95).
+
+    Returns:
+    ----------
+    Bytes with the encoded image.
+    """
+
+    if FORMAT == 'JPEG':
+        # JPEG has no transparency
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, FORMAT, **options)
+    return buffer.getvalue()
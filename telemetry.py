@@ -0,0 +1,229 @@
+import os
+import time
+import random
+import logging
+import threading
+import contextlib
+import cProfile
+import http.server
+
+logger = logging.getLogger('igo')
+
+# Upper bounds in seconds of the buckets of the latency histograms
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Distribution of some values in cumulative buckets, as Prometheus
+    histograms.
+
+    Parameters:
+    ----------
+    buckets: Sorted upper bounds of the buckets.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Adds a value to the histogram."""
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels):
+    """Given a tuple of (name, value) pairs, returns them as Prometheus
+    labels, such as {stage="route"}."""
+
+    if not labels:
+        return ''
+    values = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+    return '{' + ','.join(values) + '}'
+
+
+class Telemetry:
+    """Latency histograms, counters and gauges of the bot, exposed as text
+    in the Prometheus format. Requests are timed stage by stage with the
+    traces returned by request, and a sample of them can be profiled.
+
+    Parameters:
+    ----------
+    slow_seconds: Requests that take longer are logged with their stages.
+    profile_rate: Fraction of the requests that are profiled with cProfile.
+    The profile of a profiled request is stored only if it is slow.
+    PROFILE_DIRNAME: Name of the directory where the profiles are stored.
+    """
+
+    def __init__(self, slow_seconds=2.0, profile_rate=0.0, PROFILE_DIRNAME='profiles'):
+        self.slow_seconds = slow_seconds
+        self.profile_rate = profile_rate
+        self.profile_dirname = PROFILE_DIRNAME
+        # Only one request is profiled at a time
+        self.profiling = threading.Lock()
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.help = {}
+
+    def observe(self, name, labels, value):
+        """Adds a value to the histogram with the given name and labels."""
+
+        with self.lock:
+            key = (name, tuple(labels))
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, labels, value=1):
+        """Adds a value to the counter with the given name and labels."""
+
+        with self.lock:
+            key = (name, tuple(labels))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, function, help=''):
+        """Registers a gauge whose value is returned by function when the
+        metrics are read."""
+
+        self.gauges[name] = function
+        self.help[name] = help
+
+    def request(self, command):
+        """Returns the trace of a new request of the given command, to be
+        used as a context manager."""
+
+        return RequestTrace(self, command)
+
+    def render(self):
+        """Returns all the metrics as text in the Prometheus format."""
+
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+            current = None
+            for (name, labels), histogram in histograms:
+                if name != current:
+                    lines.append('# TYPE %s histogram' % name)
+                    current = name
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', bound),)), count))
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), histogram.count))
+                lines.append('%s_sum%s %f' % (name, format_labels(labels), histogram.sum))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), histogram.count))
+            for (name, labels), value in counters:
+                if name != current:
+                    lines.append('# TYPE %s counter' % name)
+                    current = name
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+        for name, function in sorted(self.gauges.items()):
+            try:
+                value = float(function())
+            except Exception:
+                # A gauge that cannot be computed yet, such as the age of a
+                # snapshot that does not exist
+                continue
+            if self.help[name]:
+                lines.append('# HELP %s %s' % (name, self.help[name]))
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %f' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Starts a thread with an HTTP server that answers GET /metrics with
+        the metrics. Returns the server."""
+
+        telemetry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = telemetry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are too frequent to be logged
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class RequestTrace:
+    """Times the stages of a request. Used as a context manager around the
+    whole request, with a span around every stage. The stage where the
+    request failed is kept in stage so that the error can be explained.
+
+    Parameters:
+    ----------
+    telemetry: Telemetry where the times are recorded.
+    command: Name of the command of the request.
+    """
+
+    def __init__(self, telemetry, command):
+        self.telemetry = telemetry
+        self.command = command
+        self.stage = None
+        self.spans = []
+        self.profile = None
+
+    def __enter__(self):
+        if self.telemetry.profile_rate > 0 and random.random() < self.telemetry.profile_rate:
+            if self.telemetry.profiling.acquire(blocking=False):
+                self.profile = cProfile.Profile()
+                self.profile.enable()
+        self.start = time.perf_counter()
+        return self
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Times a stage of the request. If it raises an exception, it is
+        counted as an error of the stage."""
+
+        self.stage = stage
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.telemetry.increment('igo_stage_errors_total', (('command', self.command), ('stage', stage),
+                                                                ('error', type(e).__name__)))
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.spans.append((stage, seconds))
+            self.telemetry.observe('igo_stage_seconds', (('command', self.command), ('stage', stage)), seconds)
+
+    def __exit__(self, exception_type, exception, traceback):
+        seconds = time.perf_counter() - self.start
+        outcome = 'ok' if exception_type is None else 'error'
+        self.telemetry.observe('igo_request_seconds', (('command', self.command),), seconds)
+        self.telemetry.increment('igo_requests_total', (('command', self.command), ('outcome', outcome)))
+        slow = seconds > self.telemetry.slow_seconds
+        if slow:
+            logger.warning("Slow /%s: %.3f s (%s)", self.command, seconds,
+                           ', '.join('%s %.3f s' % span for span in self.spans))
+        if self.profile is not None:
+            self.profile.disable()
+            if slow:
+                os.makedirs(self.telemetry.profile_dirname, exist_ok=True)
+                filename = os.path.join(self.telemetry.profile_dirname, '%d-%s.prof' % (int(1000 * time.time()), self.command))
+                self.profile.dump_stats(filename)
+                self.telemetry.increment('igo_profiles_total', (('command', self.command),))
+            self.telemetry.profiling.release()
+        # Exceptions are not handled here
+        return False
@@ -0,0 +1,58 @@
+import os
+import pytest
+
+pytest.importorskip('osmium')
+pytest.importorskip('osmnx')
+import build
+
+# Small OSM extract with streets and points of interest. osmium reads the
+# XML format as the .osm.pbf one.
+FIXTURE_FILENAME = os.path.join(os.path.dirname(__file__), 'fixture.osm')
+FIXTURE_BBOX = (2.09, 41.37, 2.19, 41.41)
+
+
+def meters(*points):
+    """Returns the length in meters of a polyline of (x, y) points."""
+
+    x, y = zip(*points)
+    return float(build.great_circle(x[:-1], y[:-1], x[1:], y[1:]).sum())
+
+
+@pytest.fixture(scope='module')
+def graph():
+    return build.graph_from_pbf(FIXTURE_FILENAME, FIXTURE_BBOX)
+
+
+def test_nodes_where_streets_meet_or_end(graph):
+    # 2 and 5 are in the middle of a street, 8 is only in a footway, 20 and
+    # 21 are not connected to the rest and 30 is out of the area
+    assert sorted(graph) == [1, 3, 4, 6, 7, 9]
+    assert (graph.nodes[3]['x'], graph.nodes[3]['y']) == (2.102, 41.38)
+
+
+def test_merged_streets(graph):
+    data = graph[1][3]
+    assert data['geometry'] == [(2.100, 41.38), (2.101, 41.38), (2.102, 41.38)]
+    assert data['length'] == pytest.approx(meters(*data['geometry']))
+    assert data['name'] == 'Carrer de Prova' and data['osmid'] == 100
+    assert graph[3][1]['geometry'] == data['geometry'][::-1]
+    assert graph[3][4]['length'] == pytest.approx(meters((2.102, 41.38), (2.103, 41.38)))
+    assert 'geometry' not in graph[3][4]
+
+
+def test_oneway_streets(graph):
+    assert graph.has_edge(3, 6) and not graph.has_edge(6, 3)
+    assert graph[3][6]['maxspeed'] == '50' and graph[3][6]['oneway']
+    assert graph[3][6]['length'] == pytest.approx(meters((2.102, 41.38), (2.102, 41.382)))
+    # oneway=-1 goes against the order of the nodes
+    assert graph.has_edge(7, 6) and not graph.has_edge(6, 7)
+    assert 'maxspeed' not in graph[7][6]
+    assert graph.has_edge(1, 3) and not graph[1][3]['oneway']
+
+
+def test_streets_are_cut_at_the_area(graph):
+    assert graph.has_edge(4, 9) and graph.has_edge(9, 4)
+    whole = build.graph_from_pbf(FIXTURE_FILENAME)
+    # Without the area 9 is in the middle of the street that ends at 30
+    assert 9 not in whole and whole.has_edge(4, 30)
+    assert whole[4][30]['length'] == pytest.approx(meters((2.103, 41.38), (2.104, 41.381), (2.2, 41.381)))
@@ -0,0 +1,126 @@
+import time
+import threading
+import pytest
+import igo
+
+
+class Clock:
+    """Replaces time.time in igo, so that entries expire on demand."""
+
+    def __init__(self, monkeypatch):
+        self.now = 1000.0
+        monkeypatch.setattr(igo.time, 'time', lambda: self.now)
+
+
+def test_route_cache_hits_and_misses():
+    cache = igo.RouteCache(maxsize=4, ttl=60)
+    assert cache.get((1, 2), 10) is None
+    cache.put((1, 2), 10, [1, 5, 2])
+    assert cache.get((1, 2), 10) == [1, 5, 2]
+    assert cache.get((2, 1), 10) is None
+    assert cache.hit_rate() == pytest.approx(1 / 3)
+
+
+def test_route_cache_new_epoch_clears_older_entries():
+    cache = igo.RouteCache(maxsize=4, ttl=60)
+    cache.put('a', 10, 'old')
+    cache.put('b', 11, 'new')
+    assert cache.get('a', 10) is None
+    assert cache.get('b', 11) == 'new'
+    # Values computed with older congestions are not stored
+    cache.put('a', 10, 'late')
+    assert cache.get('a', 10) is None
+    assert len(cache.entries) == 1
+
+
+def test_route_cache_expires_entries(monkeypatch):
+    clock = Clock(monkeypatch)
+    cache = igo.RouteCache(maxsize=4, ttl=60)
+    cache.put('a', 1, 'value')
+    clock.now += 59
+    assert cache.get('a', 1) == 'value'
+    clock.now += 2
+    assert cache.get('a', 1) is None
+
+
+def test_route_cache_removes_least_recently_used():
+    cache = igo.RouteCache(maxsize=2, ttl=60)
+    cache.put('a', 1, 'A')
+    cache.put('b', 1, 'B')
+    assert cache.get('a', 1) == 'A'
+    cache.put('c', 1, 'C')
+    assert cache.get('b', 1) is None
+    assert cache.get('a', 1) == 'A'
+    assert cache.get('c', 1) == 'C'
+
+
+def concurrent_calls(flight, key, function, count):
+    """Calls flight.do(key, function) from count threads while function is
+    blocked, and returns the results or exceptions of all of them."""
+
+    results = [None] * count
+
+    def call(i):
+        try:
+            results[i] = flight.do(key, function)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_single_flight_shares_a_running_call():
+    flight = igo.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'route'
+
+    threads, results = concurrent_calls(flight, 'key', slow, 1)
+    started.wait(5)
+    more, more_results = concurrent_calls(flight, 'key', slow, 4)
+    # The other calls wait for the running one
+    while flight.shared < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads + more:
+        thread.join(5)
+    assert results + more_results == ['route'] * 5
+    assert len(calls) == 1
+    assert flight.calls == {}
+
+
+def test_single_flight_shares_the_exception():
+    flight = igo.SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError('no route')
+
+    threads, results = concurrent_calls(flight, 'key', failing, 1)
+    started.wait(5)
+    more, more_results = concurrent_calls(flight, 'key', failing, 2)
+    while flight.shared < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads + more:
+        thread.join(5)
+    assert all(isinstance(result, ValueError) for result in results + more_results)
+
+
+def test_single_flight_runs_again_once_finished():
+    flight = igo.SingleFlight()
+    calls = []
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 1
+    assert flight.do('key', lambda: calls.append(1) or len(calls)) == 2
+    assert flight.do('other', lambda x: x * 2, 21) == 42
+    assert flight.shared == 0
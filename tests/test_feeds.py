@@ -0,0 +1,90 @@
+import threading
+import http.server
+import urllib.request
+import pytest
+import igo
+
+CONGESTIONS = b'1#20210530101500#2#2\n2#20210530101500#5#5\n'
+
+
+class FeedServer(http.server.ThreadingHTTPServer):
+    """Local server of an open data file, which answers conditional requests
+    if conditional is True."""
+
+    def __init__(self):
+        self.content = CONGESTIONS
+        self.etag = '"v1"'
+        self.last_modified = 'Sun, 30 May 2021 10:15:00 GMT'
+        self.conditional = True
+        self.requests = []
+        super().__init__(('127.0.0.1', 0), FeedHandler)
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.conditional and (self.headers.get('If-None-Match') == server.etag or
+                                   self.headers.get('If-Modified-Since') == server.last_modified):
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if server.conditional:
+            self.send_header('ETag', server.etag)
+            self.send_header('Last-Modified', server.last_modified)
+        self.send_header('Content-Length', str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FeedServer()
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    server.url = 'http://127.0.0.1:%d/congestions' % server.server_address[1]
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_congestions_are_parsed(server):
+    assert igo.download_congestions(server.url) == [(1, 2), (2, 5)]
+
+
+def test_unchanged_feed_is_not_downloaded_again(server):
+    feed = {}
+    assert igo.download_congestions(server.url, feed) == [(1, 2), (2, 5)]
+    assert feed['etag'] == '"v1"'
+    assert igo.download_congestions(server.url, feed) is None
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+    assert server.requests[-1]['If-Modified-Since'] == server.last_modified
+    # A new version is downloaded and parsed
+    server.content += b'3#20210530103000#6#6\n'
+    server.etag = '"v2"'
+    server.last_modified = 'Sun, 30 May 2021 10:30:00 GMT'
+    assert igo.download_congestions(server.url, feed) == [(1, 2), (2, 5), (3, 6)]
+    assert feed['etag'] == '"v2"'
+
+
+def test_unchanged_content_is_skipped_without_conditional_requests(server):
+    server.conditional = False
+    feed = {}
+    assert igo.download_congestions(server.url, feed) == [(1, 2), (2, 5)]
+    assert 'If-None-Match' not in server.requests[-1]
+    # The same content gives no new congestions
+    assert igo.download_congestions(server.url, feed) is None
+    server.content = CONGESTIONS.replace(b'#2#2', b'#3#3')
+    assert igo.download_congestions(server.url, feed) == [(1, 3), (2, 5)]
+    assert igo.download_congestions(server.url, feed) is None
+
+
+def test_highways_from_a_local_file(tmp_path):
+    filename = tmp_path / 'highways.csv'
+    filename.write_text('Tram,Descripcio,Coordenades\n1,"Diagonal","2.11,41.38,2.12,41.39"\n', encoding='utf-8')
+    url = 'file:' + urllib.request.pathname2url(str(filename))
+    assert igo.download_highways(url) == {1: [2.11, 41.38, 2.12, 41.39]}
@@ -0,0 +1,99 @@
+import os
+import sys
+import json
+import types
+import pytest
+import networkx as nx
+import igo
+
+# Small OSM extract with streets and points of interest
+FIXTURE_FILENAME = os.path.join(os.path.dirname(__file__), 'fixture.osm')
+FIXTURE_BBOX = (2.09, 41.37, 2.19, 41.41)
+
+GAZETTEER = {
+    'Carrer de Mallorca': (41.395, 2.160),
+    'Carrer de la Marina': (41.400, 2.180),
+    'Avinguda Diagonal': (41.390, 2.140),
+    'Plaça de Catalunya': (41.387, 2.170),
+    "Carrer d'Aragó": (41.392, 2.162),
+    'Sagrada Família': (41.403, 2.174),
+}
+
+
+def test_normalize_place():
+    assert igo.normalize_place('  Sagrada   FAMÍLIA, ') == 'sagrada familia'
+    assert igo.normalize_place('Plaça de Catalunya') == igo.normalize_place('placa  de catalunya')
+
+
+def test_strip_street_type():
+    assert igo.strip_street_type('carrer de la marina') == 'marina'
+    assert igo.strip_street_type("carrer d'arago") == 'arago'
+    assert igo.strip_street_type('avinguda diagonal') == 'diagonal'
+    assert igo.strip_street_type('sagrada familia') == 'sagrada familia'
+
+
+def test_gazetteer_lookup():
+    geocoder = igo.Geocoder(GAZETTEER)
+    assert geocoder.lookup('sagrada familia') == GAZETTEER['Sagrada Família']
+    # Without the street type, by prefix and with a typo
+    assert geocoder.lookup('Marina') == GAZETTEER['Carrer de la Marina']
+    assert geocoder.lookup('Arago') == GAZETTEER["Carrer d'Aragó"]
+    assert geocoder.lookup('Sagrada') == GAZETTEER['Sagrada Família']
+    assert geocoder.lookup('Diagonl') == GAZETTEER['Avinguda Diagonal']
+    assert geocoder.lookup('Camp Nou') is None
+
+
+def test_gazetteer_file(tmp_path):
+    filename = str(tmp_path / 'barcelona.places')
+    igo.save_gazetteer(GAZETTEER, filename)
+    assert igo.load_gazetteer(filename) == GAZETTEER
+
+
+def test_remote_answers_are_cached(tmp_path, monkeypatch):
+    calls = []
+    osmnx = types.ModuleType('osmnx')
+    osmnx.geocode = lambda query: calls.append(query) or (41.381, 2.123)
+    monkeypatch.setitem(sys.modules, 'osmnx', osmnx)
+    filename = str(tmp_path / 'geocode.json')
+    geocoder = igo.Geocoder(GAZETTEER, filename)
+    assert geocoder.geocode('Camp Nou') == (41.381, 2.123)
+    assert geocoder.geocode('  camp NOU') == (41.381, 2.123)
+    assert geocoder.geocode('Mallorca') == GAZETTEER['Carrer de Mallorca']
+    assert calls == ['Camp Nou,Barcelona,Catalonia']
+    with open(filename) as file:
+        assert json.load(file) == {'camp nou': [41.381, 2.123]}
+    # The answers are kept between runs
+    assert igo.Geocoder(None, filename).lookup('Camp Nou') == (41.381, 2.123)
+
+
+def test_points_of_interest_are_geocoded_locally(monkeypatch):
+    def remote(query):
+        raise AssertionError('remote geocoder used for ' + query)
+    osmnx = types.ModuleType('osmnx')
+    osmnx.geocode = remote
+    monkeypatch.setitem(sys.modules, 'osmnx', osmnx)
+    graph = nx.DiGraph()
+    graph.add_node(1, x=2.160, y=41.394)
+    graph.add_node(2, x=2.162, y=41.396)
+    graph.add_edge(1, 2, name='Carrer de Mallorca')
+    graph.add_edge(2, 1, name=['Carrer de Mallorca', 'Camp Nou'])
+    places = {'Camp Nou': (41.381, 2.123), 'Hospital Clínic': (41.389, 2.152)}
+    gazetteer = igo.build_gazetteer(graph, places)
+    # Streets with the name of a place win
+    assert gazetteer['Camp Nou'] == pytest.approx((41.395, 2.161))
+    assert gazetteer['Carrer de Mallorca'] == pytest.approx((41.395, 2.161))
+    geocoder = igo.Geocoder(gazetteer)
+    assert geocoder.geocode('hospital clinic') == (41.389, 2.152)
+    assert geocoder.geocode('Hospital') == (41.389, 2.152)
+
+
+def test_points_of_interest_of_an_extract():
+    pytest.importorskip('osmium')
+    pytest.importorskip('osmnx')
+    import build
+    places = build.pois_from_pbf(FIXTURE_FILENAME, FIXTURE_BBOX)
+    # Places without a name, of other kinds or out of the area are skipped
+    assert sorted(places) == ['Camp Nou', 'Estació de Sants', 'Hospital Clínic', 'Sagrada Família']
+    assert places['Hospital Clínic'] == pytest.approx((41.389, 2.105))
+    # Areas are placed at the mean of their nodes
+    assert places['Camp Nou'] == pytest.approx((41.3808, 2.1216))
@@ -0,0 +1,80 @@
+import time
+import numpy as np
+import pytest
+import igo
+
+WAY_IDS = [10, 20, 30, 40]
+# Noon of a day without a change of time, in local time like day_intervals
+NOON = time.mktime((2021, 6, 1, 12, 0, 0, 0, 0, -1))
+DAY = 86400
+
+
+@pytest.fixture
+def history(tmp_path):
+    return igo.CongestionHistory(str(tmp_path / 'history'), WAY_IDS, size=3)
+
+
+def test_ring_replaces_the_oldest_snapshot(history):
+    assert len(history) == 0
+    for day in range(5):
+        history.add([(10, day + 1)], NOON + day * DAY)
+    assert len(history) == 3
+    times, densities = history.snapshots()
+    order = np.argsort(times)
+    assert times[order].tolist() == [NOON + 2 * DAY, NOON + 3 * DAY, NOON + 4 * DAY]
+    assert densities[order, 0].tolist() == [3, 4, 5]
+
+
+def test_unknown_ways_and_levels_are_not_stored(history):
+    history.add([(10, 3), (99, 4), (20, 9), (30, -1), (40, 6)], NOON)
+    _, densities = history.snapshots()
+    assert densities.tolist() == [[3, 0, 0, 6]]
+
+
+def test_predict_uses_the_same_time_of_day(history):
+    history.add([(10, 2), (20, 5)], NOON - 2 * DAY)
+    history.add([(10, 3), (20, 0)], NOON - DAY)
+    # Another time of the day
+    history.add([(10, 6), (30, 6)], NOON - DAY + 3600)
+    # Way 20 is only known once and way 30 not at noon
+    assert sorted(history.predict(NOON)) == [(10, 2), (20, 5)]
+    assert sorted(history.predict(NOON + 3600)) == [(10, 6), (30, 6)]
+    assert history.predict(NOON + 7200) == []
+
+
+def test_fill_keeps_the_live_levels(history):
+    history.add([(10, 2), (20, 4), (30, 1)], NOON - DAY)
+    filled = history.fill([(20, 1), (30, 0), (40, 3)], NOON)
+    # The usual levels go first, so the live ones win on shared edges
+    assert filled == [(10, 2), (20, 1), (30, 1), (40, 3)]
+    assert sorted(history.fill([], NOON)) == [(10, 2), (20, 4), (30, 1)]
+
+
+def test_profiles_match_the_mean_of_every_interval(history):
+    history.add([(10, 2), (20, 4)], NOON - DAY)
+    history.add([(10, 4)], NOON - 2 * DAY)
+    history.add([(10, 6)], NOON + 7200)
+    profiles = history.profiles(minutes=60)
+    noon = igo.day_intervals(NOON, 60)
+    assert profiles.shape == (len(WAY_IDS), 24)
+    assert profiles[:, noon][:2].tolist() == [3.0, 4.0]
+    assert np.isnan(profiles[2:, noon]).all()
+    assert profiles[0, igo.day_intervals(NOON + 7200, 60)] == 6.0
+    assert np.isnan(profiles[0, (noon + 3) % 24])
+    assert history.profiles([20, 99], minutes=60)[:, noon][0] == 4.0
+    assert np.isnan(history.profiles([20, 99], minutes=60)[1]).all()
+
+
+def test_history_is_kept_on_disk(tmp_path):
+    dirname = str(tmp_path / 'history')
+    history = igo.CongestionHistory(dirname, WAY_IDS, size=3)
+    for day in range(3):
+        history.add([(10, day + 1), (30, 5)], NOON + day * DAY)
+    del history
+    assert len(igo.CongestionHistory(dirname, WAY_IDS, size=3)) == 3
+    # Other ways and a smaller size keep the newest levels of the known ways
+    history = igo.CongestionHistory(dirname, [5, 10, 20], size=2)
+    times, densities = history.snapshots()
+    order = np.argsort(times)
+    assert times[order].tolist() == [NOON + DAY, NOON + 2 * DAY]
+    assert densities[order].tolist() == [[0, 2, 0], [0, 3, 0]]
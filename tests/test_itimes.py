@@ -0,0 +1,83 @@
+import random
+import numpy as np
+import pytest
+import networkx as nx
+import igo
+
+
+def fixture_arrays(n=10, seed=0):
+    """Returns the arrays of a grid of n x n nodes and of ways that follow
+    its rows and columns, some of them sharing edges."""
+
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    for i in range(n):
+        for j in range(n):
+            graph.add_node(i * n + j, x=2.1 + j * 0.001, y=41.38 + i * 0.001)
+    for i in range(n):
+        for j in range(n):
+            for a, b in ((i, j + 1), (i + 1, j), (i, j - 1), (i - 1, j)):
+                if 0 <= a < n and 0 <= b < n:
+                    graph.add_edge(i * n + j, a * n + b, length=rng.uniform(50, 150),
+                                   maxspeed=rng.choice([30, 50]))
+    way_index = {}
+    for i in range(n):
+        row = [i * n + j for j in range(n)]
+        column = [j * n + i for j in range(n)]
+        way_index[100 + i] = list(zip(row[:-1], row[1:]))
+        way_index[200 + i] = list(zip(column[:-1], column[1:]))
+        # Half of a row, so that two ways share its edges
+        way_index[300 + i] = list(zip(row[:n // 2], row[1:n // 2 + 1]))
+    return igo.graph_arrays(graph, way_index)
+
+
+@pytest.fixture(scope='module')
+def arrays():
+    return fixture_arrays()
+
+
+def random_congestions(rng, way_ids):
+    """Returns the congestions of some of the ways and of unknown ones, with
+    levels that may be out of range."""
+
+    ways = [way_id for way_id in way_ids if rng.random() < 0.7] + [999, 1000]
+    rng.shuffle(ways)
+    return [(way_id, rng.randint(-1, 8)) for way_id in ways]
+
+
+def test_update_matches_the_full_computation(arrays):
+    rng = random.Random(1)
+    way_ids = arrays.way_ids.tolist()
+    old = random_congestions(rng, way_ids)
+    itime = igo.compute_itimes(arrays, old)
+    for _ in range(100):
+        if rng.random() < 0.8:
+            # The same ways with some levels changed
+            new = [(way_id, rng.randint(-1, 8) if rng.random() < 0.2 else level) for way_id, level in old]
+        else:
+            new = random_congestions(rng, way_ids)
+        updated, touched = igo.update_itimes(arrays, itime, old, new)
+        assert np.allclose(updated, igo.compute_itimes(arrays, new))
+        if [way_id for way_id, _ in old] != [way_id for way_id, _ in new]:
+            assert touched == len(itime)
+        else:
+            changed = [way_id for (way_id, before), (_, after) in zip(old, new) if before != after]
+            edges = set()
+            for way_id in changed:
+                if way_id in way_ids:
+                    i = way_ids.index(way_id)
+                    edges.update(arrays.way_edges[arrays.way_offsets[i]:arrays.way_offsets[i+1]].tolist())
+            assert touched == len(edges)
+        old, itime = new, updated
+
+
+def test_update_without_changes_keeps_the_itimes(arrays):
+    congestions = [(100, 3), (300, 5), (999, 4)]
+    itime = igo.compute_itimes(arrays, congestions)
+    updated, touched = igo.update_itimes(arrays, itime, congestions, list(congestions))
+    assert updated is itime and touched == 0
+    # The given itimes are not modified
+    before = itime.copy()
+    updated, touched = igo.update_itimes(arrays, itime, congestions, [(100, 3), (300, 6), (999, 4)])
+    assert np.array_equal(itime, before)
+    assert touched == 5 and not np.array_equal(updated, before)
@@ -0,0 +1,123 @@
+import random
+import pytest
+import networkx as nx
+import igo
+
+
+def fixture_graph(n=12, seed=0):
+    """Returns a grid of n x n nodes, with most of the streets in both
+    directions, some missing and random itimes, so that there are no ties
+    between paths."""
+
+    rng = random.Random(seed)
+    graph = nx.DiGraph()
+    for i in range(n):
+        for j in range(n):
+            graph.add_node(i * n + j, x=2.1 + j * 0.001, y=41.38 + i * 0.001)
+    for i in range(n):
+        for j in range(n):
+            for a, b in ((i, j + 1), (i + 1, j), (i, j - 1), (i - 1, j)):
+                if 0 <= a < n and 0 <= b < n and rng.random() < 0.85:
+                    graph.add_edge(i * n + j, a * n + b, itime=rng.uniform(5, 60))
+    # A node that can only be left
+    graph.add_node(-1, x=2.09, y=41.37)
+    graph.add_edge(-1, 0, itime=10.0)
+    return graph
+
+
+@pytest.fixture(scope='module')
+def graph():
+    return fixture_graph()
+
+
+@pytest.fixture(scope='module', params=[False, True], ids=['dijkstra', 'hierarchy'])
+def router(request, graph):
+    router = igo.build_router(graph)
+    if request.param:
+        router = igo.customize_router(router, igo.build_hierarchy(router))
+    return router
+
+
+def test_shortest_path_matches_networkx(graph, router):
+    rng = random.Random(1)
+    nodes = list(graph)
+    for _ in range(200):
+        orig, dest = rng.choice(nodes), rng.choice(nodes)
+        try:
+            expected = nx.shortest_path(graph, orig, dest, weight='itime')
+        except nx.NetworkXNoPath:
+            with pytest.raises(nx.NetworkXNoPath):
+                igo.router_shortest_path(router, orig, dest)
+            continue
+        assert igo.router_shortest_path(router, orig, dest) == expected
+
+
+def test_adjacent_and_same_node(graph, router):
+    orig = 0
+    for dest in graph[orig]:
+        assert igo.router_shortest_path(router, orig, dest) == nx.shortest_path(graph, orig, dest, weight='itime')
+    assert igo.router_shortest_path(router, orig, orig) == [orig]
+
+
+def test_unreachable_node(router):
+    with pytest.raises(nx.NetworkXNoPath):
+        igo.router_shortest_path(router, 0, -1)
+
+
+def test_shortest_paths_and_isochrone(graph):
+    router = igo.build_router(graph)
+    lengths = nx.single_source_dijkstra_path_length(graph, 0, weight='itime')
+    dests = [5, 77, 143, -1]
+    for dest, route in zip(dests, igo.router_shortest_paths(router, 0, dests)):
+        if dest not in lengths:
+            assert route is None
+        else:
+            assert route[0] == pytest.approx(lengths[dest])
+            assert route[1] == nx.shortest_path(graph, 0, dest, weight='itime')
+    itimes = igo.router_isochrone(router, 0, 120)
+    assert itimes == pytest.approx({node: d for node, d in lengths.items() if d <= 120})
+
+
+def test_new_weights_are_searched(graph):
+    # The lists of the arrays are cached, so a router with other weights
+    # must not use the old ones
+    router = igo.build_router(graph)
+    slow = router._replace(weights=router.weights * 0 + 1)
+    unweighted = nx.shortest_path_length(graph, 0, 143)
+    igo.router_shortest_path(router, 0, 143)
+    assert len(igo.router_shortest_path(slow, 0, 143)) - 1 == unweighted
+
+
+def test_saved_hierarchy_is_mapped(graph, tmp_path):
+    router = igo.build_router(graph)
+    dirname = str(tmp_path / 'hierarchy')
+    assert igo.load_hierarchy(dirname, router) is None
+    igo.save_hierarchy(igo.build_hierarchy(router), router, dirname)
+    mapped = igo.customize_router(router, igo.load_hierarchy(dirname, router))
+    rng = random.Random(2)
+    nodes = list(graph)
+    for _ in range(50):
+        orig, dest = rng.choice(nodes[:-1]), rng.choice(nodes[:-1])
+        assert igo.router_shortest_path(mapped, orig, dest) == nx.shortest_path(graph, orig, dest, weight='itime')
+    # A topology of another graph is not used
+    assert igo.load_hierarchy(dirname, router._replace(targets=router.targets[::-1].copy())) is None
+
+
+def test_snapshot_map_draws_like_the_graph(graph, tmp_path):
+    graph = graph.copy()
+    # A street that is not a straight line
+    start, end = (graph.nodes[0]['x'], graph.nodes[0]['y']), (graph.nodes[1]['x'], graph.nodes[1]['y'])
+    graph.add_edge(0, 1, itime=1.0, length=10.0, geometry=[start, (start[0], start[1] + 0.0005), end])
+    for u, v, data in graph.edges(data=True):
+        data.setdefault('length', 10.0)
+    igo.save_graph_snapshot(graph, {}, str(tmp_path / 'snapshot'))
+    snapshot = igo.load_graph_snapshot(str(tmp_path / 'snapshot'))
+    graph_map = igo.snapshot_map(snapshot)
+    ipath = nx.shortest_path(graph, -1, 143, weight='itime')
+    assert ipath[:3] == [-1, 0, 1]
+    assert igo.path_coordinates(graph_map, ipath) == igo.path_coordinates(graph, ipath)
+    itimes = igo.router_isochrone(igo.build_router(graph), 0, 60)
+    assert sorted(igo.graph_edges(graph_map, itimes)) == sorted(igo.graph_edges(graph, itimes))
+    X, Y = [2.1, 2.1055, 2.2], [41.38, 41.3852, 41.4]
+    assert (igo.nearest_nodes(igo.snapshot_node_index(snapshot), X, Y).tolist()
+            == igo.nearest_nodes(igo.build_node_index(graph), X, Y).tolist())
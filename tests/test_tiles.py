@@ -0,0 +1,53 @@
+import tiles
+
+# Nothing listens on port 9, so every download fails at once
+UNREACHABLE_URL = 'http://127.0.0.1:9/{z}/{x}/{y}.png'
+
+
+def test_base_map_with_failed_tiles(tmp_path):
+    cache = tiles.TileCache(str(tmp_path / 'tiles'), url_template=UNREACHABLE_URL)
+    base = tiles.BaseMap(cache, zooms=[11])
+    image, x_min, y_min = base.images[11]
+    xs, ys = tiles.bbox_tiles(tiles.BARCELONA_BBOX, 11)
+    assert image.size == (len(xs) * tiles.TILE_SIZE, len(ys) * tiles.TILE_SIZE)
+    assert (x_min, y_min) == (xs[0], ys[0])
+    assert cache.counts['failed'] == len(xs) * len(ys)
+    # Failed tiles are drawn blank over the white background
+    assert image.getpixel((5, 5))[:3] == (255, 255, 255)
+
+
+def test_base_map_is_stored_only_with_every_tile(tmp_path):
+    dirname = str(tmp_path / 'base_map')
+    offline = tiles.TileCache(str(tmp_path / 'tiles'), offline=True)
+    tiles.BaseMap(offline, zooms=[11], DIRNAME=dirname)
+    # The blank tiles are not kept
+    assert not (tmp_path / 'base_map').exists()
+    xs, ys = tiles.bbox_tiles(tiles.BARCELONA_BBOX, 11)
+    content = tiles.TileCache(str(tmp_path / 'other'), offline=True).blank
+    for x in xs:
+        for y in ys:
+            offline.put(offline.path(11, x, y), content)
+    tiles.BaseMap(offline, zooms=[11], DIRNAME=dirname)
+    assert len(list((tmp_path / 'base_map').iterdir())) == 1
+    # Later processes map the stored image without reading the tiles
+    stored = offline.counts['stored']
+    image = tiles.BaseMap(offline, zooms=[11], DIRNAME=dirname).images[11][0]
+    assert offline.counts['stored'] == stored
+    assert image.size == (len(xs) * tiles.TILE_SIZE, len(ys) * tiles.TILE_SIZE)
+
+
+def test_simplify_polyline():
+    line = [(2.10 + i * 0.001, 41.38) for i in range(6)]
+    # Points in the middle of a straight line are not needed
+    assert tiles.simplify_polyline(line, 15) == [line[0], line[-1]]
+    # A point a few pixels away from the line is kept at zoom 15 but not at
+    # zoom 10, where it is less than a pixel away
+    bent = line[:3] + [(2.103, 41.3802)] + line[4:]
+    assert tiles.simplify_polyline(bent, 15) == [line[0], line[2], (2.103, 41.3802), line[4], line[-1]]
+    assert tiles.simplify_polyline(bent, 10) == [line[0], line[-1]]
+    assert tiles.simplify_polyline(bent, 15, tolerance=100) == [line[0], line[-1]]
+    # A closed polyline keeps its furthest point
+    closed = [(2.10, 41.38), (2.11, 41.38), (2.11, 41.39), (2.10, 41.38)]
+    assert tiles.simplify_polyline(closed, 15) == closed
+    for points in ([], line[:1], line[:2]):
+        assert tiles.simplify_polyline(points, 15) == points
@@ -0,0 +1,67 @@
+import io
+import pytest
+from PIL import Image
+import igo
+import tiles
+from test_itimes import fixture_arrays
+
+TRAFFIC_ZOOM = 15  # As in bot.py, which needs python-telegram-bot
+
+
+class CountingPool:
+    """Renders in the calling thread and counts the maps drawn."""
+
+    def __init__(self):
+        self.rendered = 0
+
+    def render(self, function, *args, **kwargs):
+        self.rendered += 1
+        return function(*args, **kwargs)
+
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    # Tiles that are not stored are blank, so nothing is downloaded
+    monkeypatch.setattr(tiles, 'tile_cache', tiles.TileCache(str(tmp_path / 'tiles'), offline=True))
+    monkeypatch.setattr(tiles, 'base_map', None)
+
+
+@pytest.fixture
+def arrays():
+    return fixture_arrays()
+
+
+def test_plot_traffic(arrays, offline):
+    congestions = [(100, 1), (101, 3), (200, 6), (300, 2), (999, 4)]
+    image = igo.plot_traffic(arrays, congestions, 300)
+    assert image.size == (300, 300)
+    center = (arrays.x.mean(), arrays.y.mean())
+    # Streets in the middle of the grid, which are inside the map of the tile
+    image = igo.plot_traffic(arrays, [(104, 3), (205, 6)], 200, center, TRAFFIC_ZOOM)
+    assert image.size == (200, 200)
+    # The congested streets are drawn over the blank tiles
+    assert len(image.convert('RGB').getcolors(200 * 200)) > 1
+
+
+def test_traffic_picture_is_cached(arrays, offline, monkeypatch):
+    pytest.importorskip('telegram')
+    import bot
+    pool = CountingPool()
+    monkeypatch.setattr(bot, 'edge_table', arrays)
+    monkeypatch.setattr(bot, 'pool', pool)
+    monkeypatch.setattr(bot, 'traffic_cache', igo.RouteCache(16, 60))
+    current = bot.Snapshot(None, None, [(100, 2), (200, 5)], 1000, None)
+    # The key of /traffic here, as built by bot.traffic
+    lat, lon = arrays.y.mean(), arrays.x.mean()
+    here = (bot.TRAFFIC_ZOOM, int(tiles.lon_to_tile(lon, bot.TRAFFIC_ZOOM)),
+            int(tiles.lat_to_tile(lat, bot.TRAFFIC_ZOOM)))
+    for key in (None, here):
+        picture_bytes = bot.traffic_picture(current, key)
+        assert Image.open(io.BytesIO(picture_bytes)).size == (bot.SIZE, bot.SIZE)
+        rendered = pool.rendered
+        assert bot.traffic_picture(current, key) is picture_bytes
+        assert pool.rendered == rendered
+    assert pool.rendered == 2
+    # A new snapshot draws the map again
+    bot.traffic_picture(current._replace(time=2000), here)
+    assert pool.rendered == 3
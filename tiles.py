@@ -0,0 +1,462 @@
+import os
+import io
+import sys
+import math
+import time
+import logging
+import threading
+import urllib.request
+import numpy as np
+from PIL import Image, ImageDraw
+from staticmap import StaticMap
+
+TILE_URL = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png'
+TILE_SIZE = 256
+# Minimum longitude, minimum latitude, maximum longitude and maximum latitude
+# of Barcelona
+BARCELONA_BBOX = (2.05, 41.32, 2.23, 41.47)
+PREFETCH_ZOOMS = range(11, 17)
+# Maximum distance in pixels between a drawn line and its real geometry
+SIMPLIFY_PIXELS = 1.0
+
+logger = logging.getLogger('igo')
+
+# Tile cache and base map used by static_map, set with configure
+tile_cache = None
+base_map = None
+
+
+def lon_to_tile(lon, zoom):
+    """Given a longitude and a zoom level, returns the x tile coordinate as a
+    float, as staticmap does."""
+
+    return (lon + 180) / 360 * 2 ** zoom
+
+
+def lat_to_tile(lat, zoom):
+    """Given a latitude, or an array of them, and a zoom level, returns the
+    y tile coordinate as a float, as staticmap does."""
+
+    lat = np.radians(lat)
+    return (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 2 ** zoom
+
+
+def tile_to_lon(x, zoom):
+    """Given an x tile coordinate and a zoom level, returns its longitude."""
+
+    return x / 2 ** zoom * 360 - 180
+
+
+def tile_to_lat(y, zoom):
+    """Given a y tile coordinate and a zoom level, returns its latitude."""
+
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / 2 ** zoom))))
+
+
+def bbox_zoom(bbox, width, height):
+    """Given a bounding box and the size of a map, returns the highest zoom
+    level where the whole box fits in the map."""
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    for zoom in range(18, 0, -1):
+        box_width = (lon_to_tile(max_lon, zoom) - lon_to_tile(min_lon, zoom)) * TILE_SIZE
+        box_height = (lat_to_tile(min_lat, zoom) - lat_to_tile(max_lat, zoom)) * TILE_SIZE
+        if box_width <= width and box_height <= height:
+            return zoom
+    return 0
+
+
+def bbox_tiles(bbox, zoom):
+    """Given a bounding box and a zoom level, returns the range of x and the
+    range of y of the tiles that cover it."""
+
+    min_lon, min_lat, max_lon, max_lat = bbox
+    xs = range(int(lon_to_tile(min_lon, zoom)), int(lon_to_tile(max_lon, zoom)) + 1)
+    ys = range(int(lat_to_tile(max_lat, zoom)), int(lat_to_tile(min_lat, zoom)) + 1)
+    return xs, ys
+
+
+def simplify_polyline(coordinates, zoom, tolerance=SIMPLIFY_PIXELS):
+    """Given the coordinates of a polyline, removes the points that are not
+    needed to draw it at a zoom level with the Douglas-Peucker algorithm: the
+    drawn polyline is never further than tolerance pixels from the original.
+
+    Parameters:
+    ----------
+    coordinates: List of (longitude, latitude) pairs.
+    zoom: Zoom level the polyline is drawn at.
+    tolerance: Maximum distance in pixels.
+
+    Returns:
+    ----------
+    List with the coordinates that are kept, including the first and the
+    last ones.
+    """
+
+    if len(coordinates) < 3:
+        return list(coordinates)
+    lon, lat = np.radians(np.array(coordinates, dtype=np.float64)).T
+    # Pixel coordinates of the points, as lon_to_tile and lat_to_tile
+    x = (lon / (2 * np.pi) + 0.5) * 2 ** zoom * TILE_SIZE
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 2 ** zoom * TILE_SIZE
+    keep = np.zeros(len(coordinates), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(coordinates) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first+1:last] - x[first], y[first+1:last] - y[first]
+        norm = np.hypot(dx, dy)
+        if norm > 0:
+            distance = np.abs(px * dy - py * dx) / norm
+        else:
+            # The segment is a point, for instance in a closed polyline
+            distance = np.hypot(px, py)
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return [coordinates[i] for i in np.flatnonzero(keep)]
+
+
+def simplify_lines(m, tolerance=SIMPLIFY_PIXELS):
+    """Given a map with all its lines and markers, simplifies its lines for
+    the zoom level it will be drawn at. Returns the zoom level, which must
+    be passed to render so that it is not computed again."""
+
+    zoom = m._calculate_zoom()
+    for line in m.lines:
+        line.coords = simplify_polyline(line.coords, zoom, tolerance)
+        # staticmap would drop more points, cutting the corners
+        line.simplify = False
+    return zoom
+
+
+def draw_polylines(m, image, batches, width=3, markers=()):
+    """Draws many polylines on the image rendered by the StaticMap m, as its
+    lines are drawn, but projecting all the points of a batch at once. The
+    polylines that are out of the map are skipped.
+
+    Parameters:
+    ----------
+    m: StaticMap that rendered the image, with its zoom and center.
+    image: Image returned by m.render().
+    batches: List of (color, x, y, offsets), where x and y are arrays with
+    the longitudes and latitudes of the points and polyline i goes from
+    offsets[i] to offsets[i+1]. Later batches are drawn on top.
+    width: Width of the lines in pixels.
+    markers: CircleMarkers drawn on top of the polylines.
+
+    Returns:
+    ----------
+    Nothing. Only draws on the image.
+    """
+
+    # Lines are drawn on an image twice as large and reduced, as staticmap
+    # does, so that they are antialiased
+    layer = Image.new('RGBA', (2 * m.width, 2 * m.height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    for color, x, y, offsets in batches:
+        if len(offsets) < 2:
+            continue
+        px = 2 * ((lon_to_tile(np.asarray(x), m.zoom) - m.x_center) * TILE_SIZE + m.width / 2)
+        py = 2 * ((lat_to_tile(np.asarray(y), m.zoom) - m.y_center) * TILE_SIZE + m.height / 2)
+        starts = np.asarray(offsets[:-1])
+        visible = ((np.minimum.reduceat(px, starts) < 2 * m.width) & (np.maximum.reduceat(px, starts) > 0) &
+                   (np.minimum.reduceat(py, starts) < 2 * m.height) & (np.maximum.reduceat(py, starts) > 0))
+        points = np.column_stack((px, py)).round().astype(np.int64)
+        for i in np.flatnonzero(visible).tolist():
+            draw.line(points[offsets[i]:offsets[i+1]].ravel().tolist(), fill=color, width=2 * width, joint='curve')
+    for marker in markers:
+        px = 2 * ((lon_to_tile(marker.coord[0], m.zoom) - m.x_center) * TILE_SIZE + m.width / 2)
+        py = 2 * ((lat_to_tile(marker.coord[1], m.zoom) - m.y_center) * TILE_SIZE + m.height / 2)
+        draw.ellipse((px - marker.width, py - marker.width, px + marker.width, py + marker.width), fill=marker.color)
+    layer = layer.resize((m.width, m.height), Image.LANCZOS)
+    image.paste(layer, (0, 0), layer)
+
+
+class TileCache:
+    """Map tiles stored on disk as DIRECTORY/z/x/y.png. Missing tiles are
+    downloaded from the tile server and stored, and the least recently used
+    tiles are removed when the directory grows over max_bytes. In offline
+    mode only the tiles in the directory are used and the missing ones are
+    drawn blank.
+
+    Parameters:
+    ----------
+    DIRECTORY: Name of the directory where the tiles are stored.
+    max_bytes: Maximum total size of the stored tiles.
+    offline: True to never use the network.
+    url_template: Url of the tile server.
+    """
+
+    def __init__(self, DIRECTORY, max_bytes=512 * 2**20, offline=False, url_template=TILE_URL):
+        self.directory = DIRECTORY
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.url_template = url_template
+        self.lock = threading.Lock()
+        # Tiles read from disk, downloaded, drawn blank offline and not
+        # available
+        self.counts = {'stored': 0, 'downloaded': 0, 'blank': 0, 'failed': 0}
+        # Last use and size of every stored tile
+        self.tiles = {}
+        for root, _, files in os.walk(DIRECTORY):
+            for name in files:
+                path = os.path.join(root, name)
+                status = os.stat(path)
+                self.tiles[path] = (status.st_mtime, status.st_size)
+        self.size = sum(size for _, size in self.tiles.values())
+        buffer = io.BytesIO()
+        Image.new('RGBA', (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0)).save(buffer, 'PNG')
+        self.blank = buffer.getvalue()
+
+    def path(self, z, x, y):
+        """Returns the name of the file of a tile."""
+
+        return os.path.join(self.directory, str(z), str(x), '%d.png' % y)
+
+    def get(self, z, x, y):
+        """Returns the content of a tile as PNG bytes, downloading it if it
+        is not stored yet. A blank tile is returned in offline mode if it is
+        not stored."""
+
+        path = self.path(z, x, y)
+        try:
+            with open(path, 'rb') as file:
+                content = file.read()
+            # Keep the time of the last use for the eviction
+            os.utime(path)
+            with self.lock:
+                self.tiles[path] = (time.time(), len(content))
+            self.count('stored')
+            return content
+        except FileNotFoundError:
+            pass
+        if self.offline:
+            self.count('blank')
+            return self.blank
+        request = urllib.request.Request(self.url_template.format(z=z, x=x, y=y),
+                                         headers={'User-Agent': 'iGoAP2_bot'})
+        with urllib.request.urlopen(request) as response:
+            content = response.read()
+        self.put(path, content)
+        self.count('downloaded')
+        return content
+
+    def count(self, name):
+        """Adds a tile to the given count."""
+
+        with self.lock:
+            self.counts[name] += 1
+
+    def put(self, path, content):
+        """Stores the content of a tile and, if the cache is too big,
+        removes the least recently used tiles until it uses 90% of its
+        maximum size."""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(content)
+        with self.lock:
+            old = self.tiles.get(path)
+            self.size += len(content) - (old[1] if old else 0)
+            self.tiles[path] = (time.time(), len(content))
+            if self.size <= self.max_bytes:
+                return
+            for oldest in sorted(self.tiles, key=lambda p: self.tiles[p][0]):
+                if self.size <= 0.9 * self.max_bytes:
+                    break
+                if oldest == path:
+                    continue
+                self.size -= self.tiles.pop(oldest)[1]
+                try:
+                    os.remove(oldest)
+                except FileNotFoundError:
+                    pass
+
+
+def prefetch_tiles(cache, bbox=BARCELONA_BBOX, zooms=PREFETCH_ZOOMS):
+    """Given a tile cache, stores all the tiles of a bounding box for some
+    zoom levels so that maps of the area can be rendered offline.
+
+    Parameters:
+    ----------
+    cache: TileCache where the tiles are stored.
+    bbox: Minimum longitude, minimum latitude, maximum longitude and maximum
+    latitude of the area.
+    zooms: Zoom levels to store.
+
+    Returns:
+    ----------
+    Number of tiles of the area.
+    """
+
+    count = 0
+    for zoom in zooms:
+        xs, ys = bbox_tiles(bbox, zoom)
+        for x in xs:
+            for y in ys:
+                cache.get(zoom, x, y)
+                count += 1
+    return count
+
+
+class BaseMap:
+    """Images of a whole area at some zoom levels assembled from a tile
+    cache, kept in memory so that maps of the area only have to draw their
+    lines and markers on top of a crop. With a directory, the images are
+    stored in it the first time they have all their tiles and mapped from it
+    afterwards, so that the processes that use the same directory share
+    them. Images with blank tiles are assembled again every time.
+
+    Parameters:
+    ----------
+    cache: TileCache with the tiles of the area.
+    bbox: Minimum longitude, minimum latitude, maximum longitude and maximum
+    latitude of the area.
+    zooms: Zoom levels to keep. Every level needs four times the memory of
+    the previous one.
+    DIRNAME: name of the directory where the images are stored, if any.
+    """
+
+    def __init__(self, cache, bbox=BARCELONA_BBOX, zooms=range(11, 15), DIRNAME=None):
+        # For every zoom, the image and the coordinates of its top left tile
+        self.images = {}
+        for zoom in zooms:
+            xs, ys = bbox_tiles(bbox, zoom)
+            size = (len(xs) * TILE_SIZE, len(ys) * TILE_SIZE)
+            filename = None
+            if DIRNAME is not None:
+                filename = os.path.join(DIRNAME, '%d_%d_%d.npy' % (zoom, xs[0], ys[0]))
+                image = load_base_image(filename, size)
+                if image is not None:
+                    self.images[zoom] = (image, xs[0], ys[0])
+                    continue
+            image = Image.new('RGBA', size, '#fff')
+            # Whether every tile is available
+            complete = True
+            for i, x in enumerate(xs):
+                for j, y in enumerate(ys):
+                    try:
+                        content = cache.get(zoom, x, y)
+                    except Exception as e:
+                        # Drawn blank, as in CachedStaticMap
+                        cache.count('failed')
+                        logger.warning("Tile %d/%d/%d not available: %r", zoom, x, y, e)
+                        content = cache.blank
+                    if content is cache.blank:
+                        complete = False
+                    tile = Image.open(io.BytesIO(content)).convert('RGBA')
+                    image.alpha_composite(tile, (i * TILE_SIZE, j * TILE_SIZE))
+            if filename is not None and complete:
+                save_base_image(image, filename)
+                image = load_base_image(filename, size)
+            self.images[zoom] = (image, xs[0], ys[0])
+
+    def crop(self, zoom, x_center, y_center, width, height):
+        """Returns the part of the base map of a zoom level with the given
+        center (in tile coordinates) and size, or None if it is not covered."""
+
+        if zoom not in self.images:
+            return None
+        image, x_min, y_min = self.images[zoom]
+        left = int(round((x_center - x_min) * TILE_SIZE - width / 2))
+        top = int(round((y_center - y_min) * TILE_SIZE - height / 2))
+        if left < 0 or top < 0 or left + width > image.width or top + height > image.height:
+            return None
+        return image.crop((left, top, left + width, top + height))
+
+
+def save_base_image(image, filename):
+    """Given an RGBA image, stores its pixels in a .npy file that
+    load_base_image can map."""
+
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # Written apart and renamed so that no process maps half an image
+    temporary = '%s.%d.npy' % (filename[:-4], os.getpid())
+    np.save(temporary, np.asarray(image))
+    os.replace(temporary, filename)
+
+
+def load_base_image(filename, size):
+    """Given a file written by save_base_image and the size of its image,
+    returns the image over the mapped pixels, or None if there is no file or
+    it has another size."""
+
+    if not os.path.exists(filename):
+        return None
+    pixels = np.load(filename, mmap_mode='r')
+    if pixels.shape != (size[1], size[0], 4):
+        return None
+    # The image reads the mapped pixels without copying them
+    return Image.frombuffer('RGBA', size, pixels, 'raw', 'RGBA', 0, 1)
+
+
+class CachedStaticMap(StaticMap):
+    """StaticMap that takes its tiles from a TileCache, or from a BaseMap
+    when the map fits in it, instead of downloading them every time.
+
+    Parameters:
+    ----------
+    width: Width of the map in pixels.
+    height: Height of the map in pixels.
+    cache: TileCache where tiles are taken from.
+    base: BaseMap used when it covers the map, if any.
+    """
+
+    def __init__(self, width, height, cache, base=None, **kwargs):
+        # The url of a tile is only used as the key of the tile in the cache
+        super().__init__(width, height, url_template='{z}/{x}/{y}', **kwargs)
+        self.cache = cache
+        self.base = base
+
+    def get(self, url, **kwargs):
+        """Returns the status code and content of a tile, as StaticMap.get."""
+
+        z, x, y = map(int, url.split('/'))
+        try:
+            return 200, self.cache.get(z, x, y)
+        except Exception as e:
+            self.cache.count('failed')
+            logger.warning("Tile %s not available: %r", url, e)
+            return None, None
+
+    def _draw_base_layer(self, image):
+        """Paste the base map if it covers the map, or the tiles otherwise."""
+
+        if self.base is not None:
+            crop = self.base.crop(self.zoom, self.x_center, self.y_center, self.width, self.height)
+            if crop is not None:
+                image.paste(crop, (0, 0))
+                return
+        super()._draw_base_layer(image)
+
+
+def configure(cache, base=None):
+    """Given a tile cache and optionally a base map, makes static_map use
+    them for all the maps."""
+
+    global tile_cache, base_map
+    tile_cache = cache
+    base_map = base
+
+
+def static_map(width, height):
+    """Returns an empty map of the given size that uses the configured tile
+    cache and base map, or a plain StaticMap if there are none."""
+
+    if tile_cache is None:
+        return StaticMap(width, height)
+    return CachedStaticMap(width, height, tile_cache, base_map)
+
+
+if __name__ == '__main__':
+    # Usage: python tiles.py DIRECTORY
+    # Stores the tiles of Barcelona in DIRECTORY to render maps offline.
+    count = prefetch_tiles(TileCache(sys.argv[1], max_bytes=float('inf')))
+    print(count, " tiles stored in ", sys.argv[1])
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+import http.server
+
+logger = logging.getLogger('igo')
+
+
+class PositionStore:
+    """Positions of the users kept in a sqlite database, so that all the bot
+    processes see the same ones. It is used as the users dictionary of the
+    bot: positions are read with store[chat_id] and set with
+    store[chat_id] = [lat, lon].
+
+    Parameters:
+    ----------
+    FILENAME: name of the database file, shared by the processes.
+    """
+
+    def __init__(self, FILENAME):
+        self.filename = FILENAME
+        # Every thread needs its own connection
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS positions '
+                               '(chat_id INTEGER PRIMARY KEY, lat REAL, lon REAL, time REAL)')
+
+    def connection(self):
+        """Returns the connection of the current thread."""
+
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.filename, timeout=10)
+            self.local.connection.execute('PRAGMA journal_mode=WAL')
+        return self.local.connection
+
+    def __getitem__(self, chat_id):
+        row = self.connection().execute('SELECT lat, lon FROM positions WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            raise KeyError(chat_id)
+        return [row[0], row[1]]
+
+    def __setitem__(self, chat_id, position):
+        with self.connection() as connection:
+            if position:
+                connection.execute('INSERT OR REPLACE INTO positions VALUES (?, ?, ?, ?)',
+                                   (chat_id, position[0], position[1], time.time()))
+            else:
+                # An empty position, as set by /start, forgets the old one
+                connection.execute('DELETE FROM positions WHERE chat_id = ?', (chat_id,))
+
+    def __contains__(self, chat_id):
+        try:
+            self[chat_id]
+            return True
+        except KeyError:
+            return False
+
+
+def publish_snapshot(FILENAME, snapshot_time, weights_filename, congestions, traffic_filename=None):
+    """Given the time, the itimes file, the congestions of a snapshot and
+    the file of its congestion map, if any, publishes them in a json file
+    for the bot processes. The file is replaced at once, so readers never
+    see half of it."""
+
+    temporary = FILENAME + '.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'time': snapshot_time, 'weights_filename': weights_filename,
+                   'congestions': congestions, 'traffic_filename': traffic_filename}, file)
+    os.replace(temporary, FILENAME)
+
+
+def read_snapshot(FILENAME):
+    """Returns the time, the itimes file, the congestions and the map file of
+    the last published snapshot, as a dictionary, or None if there is
+    none."""
+
+    try:
+        with open(FILENAME) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def follow_snapshots(FILENAME, load, seconds=5):
+    """Calls load with every snapshot published in FILENAME, checking it
+    every few seconds in a background thread. The current one is loaded
+    before returning."""
+
+    current = read_snapshot(FILENAME)
+    load(current)
+
+    def loop():
+        last = current['time']
+        while True:
+            time.sleep(seconds)
+            published = read_snapshot(FILENAME)
+            if published is not None and published['time'] != last:
+                try:
+                    load(published)
+                    last = published['time']
+                except Exception as e:
+                    # The itimes file may have been replaced again
+                    logger.error("Published snapshot could not be loaded: %r", e)
+
+    threading.Thread(target=loop, daemon=True).start()
+
+
+def update_chat(update):
+    """Returns the id of the chat of a Telegram update, as a json object, or
+    0 if it has none."""
+
+    for key in ('message', 'edited_message', 'channel_post', 'callback_query'):
+        if key in update:
+            message = update[key]
+            if key == 'callback_query':
+                message = message.get('message', {})
+            return message.get('chat', {}).get('id', 0)
+    return 0
+
+
+class UpdateServer(http.server.ThreadingHTTPServer):
+    """HTTP server that receives the updates sent by Telegram to a webhook
+    and passes them to the bot processes through their queues. All the
+    updates of a chat go to the same process, so they are answered in
+    order.
+
+    Parameters:
+    ----------
+    address: (host, port) where the server listens.
+    path: Secret path of the webhook, such as '/' + TOKEN.
+    queues: One multiprocessing queue per bot process.
+    """
+
+    def __init__(self, address, path, queues):
+        self.webhook_path = path
+        self.queues = queues
+        super().__init__(address, UpdateHandler)
+
+
+class UpdateHandler(http.server.BaseHTTPRequestHandler):
+    """Handler of the requests of an UpdateServer."""
+
+    def do_POST(self):
+        if self.path != self.server.webhook_path:
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            update = json.loads(body)
+        except ValueError:
+            self.send_error(400)
+            return
+        queues = self.server.queues
+        queues[update_chat(update) % len(queues)].put(body)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # There is a request for every message of the users
+        pass
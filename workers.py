@@ -0,0 +1,160 @@
+import os
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import igo
+
+# Router of a routing process. The adjacency is mapped from the graph
+# snapshot once, and the itimes are mapped from the file of the current
+# congestions whenever they change. If the routing processes use a
+# contraction hierarchy, its topology is mapped once and the router is
+# customized with every new file.
+router = None
+topology = None
+weights_filename = None
+
+
+def save_weights(router, WEIGHTS_FILENAME):
+    """ Given a router and the name of a file, saves the itimes of the router
+    so that the routing processes can map them.
+
+    Parameters:
+    ----------
+    router: Router built from the current igraph.
+    WEIGHTS_FILENAME: name of the .npy file where the itimes are stored.
+
+    Returns:
+    ----------
+    Nothing. Only saves the itimes.
+    """
+
+    os.makedirs(os.path.dirname(WEIGHTS_FILENAME) or '.', exist_ok=True)
+    np.save(WEIGHTS_FILENAME, np.asarray(router.weights))
+
+
+def init_worker(SNAPSHOT_DIRNAME, HIERARCHY_DIRNAME=None):
+    """Load the router of the graph snapshot in a routing process and, if
+    HIERARCHY_DIRNAME is given, map the topology of its contraction hierarchy
+    from it (building it if it is not there)."""
+
+    global router, topology
+    router = igo.snapshot_router(igo.load_graph_snapshot(SNAPSHOT_DIRNAME))
+    if HIERARCHY_DIRNAME is not None:
+        topology = igo.load_hierarchy(HIERARCHY_DIRNAME, router)
+        if topology is None:
+            topology = igo.build_hierarchy(router)
+
+
+def current_router(WEIGHTS_FILENAME):
+    """Return the router of a routing process with the itimes stored in
+    WEIGHTS_FILENAME, mapping them if they have changed."""
+
+    global router, weights_filename
+    if WEIGHTS_FILENAME != weights_filename:
+        router = router._replace(weights=np.load(WEIGHTS_FILENAME, mmap_mode='r'))
+        if topology is not None:
+            router = igo.customize_router(router, topology)
+        weights_filename = WEIGHTS_FILENAME
+    return router
+
+
+def shortest_path(WEIGHTS_FILENAME, orig, dest):
+    """Find the shortest path between two nodes in a routing process using
+    the itimes stored in WEIGHTS_FILENAME."""
+
+    return igo.router_shortest_path(current_router(WEIGHTS_FILENAME), orig, dest)
+
+
+def shortest_paths(WEIGHTS_FILENAME, orig, dests):
+    """Find the shortest paths from a node to several ones in a routing
+    process using the itimes stored in WEIGHTS_FILENAME."""
+
+    return igo.router_shortest_paths(current_router(WEIGHTS_FILENAME), orig, dests)
+
+
+def isochrone(WEIGHTS_FILENAME, orig, max_itime):
+    """Find the nodes reachable from a node within max_itime in a routing
+    process using the itimes stored in WEIGHTS_FILENAME."""
+
+    return igo.router_isochrone(current_router(WEIGHTS_FILENAME), orig, max_itime)
+
+
+def render_path(igraph, ipath, SIZE, FORMAT='PNG', **options):
+    """Plot a path and return the encoded image."""
+
+    return igo.image_bytes(igo.plot_path(igraph, ipath, SIZE), FORMAT, **options)
+
+
+def render_paths(igraph, ipaths, SIZE, FORMAT='PNG', **options):
+    """Plot several paths on the same map and return the encoded image."""
+
+    return igo.image_bytes(igo.plot_paths(igraph, ipaths, SIZE), FORMAT, **options)
+
+
+def render_isochrone(igraph, itimes, max_itime, SIZE, FORMAT='PNG', **options):
+    """Plot an isochrone and return the encoded image."""
+
+    return igo.image_bytes(igo.plot_isochrone(igraph, itimes, max_itime, SIZE), FORMAT, **options)
+
+
+def render_traffic(arrays, congestions, SIZE, center=None, zoom=None, FORMAT='PNG', **options):
+    """Plot the congestions of the streets and return the encoded image."""
+
+    return igo.image_bytes(igo.plot_traffic(arrays, congestions, SIZE, center, zoom), FORMAT, **options)
+
+
+class RequestPool:
+    """Executes the slow parts of the requests out of the threads that talk
+    to Telegram. Routing runs in a pool of processes that map the graph
+    snapshot, so it is not limited by the GIL, and rendering (mostly waiting
+    for tiles and encoding images) runs in a pool of threads.
+
+    Parameters:
+    ----------
+    SNAPSHOT_DIRNAME: name of the directory of the graph snapshot.
+    processes: Number of routing processes. With 0 routes are computed in
+    the calling thread.
+    threads: Number of rendering threads.
+    HIERARCHY_DIRNAME: name of the directory where the topology of the
+    contraction hierarchy is saved, to route with it in the routing
+    processes, or None to route without it.
+    """
+
+    def __init__(self, SNAPSHOT_DIRNAME, processes=2, threads=4, HIERARCHY_DIRNAME=None):
+        self.routing = None
+        if processes > 0:
+            # Spawn the processes, as forking a process with threads is unsafe
+            self.routing = concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker, initargs=(SNAPSHOT_DIRNAME, HIERARCHY_DIRNAME))
+        self.rendering = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def route(self, router, WEIGHTS_FILENAME, orig, dest):
+        """Returns the shortest path between two nodes. router is used when
+        there are no routing processes, and WEIGHTS_FILENAME must have its
+        itimes otherwise."""
+
+        if self.routing is None:
+            return igo.router_shortest_path(router, orig, dest)
+        return self.routing.submit(shortest_path, WEIGHTS_FILENAME, orig, dest).result()
+
+    def route_many(self, router, WEIGHTS_FILENAME, orig, dests):
+        """Returns the itimes and shortest paths from a node to several ones,
+        as igo.router_shortest_paths."""
+
+        if self.routing is None:
+            return igo.router_shortest_paths(router, orig, dests)
+        return self.routing.submit(shortest_paths, WEIGHTS_FILENAME, orig, dests).result()
+
+    def isochrone(self, router, WEIGHTS_FILENAME, orig, max_itime):
+        """Returns the nodes reachable from a node within max_itime, as
+        igo.router_isochrone."""
+
+        if self.routing is None:
+            return igo.router_isochrone(router, orig, max_itime)
+        return self.routing.submit(isochrone, WEIGHTS_FILENAME, orig, max_itime).result()
+
+    def render(self, function, *args, **kwargs):
+        """Returns the result of calling function in a rendering thread."""
+
+        return self.rendering.submit(function, *args, **kwargs).result()